@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""
+Times r4's status and grep, and the functions they lean on, against
+synthetic depots of several sizes served by the fake P4 module in
+benchmarks/fakep4, so that changes can be measured without a
+Perforce server.
+
+Each scale is a depot with a workspace, created in a work directory.
+With --work-directory the depots are kept there and reused by later
+runs, otherwise they're made in a temporary directory and removed.
+Every benchmark is run once to warm up (which fills r4's caches, as
+earlier commands would have) and then timed; the median time is
+printed.  r4's in-process state is reset before each run, so each one
+costs what a new r4 process would.
+
+--save writes the results to a file, and --compare prints them next
+to the results saved in a file and exits with status 1 if anything
+got slower by more than --threshold percent.
+
+Usage: bench_commands.py [ -n iterations ] [ --scale name ... ] [ --work-directory dir ]
+                         [ --save file ] [ --compare file ] [ --threshold percent ]
+"""
+
+import getopt
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+FAKE_P4 = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakep4')
+# r4 imports P4 lazily, by name, so it gets the fake.
+sys.path.insert(0, FAKE_P4)
+sys.path.insert(0, ROOT)
+
+import P4
+import r4
+
+
+SCALES = [
+    ('small', {'files': 1000, 'revisions': 5, 'opened': 20, 'deleted': 5,
+               'unknown': 20, 'ignored': 20}),
+    ('medium', {'files': 10000, 'revisions': 5, 'opened': 100, 'deleted': 20,
+                'unknown': 100, 'ignored': 100}),
+    ('large', {'files': 100000, 'revisions': 3, 'opened': 1000, 'deleted': 100,
+               'unknown': 1000, 'ignored': 1000}),
+]
+
+DEFAULT_SCALES = ['small', 'medium']
+
+# How much slower than the saved results something has to be, in
+# percent, to count as a regression.
+DEFAULT_THRESHOLD = 10.0
+
+
+def reset_r4():
+    "Forgets what r4 keeps between commands in one process."
+    r4.g_translation_map = None
+    r4.g_client_spec = None
+    r4.g_client_update = None
+    r4.g_ignore_rules_cache.clear()
+    r4.StatCache.in_memory.clear()
+
+def run_r4_command(command, name, args):
+    def run(p4, depot):
+        command.run(p4, name, args)
+    return run
+
+def coalesce_ranges(p4, depot):
+    r4.coalesce_revision_ranges(depot.ranges)
+
+def load_translation_map(p4, depot):
+    r4.ensure_translation_map(p4)
+
+def build_translation_map(p4, depot):
+    cache_path = r4.user_cache_path('clients', r4.cache_file_name(p4.port, p4.client))
+    if os.path.exists(cache_path):
+        os.unlink(cache_path)
+    r4.ensure_translation_map(p4)
+
+BENCHMARKS = [
+    ('status', run_r4_command(r4.R4Status(), 'status', [])),
+    ('status --no-cache', run_r4_command(r4.R4Status(), 'status', ['--no-cache'])),
+    ('grep', run_r4_command(r4.R4Grep(), 'grep', ['TODO', P4.DEPOT_ROOT + '...'])),
+    ('grep -l', run_r4_command(r4.R4Grep(), 'grep', ['-l', 'TODO', P4.DEPOT_ROOT + '...'])),
+    ('grep -v', run_r4_command(r4.R4Grep(), 'grep', ['-v', 'TODO', P4.DEPOT_ROOT + '...'])),
+    ('coalesce_revision_ranges', coalesce_ranges),
+    ('ensure_translation_map', load_translation_map),
+    ('ensure_translation_map (build)', build_translation_map),
+]
+
+def make_ranges(count, max_revision, max_length):
+    "Returns count random revision ranges, as strings like annotate returns them."
+    ranges = []
+    for i in range(count):
+        lower = random.randint(1, max_revision)
+        upper = min(max_revision, lower + random.randint(0, max_length))
+        ranges.append((str(lower), str(upper)))
+    return ranges
+
+def get_depot(work_directory, name, parameters):
+    """Returns the depot for a scale, creating it unless the work
+    directory already has one with the same parameters.
+    """
+    directory = os.path.join(work_directory, name)
+    try:
+        depot = P4.load_depot(directory)
+        if [k for k, v in parameters.items() if depot.parameters.get(k) != v]:
+            depot = None
+    except (IOError, OSError, ValueError):
+        depot = None
+    if depot is None:
+        sys.stderr.write('Creating the %s depot...\n' % (name,))
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        P4.create_depot(directory, **parameters)
+        depot = P4.load_depot(directory)
+    return depot
+
+def time_benchmark(function, p4, depot, iterations):
+    """Calls function(p4, depot) once to warm up and then iterations
+    times, and returns the median time of a call in milliseconds.
+    """
+    times = []
+    saved_stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            for i in range(iterations + 1):
+                reset_r4()
+                start = time.time()
+                function(p4, depot)
+                if i:
+                    times.append((time.time() - start) * 1000.0)
+        finally:
+            sys.stdout = saved_stdout
+    times.sort()
+    return times[len(times) / 2]
+
+def run_scale(work_directory, name, parameters, iterations):
+    "Returns a dictionary mapping each benchmark's name to its time."
+    depot = get_depot(work_directory, name, parameters)
+    random.seed(1)
+    depot.ranges = make_ranges(depot.files, depot.files * 10, 20)
+    os.environ['FAKE_P4_DEPOT'] = depot.directory
+    os.chdir(depot.root)
+    reset_r4()
+    p4 = r4.get_p4_connection()
+    try:
+        return dict([(benchmark, time_benchmark(function, p4, depot, iterations))
+                     for benchmark, function in BENCHMARKS])
+    finally:
+        p4.disconnect()
+
+def print_results(results, previous, threshold):
+    """Prints the results, and how they compare to the previous ones if
+    there are any.  Returns the number of regressions.
+    """
+    regressions = 0
+    print '%-8s %-32s %12s %12s %9s' % ('scale', 'benchmark', 'time (ms)', 'before (ms)', 'change')
+    for scale, parameters in SCALES:
+        if scale not in results:
+            continue
+        for benchmark, function in BENCHMARKS:
+            milliseconds = results[scale][benchmark]
+            before = previous.get(scale, {}).get(benchmark)
+            if before:
+                change = (milliseconds - before) * 100.0 / before
+                flag = ''
+                if change > threshold:
+                    flag = ' *'
+                    regressions += 1
+                print '%-8s %-32s %12.2f %12.2f %+8.1f%%%s' % (scale, benchmark, milliseconds, before, change, flag)
+            else:
+                print '%-8s %-32s %12.2f %12s %9s' % (scale, benchmark, milliseconds, '-', '-')
+    return regressions
+
+def main(args):
+    iterations = 5
+    scales = []
+    work_directory = None
+    save_path = None
+    compare_path = None
+    threshold = DEFAULT_THRESHOLD
+    options, args = getopt.getopt(args, 'n:', ['scale=', 'work-directory=', 'save=', 'compare=',
+                                               'threshold='])
+    for option, value in options:
+        if option == '-n':
+            iterations = int(value)
+        elif option == '--scale':
+            if value not in dict(SCALES):
+                sys.stderr.write('Unknown scale %s; the scales are %s\n' % (value, ', '.join([n for n, p in SCALES])))
+                sys.exit(2)
+            scales.append(value)
+        elif option == '--work-directory':
+            work_directory = os.path.abspath(value)
+        elif option == '--save':
+            save_path = os.path.abspath(value)
+        elif option == '--compare':
+            compare_path = os.path.abspath(value)
+        elif option == '--threshold':
+            threshold = float(value)
+    if not scales:
+        scales = DEFAULT_SCALES
+
+    previous = {}
+    if compare_path:
+        with open(compare_path) as f:
+            previous = json.load(f)['results']
+
+    temporary = work_directory is None
+    if temporary:
+        work_directory = tempfile.mkdtemp(prefix='r4-bench-')
+    elif not os.path.isdir(work_directory):
+        os.makedirs(work_directory)
+    # Keep r4's per-user caches out of the real ~/.r4.
+    os.environ['HOME'] = os.path.join(work_directory, 'home')
+    cwd = os.getcwd()
+    try:
+        results = {}
+        for scale in scales:
+            results[scale] = run_scale(work_directory, scale, dict(SCALES)[scale], iterations)
+    finally:
+        os.chdir(cwd)
+        if temporary:
+            shutil.rmtree(work_directory)
+
+    regressions = print_results(results, previous, threshold)
+    if save_path:
+        with open(save_path, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'iterations': iterations,
+                       'time': time.strftime('%Y/%m/%d %H:%M:%S'),
+                       'scales': dict([(scale, dict(SCALES)[scale]) for scale in scales]),
+                       'results': results}, f, indent=1, sort_keys=True)
+    if regressions:
+        print
+        print '%d benchmark(s) got more than %.0f%% slower.' % (regressions, threshold)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
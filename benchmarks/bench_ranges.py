@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Compares coalescing revision ranges with RevisionRangeSet against the
+bitmap implementation r4 used to have.
+
+For each workload, checks that both give the same ranges, then prints
+the median time each takes.  The workloads are shaped like the match
+ranges 'grep -l' collects: many short ranges scattered over a file's
+history.
+
+Usage: bench_ranges.py [ -n iterations ] [ --seed seed ]
+"""
+
+import getopt
+import os
+import random
+import sys
+import time
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import r4
+
+
+def bitmap_coalesce_revision_ranges(ranges):
+    "The bitmap implementation that RevisionRangeSet replaced."
+    max_r = None
+    for l, r in ranges:
+        if not max_r or int(r) > max_r:
+            max_r = int(r)
+    revisions = [False] * (max_r + 1)
+    for l, r in ranges:
+        for i in range(int(l), int(r) + 1):
+            revisions[i] = True
+
+    new_ranges = []
+    start_l = None
+    pos = 0
+    while pos < len(revisions):
+        state = revisions[pos]
+        if start_l:
+            if state == False:
+                new_ranges.append((start_l, pos - 1))
+                start_l = None
+        if not start_l:
+            if state == True:
+                start_l = pos
+        pos += 1
+    if start_l:
+        new_ranges.append((start_l, pos - 1))
+    return new_ranges
+
+def streaming_coalesce_revision_ranges(ranges):
+    "Adds the ranges one at a time, the way grep does."
+    range_set = r4.RevisionRangeSet()
+    for lower, upper in ranges:
+        range_set.add(lower, upper)
+    return list(range_set)
+
+def make_ranges(count, max_revision, max_length, in_order):
+    """Returns count random ranges of revisions from 1 to
+    max_revision, as strings like annotate returns them.
+    """
+    ranges = []
+    for i in range(count):
+        lower = random.randint(1, max_revision)
+        upper = min(max_revision, lower + random.randint(0, max_length))
+        ranges.append((lower, upper))
+    if in_order:
+        ranges.sort()
+    return [(str(lower), str(upper)) for lower, upper in ranges]
+
+WORKLOADS = [
+    # (name, number of ranges, highest revision, longest range, sorted)
+    ('small', 50, 100, 10, False),
+    ('long history', 1000, 50000, 20, False),
+    ('many matches', 20000, 50000, 5, False),
+    ('in order', 20000, 50000, 5, True),
+    ('long ranges', 2000, 20000, 5000, False),
+]
+
+IMPLEMENTATIONS = [
+    ('bitmap', bitmap_coalesce_revision_ranges),
+    ('sorted', r4.coalesce_revision_ranges),
+    ('streaming', streaming_coalesce_revision_ranges),
+]
+
+def time_function(function, argument, iterations):
+    "Returns the median time of calling function(argument), in milliseconds."
+    times = []
+    for i in range(iterations):
+        start = time.time()
+        function(argument)
+        times.append((time.time() - start) * 1000.0)
+    times.sort()
+    return times[len(times) / 2]
+
+def main(args):
+    iterations = 5
+    seed = 1
+    options, args = getopt.getopt(args, 'n:', ['seed='])
+    for option, value in options:
+        if option == '-n':
+            iterations = int(value)
+        elif option == '--seed':
+            seed = int(value)
+    random.seed(seed)
+
+    print '%-14s %8s' % ('workload', 'ranges') + ''.join(['%16s' % (name + ' (ms)',) for name, f in IMPLEMENTATIONS])
+    for name, count, max_revision, max_length, in_order in WORKLOADS:
+        ranges = make_ranges(count, max_revision, max_length, in_order)
+        expected = bitmap_coalesce_revision_ranges(ranges)
+        for implementation_name, function in IMPLEMENTATIONS:
+            if function(ranges) != expected:
+                sys.stderr.write('%s gives the wrong ranges for %s\n' % (implementation_name, name))
+                sys.exit(1)
+        times = [time_function(function, ranges, iterations) for n, function in IMPLEMENTATIONS]
+        print '%-14s %8d' % (name, count) + ''.join(['%16.2f' % (t,) for t in times])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Measures how much time r4 adds to commands that it passes through to
+p4.
+
+Puts a stand-in p4 (which does nothing) first on the PATH, then times
+running commands with it directly and through r4.  The difference is
+r4's overhead.
+
+r4.py is timed both run directly and through the r4 launcher, which
+uses the compiled r4.pyc.
+
+Usage: bench_startup.py [ -n iterations ] [ --python interpreter ] [ command ... ]
+"""
+
+import getopt
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# The script itself, and the launcher that imports it.
+R4_SCRIPT = os.path.join(ROOT, 'r4.py')
+R4_LAUNCHER = os.path.join(ROOT, 'r4')
+
+DEFAULT_COMMANDS = ['sync', 'edit', 'opened']
+
+
+def make_fake_p4(directory):
+    "Creates a p4 executable in directory that exits immediately."
+    path = os.path.join(directory, 'p4')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nexit 0\n')
+    os.chmod(path, 0755)
+    return path
+
+def time_command(argv, iterations, env):
+    """Runs a command iterations times and returns the median wall
+    clock time of a run, in milliseconds.
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(iterations):
+            start = time.time()
+            subprocess.call(argv, env=env, stdout=devnull, stderr=devnull)
+            times.append((time.time() - start) * 1000.0)
+    times.sort()
+    return times[len(times) / 2]
+
+def main(args):
+    iterations = 50
+    python = sys.executable
+    options, commands = getopt.getopt(args, 'n:', ['python='])
+    for option, value in options:
+        if option == '-n':
+            iterations = int(value)
+        elif option == '--python':
+            python = value
+    if not commands:
+        commands = DEFAULT_COMMANDS
+
+    directory = tempfile.mkdtemp(prefix='r4-bench-')
+    try:
+        p4 = make_fake_p4(directory)
+        env = dict(os.environ)
+        env['PATH'] = directory + os.pathsep + env.get('PATH', '')
+
+        # Make sure the launcher finds a compiled r4.pyc.
+        subprocess.call([python, '-c', 'import compileall; compileall.compile_file(%r, quiet=True)' % (R4_SCRIPT,)])
+
+        interpreter = time_command([python, '-c', 'pass'], iterations, env)
+        print '%-12s %10s %12s %12s' % ('command', 'p4 (ms)', 'r4.py (ms)', 'r4 (ms)')
+        for command in commands:
+            direct = time_command([p4, command], iterations, env)
+            script = time_command([python, R4_SCRIPT, command], iterations, env)
+            launcher = time_command([python, R4_LAUNCHER, command], iterations, env)
+            print '%-12s %10.2f %12.2f %12.2f' % (command, direct, script, launcher)
+        print
+        print 'Python interpreter startup alone: %.2f ms' % (interpreter,)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,631 @@
+#!/usr/bin/env python
+
+"""
+A stand-in for the P4 module that serves a synthetic depot, so r4 can
+be benchmarked without a Perforce server.
+
+Put this directory first on sys.path (or PYTHONPATH) and set
+FAKE_P4_DEPOT to a directory made by create_depot, and r4 will talk to
+the depot described there instead of to a server.  The depot has a
+given number of files, each with a given number of revisions, all
+mapped by one client whose workspace create_depot writes out with
+some files opened for edit (half of them modified), some opened for
+delete (and removed), and some files that aren't in the depot, some
+of them ignored.
+
+Only the commands and the tagged output r4 uses when it runs status
+and grep are supported, and nothing can be changed: the depot is
+computed from its parameters rather than stored.  Every revision
+changes one line of a file, and the lines it changes mention 'TODO'.
+
+Usage: P4.py [ --files n ] [ --revisions n ] [ --lines n ] [ --opened n ]
+             [ --deleted n ] [ --unknown n ] [ --ignored n ] directory
+
+creates a depot in directory and prints the environment settings
+that make r4 use it.
+"""
+
+import bisect
+import getopt
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+
+# The name of the file create_depot describes the depot in.
+DEPOT_FILE = 'depot.json'
+
+DEFAULT_PARAMETERS = {
+    'files': 1000,
+    'revisions': 5,
+    'lines': 20,
+    'files_per_directory': 25,
+    'opened': 20,
+    'deleted': 5,
+    'unknown': 20,
+    'ignored': 20,
+    'seed': 1,
+}
+
+DEPOT_ROOT = '//depot/bench/'
+CLIENT = 'bench'
+
+
+class P4Exception(Exception):
+    pass
+
+
+class OutputHandler(object):
+    REPORT = 0
+    HANDLED = 1
+    CANCEL = 2
+
+    def outputStat(self, stat):
+        return OutputHandler.REPORT
+
+    def outputInfo(self, info):
+        return OutputHandler.REPORT
+
+    def outputText(self, text):
+        return OutputHandler.REPORT
+
+    def outputBinary(self, data):
+        return OutputHandler.REPORT
+
+    def outputMessage(self, message):
+        return OutputHandler.REPORT
+
+
+# --------------------
+# Views.  Only the lines r4 makes, which map whole directories or
+# single files, are supported.
+# --------------------
+
+class Map(object):
+    def __init__(self, *args):
+        # A list of (exclude, lhs, rhs); later lines override earlier
+        # ones.
+        self.lines = []
+        if args:
+            self.insert(*args)
+
+    def insert(self, lhs, rhs=None):
+        if rhs is None:
+            if isinstance(lhs, (list, tuple)):
+                for line in lhs:
+                    self.insert(line)
+                return
+            lhs, rhs = split_map_line(lhs)
+        exclude = lhs.startswith('-')
+        self.lines.append((exclude, lhs.lstrip('-+'), rhs))
+
+    def is_empty(self):
+        return not self.lines
+
+    def translate(self, path):
+        for exclude, lhs, rhs in reversed(self.lines):
+            if lhs.endswith('...'):
+                if path.startswith(lhs[:-3]):
+                    if exclude:
+                        return None
+                    return rhs[:-3] + path[len(lhs) - 3:]
+            elif path == lhs:
+                if exclude:
+                    return None
+                return rhs
+        return None
+
+    def reverse(self):
+        map = Map()
+        map.lines = [(exclude, rhs, lhs) for exclude, lhs, rhs in self.lines]
+        return map
+
+    def as_array(self):
+        return ['%s%s %s' % (exclude and '-' or '', quote_map_path(lhs), quote_map_path(rhs))
+                for exclude, lhs, rhs in self.lines]
+
+    @staticmethod
+    def join(left, right):
+        map = Map()
+        for exclude, lhs, rhs in left.lines:
+            translated = right.translate(rhs)
+            if translated is not None:
+                map.lines.append((exclude, lhs, translated))
+        return map
+
+def split_map_line(line):
+    if line.startswith('"') or ' "' in line:
+        parts = [part for part in line.split('"') if part.strip()]
+    else:
+        parts = line.split()
+    if len(parts) != 2:
+        raise P4Exception('Unsupported map line: %s' % (line,))
+    return parts[0].strip(), parts[1].strip()
+
+def quote_map_path(path):
+    if ' ' in path:
+        return '"%s"' % (path,)
+    return path
+
+
+# --------------------
+# The synthetic depot.
+# --------------------
+
+def line_text(number, line, revision):
+    "Returns the text line of file number has after the revision that changed it."
+    if revision == 1:
+        return 'static int value_%d_%d = %d;\n' % (number, line, line)
+    return 'static int value_%d_%d = %d;  /* TODO: changed in #%d */\n' % (number, line, revision, revision)
+
+class SyntheticDepot:
+    """Computes the files, revisions and workspace of a depot from its
+    parameters.  Files are numbered from 0; revision r of file n is in
+    change (r - 1) * files + n + 1.
+    """
+    def __init__(self, directory, parameters):
+        self.directory = directory
+        self.parameters = parameters
+        for name, value in parameters.items():
+            setattr(self, name, value)
+        self.root = os.path.join(directory, 'workspace')
+        self.port = parameters['port']
+        self.update = parameters['update']
+        self.view = ['%s... //%s/...' % (DEPOT_ROOT, CLIENT)]
+        # The files' paths relative to the depot root, sorted.
+        self.paths = sorted([self.file_path(n) for n in range(self.files)])
+        self.numbers = dict([(self.file_path(n), n) for n in range(self.files)])
+        rng = random.Random(self.seed)
+        chosen = rng.sample(range(self.files), min(self.files, self.opened + self.deleted))
+        self.actions = {}
+        for n in chosen[:self.opened]:
+            self.actions[n] = 'edit'
+        for n in chosen[self.opened:]:
+            self.actions[n] = 'delete'
+        self.modified = set(chosen[:self.opened:2])
+
+    def file_path(self, number):
+        directory = number / self.files_per_directory
+        return 'd%d/s%d/file%d.c' % (directory / 20, directory % 20, number)
+
+    def change(self, number, revision):
+        return (revision - 1) * self.files + number + 1
+
+    def head_change(self):
+        return self.change(self.files - 1, self.revisions)
+
+    def changed_line(self, number, revision):
+        return (number * 7 + revision * 13) % self.lines
+
+    def lines_at(self, number, revision):
+        lines = [line_text(number, line, 1) for line in range(self.lines)]
+        for r in range(2, revision + 1):
+            lines[self.changed_line(number, r)] = line_text(number, self.changed_line(number, r), r)
+        return lines
+
+    def contents(self, number, revision):
+        return ''.join(self.lines_at(number, revision))
+
+    def local_contents(self, number):
+        contents = self.contents(number, self.revisions)
+        if number in self.modified:
+            contents += 'int local_change;\n'
+        return contents
+
+    def annotate(self, number, lower, upper, all_lines):
+        """Returns (lower, upper, text) for each line of revisions lower
+        through upper of a file, like 'p4 annotate [ -a ]'.
+        """
+        texts = self.lines_at(number, lower)
+        starts = [lower] * len(texts)
+        removed = []
+        for r in range(lower + 1, upper + 1):
+            line = self.changed_line(number, r)
+            removed.append((starts[line], r - 1, texts[line]))
+            starts[line] = r
+            texts[line] = line_text(number, line, r)
+        current = [(starts[line], upper, texts[line]) for line in range(len(texts))]
+        if all_lines:
+            return removed + current
+        return current
+
+    def matching_files(self, relative):
+        "Returns the numbers of the files a path (relative to the depot root) names."
+        if '*' in relative or '...' in relative[:-3]:
+            raise P4Exception('Unsupported wildcard: %s' % (relative,))
+        if relative.endswith('...'):
+            prefix = relative[:-3]
+            start = bisect.bisect_left(self.paths, prefix)
+            end = start
+            while end < len(self.paths) and self.paths[end].startswith(prefix):
+                end += 1
+            return [self.numbers[path] for path in self.paths[start:end]]
+        elif relative in self.numbers:
+            return [self.numbers[relative]]
+        return []
+
+    def revision_number(self, number, specifier, lower_bound=False):
+        """Returns the revision of a file a revision specifier like '#3'
+        or '@1234' names, or with lower_bound the first one it
+        includes as the start of a range.
+        """
+        if specifier.startswith('#'):
+            name = specifier[1:]
+            if name in ('head', 'have'):
+                return self.revisions
+            elif name == 'none':
+                return 0
+            return min(int(name), self.revisions)
+        elif specifier.startswith('@'):
+            name = specifier[1:]
+            if name == 'now':
+                return self.revisions
+            change = int(name)
+            if lower_bound:
+                revision = (change - number - 2) / self.files + 2
+            else:
+                revision = (change - number - 1) / self.files + 1
+            return max(0, min(revision, self.revisions))
+        raise P4Exception('Unsupported revision: %s' % (specifier,))
+
+    def revision_range(self, number, revision):
+        """Returns the (lower, upper) revisions of a file that a revision
+        specifier includes, or None if it doesn't include any.
+        """
+        if not revision:
+            return 1, self.revisions
+        lower, comma, upper = revision.partition(',')
+        if comma:
+            if upper[:1] not in ('#', '@'):
+                upper = lower[0] + upper
+            low = max(1, self.revision_number(number, lower, lower_bound=True))
+            high = self.revision_number(number, upper)
+        else:
+            low, high = 1, self.revision_number(number, revision)
+        if high < low:
+            return None
+        return low, high
+
+def create_depot(directory, **parameters):
+    """Writes a description of a depot with the given parameters (see
+    DEFAULT_PARAMETERS) to directory, with its workspace in
+    directory/workspace.  Returns the SyntheticDepot.
+    """
+    values = dict(DEFAULT_PARAMETERS)
+    values.update(parameters)
+    values['update'] = time.strftime('%Y/%m/%d %H:%M:%S')
+    values['port'] = 'fake:%s:%d' % (os.path.basename(os.path.abspath(directory)), int(time.time() * 1000))
+    depot = SyntheticDepot(os.path.abspath(directory), values)
+
+    for number in range(depot.files):
+        if depot.actions.get(number) == 'delete':
+            continue
+        path = os.path.join(depot.root, depot.file_path(number))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(depot.local_contents(number))
+    # Files that aren't in the depot go next to the ones that are.
+    step = max(1, depot.files / max(1, depot.unknown + depot.ignored))
+    for i in range(depot.unknown + depot.ignored):
+        directory_path = os.path.dirname(os.path.join(depot.root, depot.file_path(min(i * step, depot.files - 1))))
+        if not os.path.isdir(directory_path):
+            os.makedirs(directory_path)
+        if i < depot.unknown:
+            name = 'notes%d.txt' % (i,)
+        else:
+            name = 'object%d.o' % (i,)
+        with open(os.path.join(directory_path, name), 'wb') as f:
+            f.write('not in the depot\n')
+    with open(os.path.join(depot.root, '.r4ignore'), 'wb') as f:
+        f.write('*.o\n')
+
+    with open(os.path.join(directory, DEPOT_FILE), 'wb') as f:
+        json.dump(values, f, indent=1, sort_keys=True)
+    return depot
+
+# Depots we've loaded, by directory, so connections share them.
+g_depots = {}
+
+def load_depot(directory):
+    directory = os.path.abspath(directory)
+    path = os.path.join(directory, DEPOT_FILE)
+    mtime = os.path.getmtime(path)
+    if directory not in g_depots or g_depots[directory][0] != mtime:
+        with open(path, 'rb') as f:
+            parameters = json.load(f)
+        parameters = dict([(str(key), value) for key, value in parameters.items()])
+        g_depots[directory] = (mtime, SyntheticDepot(directory, parameters))
+    return g_depots[directory][1]
+
+
+# --------------------
+# Connections.
+# --------------------
+
+def flatten(args):
+    flat = []
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            flat.extend(flatten(arg))
+        else:
+            flat.append(str(arg))
+    return flat
+
+def parse_options(args, with_values=''):
+    """Splits p4 command arguments into a dictionary of options and a
+    list of file arguments.  Options in with_values take a value.
+    """
+    options = {}
+    files = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if not files and arg.startswith('-') and len(arg) > 1:
+            if arg[1] in with_values:
+                if len(arg) > 2:
+                    options[arg[1]] = arg[2:]
+                else:
+                    i += 1
+                    options[arg[1]] = args[i]
+            else:
+                options[arg[1:]] = True
+        else:
+            files.append(arg)
+        i += 1
+    return options, files
+
+class P4(object):
+    RAISE_NONE = 0
+    RAISE_ERROR = 1
+    RAISE_ALL = 2
+
+    def __init__(self):
+        self.exception_level = P4.RAISE_ALL
+        self.handler = None
+        self.tagged = 1
+        self.cwd = os.getcwd()
+        self.user = os.environ.get('P4USER', 'bench')
+        self.depot = None
+        self.port = 'fake'
+        self.client = CLIENT
+        if os.environ.get('FAKE_P4_DEPOT'):
+            self.depot = load_depot(os.environ['FAKE_P4_DEPOT'])
+            self.port = self.depot.port
+        self.is_connected = False
+
+    def connect(self):
+        if self.depot is None:
+            raise P4Exception('FAKE_P4_DEPOT is not set to a depot made by create_depot.')
+        self.is_connected = True
+        return self
+
+    def disconnect(self):
+        self.is_connected = False
+
+    def connected(self):
+        return self.is_connected
+
+    def __getattr__(self, name):
+        if name.startswith('run_'):
+            command = name[len('run_'):]
+            return lambda *args: self.run(command, *args)
+        raise AttributeError(name)
+
+    def run(self, command, *args):
+        args = flatten(args)
+        method = getattr(self, 'command_' + command, None)
+        if method is None:
+            raise P4Exception('The fake P4 module does not support %s.' % (command,))
+        results = method(args)
+        if self.handler is None:
+            return list(results)
+        reported = []
+        for result in results:
+            if isinstance(result, dict):
+                action = self.handler.outputStat(result)
+            else:
+                action = self.handler.outputText(result)
+            if action == OutputHandler.REPORT:
+                reported.append(result)
+            elif action == OutputHandler.CANCEL:
+                break
+        return reported
+
+    def fetch_client(self, name=None):
+        return self.command_client(['-o'])[0]
+
+    def relative_path(self, path):
+        """Returns a depot, client or local path relative to the depot
+        root, or None if it's outside the depot.
+        """
+        for root in (DEPOT_ROOT, '//%s/' % (self.client,)):
+            if path.startswith(root):
+                return path[len(root):]
+        if path.startswith('//'):
+            return None
+        local = os.path.normpath(os.path.join(self.cwd, path))
+        if local == self.depot.root:
+            return ''
+        root = os.path.join(self.depot.root, '')
+        if local.startswith(root):
+            return local[len(root):]
+        return None
+
+    def resolve(self, spec):
+        """Returns the numbers of the files a file specification names,
+        and its revision specifier.
+        """
+        path, revision = spec, ''
+        for i, c in enumerate(spec):
+            if c in '#@':
+                path, revision = spec[:i], spec[i:]
+                break
+        relative = self.relative_path(path)
+        if relative is None:
+            return [], revision
+        return self.depot.matching_files(relative), revision
+
+    def resolve_all(self, specs):
+        "Returns (file number, revision specifier) for each file the specs name."
+        seen = set()
+        resolved = []
+        for spec in specs:
+            numbers, revision = self.resolve(spec)
+            for number in numbers:
+                if number not in seen:
+                    seen.add(number)
+                    resolved.append((number, revision))
+        return resolved
+
+    def local_path(self, number):
+        return os.path.join(self.depot.root, self.depot.file_path(number))
+
+    def command_clients(self, args):
+        return [{'client': self.client, 'Update': self.depot.update, 'Access': self.depot.update,
+                 'Root': self.depot.root, 'Options': 'noallwrite noclobber', 'Owner': self.user}]
+
+    def command_client(self, args):
+        options, names = parse_options(args)
+        if 'o' not in options or (names and names[0] != self.client):
+            raise P4Exception('The fake P4 module only supports client -o.')
+        return [{'Client': self.client, 'Update': self.depot.update, 'Access': self.depot.update,
+                 'Owner': self.user, 'Host': '', 'Description': 'Benchmark client.\n',
+                 'Root': self.depot.root, 'Options': 'noallwrite noclobber nocompress unlocked nomodtime normdir',
+                 'SubmitOptions': 'submitunchanged', 'LineEnd': 'local', 'View': list(self.depot.view)}]
+
+    def command_changes(self, args):
+        options, specs = parse_options(args, 'msu')
+        depot = self.depot
+        if specs:
+            changes = set()
+            for number, revision in self.resolve_all(specs):
+                bounds = depot.revision_range(number, revision)
+                if bounds:
+                    changes.update([depot.change(number, r) for r in range(bounds[0], bounds[1] + 1)])
+            changes = sorted(changes, reverse=True)
+        else:
+            changes = xrange(depot.head_change(), 0, -1)
+        if 'm' in options:
+            changes = itertools.islice(changes, int(options['m']))
+        return [{'change': str(change), 'time': str(1000000000 + change), 'user': self.user,
+                 'client': self.client, 'status': 'submitted', 'changeType': 'public',
+                 'desc': 'Change %d.\n' % (change,)}
+                for change in changes]
+
+    def command_have(self, args):
+        options, specs = parse_options(args)
+        if not specs:
+            specs = ['//%s/...' % (self.client,)]
+        depot = self.depot
+        # A generator, so that with an output handler the records are
+        # made one at a time, as they are by a server.
+        for number, revision in self.resolve_all(specs):
+            bounds = depot.revision_range(number, revision)
+            if bounds is None or not bounds[0] <= depot.revisions <= bounds[1]:
+                continue
+            relative = depot.file_path(number)
+            yield {'depotFile': DEPOT_ROOT + relative,
+                   'clientFile': '//%s/%s' % (self.client, relative),
+                   'path': self.local_path(number), 'haveRev': str(depot.revisions)}
+
+    def command_opened(self, args):
+        options, specs = parse_options(args, 'cmu')
+        depot = self.depot
+        if specs:
+            numbers = [number for number, revision in self.resolve_all(specs) if number in depot.actions]
+        else:
+            numbers = sorted(depot.actions)
+        return [{'depotFile': DEPOT_ROOT + depot.file_path(number),
+                 'clientFile': '//%s/%s' % (self.client, depot.file_path(number)),
+                 'rev': str(depot.revisions), 'haveRev': str(depot.revisions),
+                 'action': depot.actions[number], 'change': 'default', 'type': 'text',
+                 'user': self.user, 'client': self.client}
+                for number in numbers]
+
+    def command_fstat(self, args):
+        options, specs = parse_options(args, 'TFmOR')
+        depot = self.depot
+        fields = options.get('T')
+        if fields:
+            fields = set(fields.replace(' ', ',').split(','))
+        sizes = 'l' in options.get('O', '')
+        only_opened = 'o' in options.get('R', '')
+        results = []
+        for number, revision in self.resolve_all(specs):
+            if only_opened and number not in depot.actions:
+                continue
+            bounds = depot.revision_range(number, revision)
+            if bounds is None or bounds[1] == 0:
+                continue
+            rev = bounds[1]
+            relative = depot.file_path(number)
+            record = {'depotFile': DEPOT_ROOT + relative, 'clientFile': self.local_path(number),
+                      'isMapped': '', 'headAction': rev == 1 and 'add' or 'edit', 'headType': 'text',
+                      'headTime': str(1000000000 + depot.change(number, rev)), 'headRev': str(rev),
+                      'headChange': str(depot.change(number, rev)), 'haveRev': str(depot.revisions)}
+            if number in depot.actions:
+                record['action'] = depot.actions[number]
+            if sizes:
+                contents = depot.contents(number, rev)
+                record['fileSize'] = str(len(contents))
+                if not fields or 'digest' in fields:
+                    record['digest'] = hashlib.md5(contents).hexdigest().upper()
+            if fields:
+                record = dict([(key, value) for key, value in record.items() if key in fields])
+            results.append(record)
+        return results
+
+    def command_annotate(self, args):
+        options, specs = parse_options(args)
+        depot = self.depot
+        results = []
+        for number, revision in self.resolve_all(specs):
+            bounds = depot.revision_range(number, revision)
+            if bounds is None or bounds[1] == 0:
+                continue
+            lower, upper = bounds
+            results.append({'depotFile': DEPOT_ROOT + depot.file_path(number), 'rev': str(upper),
+                            'change': str(depot.change(number, upper)), 'action': 'edit', 'type': 'text'})
+            for low, high, text in depot.annotate(number, lower, upper, 'a' in options):
+                if 'c' in options:
+                    low, high = depot.change(number, low), depot.change(number, high)
+                results.append({'lower': str(low), 'upper': str(high), 'data': text})
+        return results
+
+    def command_where(self, args):
+        results = []
+        for spec in args:
+            relative = self.relative_path(spec)
+            if relative is None:
+                continue
+            results.append({'depotFile': DEPOT_ROOT + relative,
+                            'clientFile': '//%s/%s' % (self.client, relative),
+                            'path': os.path.join(self.depot.root, relative)})
+        return results
+
+
+def main(args):
+    parameters = {}
+    names = [name for name in DEFAULT_PARAMETERS if name != 'seed']
+    options, args = getopt.getopt(args, '', [name.replace('_', '-') + '=' for name in names])
+    for option, value in options:
+        parameters[option[2:].replace('-', '_')] = int(value)
+    if len(args) != 1:
+        sys.stderr.write(__doc__)
+        sys.exit(2)
+    directory = os.path.abspath(args[0])
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    depot = create_depot(directory, **parameters)
+    print 'export PYTHONPATH=%s' % (os.path.dirname(os.path.abspath(__file__)),)
+    print 'export FAKE_P4_DEPOT=%s' % (directory,)
+    print 'cd %s' % (depot.root,)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -16,12 +16,16 @@ basically you need to first install the Perforce C++ API.)
 """
 from __future__ import with_statement
 
-import P4
 import os
-import fnmatch
+import re
 import sys
-import pprint
 import itertools
+import time
+import cPickle
+import cStringIO
+import hashlib
+import mmap
+import bisect
 
 # I usually prefer optparse, but this is a special case where we don't
 # care about all the extra stuff optparse does for us since we're not
@@ -30,6 +34,24 @@ import itertools
 import getopt
 
 
+class LazyModule:
+    """Stands in for a module that is only imported the first time one
+    of its attributes is used.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = __import__(self.name)
+        return getattr(self.module, attribute)
+
+# The P4 module is a big C extension that takes a while to load, and
+# commands we just pass through to p4 don't need it.
+P4 = LazyModule('P4')
+
+
 # --------------------
 # Maps command names to our custom implementations.
 # --------------------
@@ -46,16 +68,57 @@ def all_r4_commands():
     return sorted(g_command_table.keys())
 
 
+# --------------------
+# Cache files.  Caches that belong to a client workspace live in a .r4
+# directory at the root of the workspace, the rest live in ~/.r4.
+# --------------------
+
+R4_DIR = '.r4'
+
+def user_cache_path(*names):
+    """Returns the path of a cache file in ~/.r4, creating its
+    directory if necessary.
+    """
+    path = os.path.join(os.path.expanduser('~'), R4_DIR, *names)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return path
+
+def cache_file_name(*parts):
+    "Makes a file name out of strings like server ports and client names."
+    return '-'.join([re.sub(r'[^\w.]', '_', part) for part in parts])
+
+def write_file_atomically(path, data):
+    """Writes data to path such that concurrent readers see either the
+    old contents or the new contents, never a partial file.
+    """
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.%s.' % (os.path.basename(path),))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+    except:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
 # --------------------
 # Build maps that lets us translate between paths in depot syntax,
 # client syntax and local syntax, like //depot/users/wiseman ->
 # /home/wiseman/work/wiseman and vice versa.
 # --------------------
 
-g_cached_depot_to_local_map = None
-
 g_translation_map = None
 
+g_client_spec = None
+
+# The (Update, Root) of the client when the maps were built.
+g_client_update = None
+
 
 def add_translation_map(fromm, to, map):
     global g_translation_map
@@ -83,28 +146,97 @@ def ensure_translation_map(p4=None):
     depot  <-->  client
     client <-->  local
     depot  <-->  local
+
+    The maps are cached in ~/.r4, and as long as the client spec
+    hasn't been updated and its root hasn't changed we use the cached
+    ones instead of fetching the spec and building them.
     """
-    global g_translation_map
+    global g_translation_map, g_client_spec, g_client_update
     if not g_translation_map:
         g_translation_map = {}
 
         if not p4:
             p4 = get_p4_connection()
 
-        client_info = p4.run_client('-o')[0]
-        client_name = client_info['Client']
-        client_root = client_info['Root']
-        client_views = client_info['View']
-        depot_to_client_map = P4.Map()
-        
-        depot_to_client_map.insert(client_views)
-        add_translation_map('depot', 'client', depot_to_client_map)
+        cache_path = user_cache_path('clients', cache_file_name(p4.port, p4.client))
+        state = load_translation_map_cache(p4, cache_path)
+        if state is None:
+            state = build_translation_map_state(p4)
+            if state['Update'] is not None:
+                try:
+                    write_file_atomically(cache_path, cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL))
+                except (IOError, OSError):
+                    pass
+
+        g_client_spec = state['spec']
+        g_client_update = (state['Update'], state['Root'])
+        for (fromm, to), map_lines in state['maps'].items():
+            map = P4.Map()
+            map.insert(map_lines)
+            add_translation_map(fromm, to, map)
+
+
+def refresh_translation_map(p4):
+    """Throws away the translation maps if the client has changed since
+    they were built.  For processes, like the daemon, that run more
+    than one command.
+    """
+    global g_translation_map
+    if g_translation_map and client_update_info(p4) != g_client_update:
+        g_translation_map = None
+
 
-        client_to_local_map = P4.Map()
-        client_to_local_map.insert('//%s/...' % (client_name,), os.path.join(client_root, '...'))
-        add_translation_map('client', 'local', client_to_local_map)
+TRANSLATION_MAP_CACHE_VERSION = 1
 
-        add_translation_map('depot', 'local', P4.Map.join(depot_to_client_map, client_to_local_map))
+def client_update_info(p4):
+    """Returns the (Update, Root) of the current client from 'p4
+    clients', which is cheaper than fetching the spec itself, or
+    (None, None) if the client doesn't exist.
+    """
+    for info in p4.run('clients', '-e', p4.client, '-m', '1'):
+        if info.get('client') == p4.client:
+            return info.get('Update'), info.get('Root')
+    return None, None
+
+def build_translation_map_state(p4):
+    "Fetches the client spec and builds the translation maps from it."
+    update, root = client_update_info(p4)
+    client_info = p4.run_client('-o')[0]
+    client_name = client_info['Client']
+    client_root = client_info['Root']
+    client_views = client_info['View']
+    depot_to_client_map = P4.Map()
+    
+    depot_to_client_map.insert(client_views)
+
+    client_to_local_map = P4.Map()
+    client_to_local_map.insert('//%s/...' % (client_name,), os.path.join(client_root, '...'))
+
+    depot_to_local_map = P4.Map.join(depot_to_client_map, client_to_local_map)
+
+    spec = dict((key, value) for key, value in client_info.items() if key != 'Description')
+    return {'version': TRANSLATION_MAP_CACHE_VERSION,
+            'Update': update,
+            'Root': root,
+            'spec': spec,
+            'maps': {('depot', 'client'): depot_to_client_map.as_array(),
+                     ('client', 'local'): client_to_local_map.as_array(),
+                     ('depot', 'local'): depot_to_local_map.as_array()}}
+
+def load_translation_map_cache(p4, path):
+    """Returns the cached translation map state, or None if there isn't
+    one or if the client has changed since it was cached.
+    """
+    try:
+        with open(path, 'rb') as f:
+            state = cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+        return None
+    if state.get('version') != TRANSLATION_MAP_CACHE_VERSION:
+        return None
+    if (state['Update'], state['Root']) != client_update_info(p4):
+        return None
+    return state
 
 
 def translate_local_to_depot(path):
@@ -113,25 +245,87 @@ def translate_local_to_depot(path):
 def translate_depot_to_local(path):
     return get_translation_map('depot', 'local').translate(path)
 
+def translate_depot_paths_to_local(paths):
+    """Translates a list of depot paths to local paths, returning a
+    list with None for each path that isn't mapped by the client.
+
+    If every line in the client's view maps a whole directory (i.e.,
+    there are no wildcards except for a trailing '...'), then all the
+    files in a directory map the same way, and we only have to ask the
+    map about one file per directory.
+    """
+    map = get_translation_map('depot', 'local')
+    translate = map.translate
+    if not maps_whole_directories(map):
+        return [translate(path) for path in paths]
+
+    local_directories = {}
+    local_paths = []
+    for path in paths:
+        directory, _, name = path.rpartition('/')
+        try:
+            local_directory = local_directories[directory]
+        except KeyError:
+            local_path = translate(path)
+            if local_path is None or not local_path.endswith(name):
+                local_directory = None
+            else:
+                local_directory = local_path[:len(local_path) - len(name)]
+            local_directories[directory] = local_directory
+            local_paths.append(local_path)
+            continue
+        if local_directory is None:
+            local_paths.append(translate(path))
+        else:
+            local_paths.append(local_directory + name)
+    return local_paths
+
+def maps_whole_directories(map):
+    "Checks whether every line of a P4.Map maps a whole directory."
+    for line in map.as_array():
+        line = line.lstrip('-+')
+        if line.startswith('"'):
+            lhs = line[1:line.index('"', 1)]
+        else:
+            lhs = line.split(' ', 1)[0]
+        if not lhs.endswith('/...'):
+            return False
+        lhs = lhs[:-len('/...')]
+        if '...' in lhs or '*' in lhs or '%%' in lhs:
+            return False
+    return True
+
+def get_client_spec(p4=None):
+    "Returns the client spec (as from 'p4 client -o') of the current client."
+    ensure_translation_map(p4)
+    return g_client_spec
+
 
 # --------------------
 # .r4ignore and processing ignores.
+#
+# The syntax of .r4ignore files is like that of .gitignore files.
+# Each line is a glob pattern.  Patterns in a directory's .r4ignore
+# apply to that directory and everything under it, and patterns in
+# ~/.r4ignore apply everywhere.  Later patterns override earlier
+# ones, and patterns in deeper directories override those in their
+# parents.
+#
+#   *.o         Ignores anything named *.o, in any subdirectory.
+#   /TAGS       A leading slash, or a slash anywhere but at the end,
+#   doc/*.html  anchors a pattern to the .r4ignore's directory.
+#   build/      A trailing slash only matches directories.
+#   **/tmp      '**' matches any number of directories.
+#   !keep.o     A leading '!' un-ignores anything matching the
+#               pattern.
+#
+# All the patterns that apply in a directory are compiled into a
+# handful of regexes (one per run of ignore or un-ignore patterns),
+# and compiled rules are cached by directory and ignore file mtime.
 # --------------------
 
 IGNORE_FILE = '.r4ignore'
 
-g_home_ignore_patterns = None
-
-def ignore_patterns_for(path):
-    # Cache the contents of ~/.r4ignore.
-    global g_home_ignore_patterns
-    if g_home_ignore_patterns is None:
-        g_home_ignore_patterns = try_load_ignore_patterns(os.path.join(os.path.expanduser('~'), IGNORE_FILE))
-        
-    patterns = g_home_ignore_patterns
-    patterns += try_load_ignore_patterns(os.path.join(path, IGNORE_FILE))
-    return patterns
-
 def try_load_ignore_patterns(path):
     patterns = []
     if os.path.exists(path):
@@ -139,242 +333,4016 @@ def try_load_ignore_patterns(path):
             with open(path, 'r') as f:
                 patterns = f.readlines()
                 # Strip the trailing newline from each line.
-                patterns = [p[:-1] for p in patterns]
+                patterns = [p.rstrip('\r\n') for p in patterns]
                 patterns = [p for p in patterns if len(p) > 0 and p[0] != '#']
         except IOError:
             # Ignore errors.
             pass
     return patterns
-        
 
-def is_ignored(ignore_patterns, filename):
-    "Checks whether a filename matches any ignore pattern."
-    for pattern in ignore_patterns:
-        if fnmatch.fnmatch(filename, pattern):
-            return True
-    return False
+
+def translate_ignore_pattern(pattern):
+    """Translates an ignore pattern into a regex.  Unlike fnmatch,
+    '*' and '?' don't match slashes, and '**' matches any number of
+    directories.
+    """
+    i, n = 0, len(pattern)
+    regex = []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if i < n and pattern[i] == '*':
+                i += 1
+                if i < n and pattern[i] == '/':
+                    i += 1
+                    regex.append('(?:.*/)?')
+                else:
+                    regex.append('.*')
+            else:
+                regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                regex.append('\\[')
+            else:
+                chars = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if chars[0] == '!':
+                    chars = '^/' + chars[1:]
+                elif chars[0] == '^':
+                    chars = '\\' + chars
+                regex.append('[%s]' % (chars,))
+        elif c == '\\' and i < n:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+        else:
+            regex.append(re.escape(c))
+    return ''.join(regex)
+
+def parse_ignore_pattern(pattern, directory):
+    """Parses a line from the .r4ignore file in directory (or from
+    ~/.r4ignore, if directory is None).  Returns a tuple (regex,
+    negated, directories_only), where regex matches the absolute paths
+    the pattern applies to.
+    """
+    negated = pattern.startswith('!')
+    if negated:
+        pattern = pattern[1:]
+    directories_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if '/' in pattern and directory is not None:
+        # Anchored to the directory the pattern came from.
+        regex = re.escape(directory.rstrip('/')) + '/' + translate_ignore_pattern(pattern.lstrip('/'))
+    else:
+        # Matches in any directory.
+        regex = '.*/' + translate_ignore_pattern(pattern.lstrip('/'))
+    return (regex, negated, directories_only)
+
+
+class IgnoreRules:
+    """The compiled ignore rules that apply in one directory."""
+    def __init__(self, directory, rules):
+        self.rules = rules
+        self.prefix = os.path.join(directory, '')
+        self.file_regexes = self.compile([r for r in rules if not r[2]])
+        self.directory_regexes = self.compile(rules)
+
+    def compile(self, rules):
+        """Groups consecutive rules that are all negated or all not
+        negated, and compiles each group into a single regex.  Returns
+        a list of (regex, ignored) pairs, last group first, since the
+        last matching rule wins.
+        """
+        groups = []
+        for regex, negated, directories_only in rules:
+            if groups and groups[-1][1] == (not negated):
+                groups[-1][0].append(regex)
+            else:
+                groups.append(([regex], not negated))
+        return [(re.compile('(?:%s)$' % ('|'.join(regexes),)), ignored)
+                for regexes, ignored in reversed(groups)]
+
+    def is_ignored(self, name, is_directory=False):
+        "Checks whether a file or directory in our directory is ignored."
+        if is_directory:
+            regexes = self.directory_regexes
+        else:
+            regexes = self.file_regexes
+        if regexes:
+            path = self.prefix + name
+            for regex, ignored in regexes:
+                if regex.match(path):
+                    return ignored
+        return False
+
+
+# Maps each directory we've seen to a tuple (ignore file stat info,
+# parent directory's IgnoreRules, IgnoreRules).
+g_ignore_rules_cache = {}
+
+def cached_ignore_rules(directory, parent_rules):
+    """Returns the IgnoreRules for a directory given the rules for its
+    parent (or for ~/.r4ignore, if directory is None), recompiling
+    them only if the ignore file or the parent's rules have changed.
+    """
+    home_path = os.path.join(os.path.expanduser('~'), IGNORE_FILE)
+    if directory is None:
+        path = home_path
+    else:
+        path = os.path.join(directory, IGNORE_FILE)
+    stat_info = stat_key(path)
+    cached = g_ignore_rules_cache.get(directory)
+    if cached and cached[0] == stat_info and cached[1] is parent_rules:
+        return cached[2]
+
+    rules = []
+    if parent_rules:
+        rules += parent_rules.rules
+    # (~/.r4ignore's patterns already apply everywhere.)
+    if stat_info and (directory is None or path != home_path):
+        rules += [parse_ignore_pattern(p, directory) for p in try_load_ignore_patterns(path)]
+    ignore_rules = IgnoreRules(directory or '/', rules)
+    g_ignore_rules_cache[directory] = (stat_info, parent_rules, ignore_rules)
+    return ignore_rules
+
+
+class IgnoreWalker:
+    """Finds the IgnoreRules that apply in each directory during a
+    walk of a directory tree.  Each directory's ignore file is checked
+    only once per IgnoreWalker.
+    """
+    def __init__(self):
+        self.rules = {}
+
+    def rules_for(self, directory):
+        directory = os.path.abspath(directory)
+        rules = self.rules.get(directory)
+        if rules is None:
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                parent_rules = cached_ignore_rules(None, None)
+            else:
+                parent_rules = self.rules_for(parent)
+            rules = self.rules[directory] = cached_ignore_rules(directory, parent_rules)
+        return rules
 
 
 # --------------------
-# Process commands
+# Have lists.  'p4 have' returns a dict of four strings for each file,
+# so on a client with hundreds of thousands of files a list of its
+# records, or even a set of the files' paths, takes hundreds of
+# megabytes.  Instead we stream the records through an output handler
+# into a HaveList, which groups the files by directory so that each
+# one costs little more than its name and revision, and which is
+# looked up a directory at a time, the way status walks the tree.
 # --------------------
 
-def handle_command(command, args, p4=None):
-    # If we have a custom implementation, use it, otherwise fall back
-    # to regular p4.
-    handler = get_r4_command(command)
-    if handler:
-        return handler.run_command(command, args, p4=p4)
+class HaveList:
+    """The files on a have list and their have revisions, keyed by
+    local directory.  The names of the files in a directory are kept
+    sorted in one string, separated by '/'s (which can't be in a
+    name), and their revisions in an array.
+
+    Files are added a directory at a time, as 'p4 have' mostly returns
+    them.  Files added to a directory that was added to before are set
+    aside, and merged into it the first time the list is looked at.
+    """
+    def __init__(self):
+        import array
+        self.array = array.array
+        # Maps each directory to its (names, revisions).
+        self.directories = {}
+        # The (name, revision) of the files added to pending_directory
+        # that haven't been stored in directories yet.
+        self.pending_directory = None
+        self.pending = []
+        # The (name, revision) of files added to directories that were
+        # already in directories, by directory.
+        self.unmerged = {}
+        # The files of the directory looked up last, as returned by
+        # directory_files.
+        self.lookup_directory = None
+        self.lookup_files = {}
+
+    @classmethod
+    def fetch(cls, p4, specs):
+        "Returns the have list of the files in a list of file specifications."
+        have_list = cls()
+        run_streaming(p4, have_list.add_record, 'have', *specs)
+        have_list.flush()
+        return have_list
+
+    def add(self, path, rev):
+        directory, slash, name = path.rpartition('/')
+        if directory != self.pending_directory:
+            self.store_pending()
+            self.pending_directory = directory
+        self.pending.append((name, rev))
+
+    def add_record(self, info):
+        "Adds a tagged record from 'p4 have'."
+        self.add(info['path'], int(info['haveRev']))
+
+    def store_pending(self):
+        """Stores the pending files as their directory's, or sets them
+        aside if it already has some.
+        """
+        if self.pending:
+            if self.pending_directory in self.directories:
+                self.unmerged.setdefault(self.pending_directory, []).extend(self.pending)
+            else:
+                self.store(self.pending_directory, dict(self.pending))
+            self.pending = []
+
+    def flush(self):
+        "Adds the pending and set aside files to their directories."
+        self.store_pending()
+        if self.unmerged:
+            for directory, added in self.unmerged.iteritems():
+                files = self.directory_files(directory)
+                files.update(added)
+                self.store(directory, files)
+            self.unmerged = {}
+        self.lookup_directory = None
+
+    def store(self, directory, files):
+        "Stores a dict mapping names to revisions as a directory's files."
+        names = sorted(files)
+        self.directories[directory] = ('/'.join(names), self.array('i', [files[n] for n in names]))
+
+    def directory_files(self, directory):
+        """Returns a dict mapping the names of the files in a directory
+        that are on the have list to their revisions.
+        """
+        if directory not in self.directories:
+            return {}
+        names, revisions = self.directories[directory]
+        return dict(itertools.izip(names.split('/'), revisions))
+
+    def revision(self, path):
+        "Returns the have revision of a file, or None if it's not on the have list."
+        directory, slash, name = path.rpartition('/')
+        if self.pending or self.unmerged:
+            self.flush()
+        if directory != self.lookup_directory:
+            self.lookup_files = self.directory_files(directory)
+            self.lookup_directory = directory
+        return self.lookup_files.get(name)
+
+    def __contains__(self, path):
+        return self.revision(path) is not None
+
+    def __len__(self):
+        self.flush()
+        return sum([len(revisions) for names, revisions in self.directories.itervalues()])
+
+    def files(self):
+        "Yields the (path, revision) of each file, a directory at a time."
+        self.flush()
+        for directory in sorted(self.directories):
+            names, revisions = self.directories[directory]
+            for name, rev in itertools.izip(names.split('/'), revisions):
+                yield directory + '/' + name, rev
+
+
+# --------------------
+# Workspace caches.  These live in a .r4 directory at the root of the
+# client workspace.
+# --------------------
+
+def workspace_root(p4=None):
+    "Returns the absolute path of the root of the client workspace."
+    return os.path.abspath(get_client_spec(p4)['Root'])
+
+def workspace_cache_dir(p4=None):
+    "Returns the absolute path of the workspace's .r4 directory."
+    return os.path.join(workspace_root(p4), R4_DIR)
+
+def workspace_cache_path(name, p4=None):
+    """Returns the path of the named cache file in the workspace's
+    .r4 directory, creating the directory if necessary.
+    """
+    cache_dir = workspace_cache_dir(p4)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, name)
+
+def escape_p4_path(path):
+    "Escapes the characters that have special meaning in p4 file specs."
+    return path.replace('%', '%25').replace('@', '%40').replace('#', '%23').replace('*', '%2A')
+
+# The maximum number of file arguments we pass to a single p4 command.
+MAX_P4_ARGS = 1000
+
+def run_on_files(p4, command, paths, revision=''):
+    """Runs a p4 command (a list like ['diff', '-sa']) on a list of
+    local paths, splitting it into several commands if there are a lot
+    of paths.  revision, if given, is appended to each path.  Returns
+    the concatenated results.
+    """
+    results = []
+    paths = [escape_p4_path(p) + revision for p in paths]
+    for start in range(0, len(paths), MAX_P4_ARGS):
+        results += p4.run(*(command + paths[start:start + MAX_P4_ARGS]))
+    return results
+
+def latest_change(p4):
+    "Returns the number of the most recently submitted changelist."
+    changes = p4.run('changes', '-m1', '-s', 'submitted')
+    if changes:
+        return int(changes[0]['change'])
     else:
-        run_standard_p4_command(command, args)
+        return 0
 
-def run_standard_p4_command(command, args):
-    """Runs a standard p4 command.  Uses exec, so this will be the
-    last function you ever call.  Used to transfer control to stock p4
-    for non-custom commands.
+def stat_key(path):
+    """Returns the stat info we use to decide whether a file has
+    changed, or None if the file doesn't exist.
     """
-    if command:
-        args = [command] + args
-    os.execvp('p4', ['p4'] + args)
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino, st.st_ctime)
 
-class MissingOrWrongArguments(Exception):
-    pass
+
+class StatCache:
+    """A cache of the workspace's have list and of whether its opened
+    files were modified.  The have list of the files a command looks
+    at is fetched from the server into a HaveList every time the cache
+    is used: nothing the server tells us short of that says whether
+    the have list has changed, since syncs that don't touch files on
+    disk ('sync -k', 'flush') don't submit anything or change the
+    client spec.
+
+    What's kept on disk, keyed by local path, is an entry for each
+    opened file we've checked for modifications, which records the
+    stat info of the file the last time we looked at it along with its
+    have revision, the depot digest of that revision (if we know it)
+    and whether the file was modified.  As long as a file's stat info
+    and have revision haven't changed we can trust whether it was
+    modified without looking at it again.
+    """
+    VERSION = 1
+    FILENAME = 'statcache'
+
+    # Indices into an entry.
+    STAT, REV, DIGEST, MODIFIED = range(4)
+
+    # In a process that runs more than one command, like the daemon,
+    # the cache last loaded or saved for each path and the stat info
+    # of its file then, so we only read the file again if another
+    # process has written it.
+    in_memory = {}
+
+    def __init__(self, path, client_spec):
+        self.path = path
+        self.client_spec = client_spec
+        self.entries = {}
+        # The have list, once the cache has been refreshed.
+        self.have_list = None
+        # The start time of the run that last saved the cache.
+        self.saved = None
+        self.start = time.time()
+        self.dirty = False
+
+    def spec_key(self):
+        "Returns the parts of the client spec that the cache depends on."
+        spec = self.client_spec
+        return (spec['Client'], spec['Root'], spec.get('Update'), spec.get('Options'),
+                spec.get('LineEnd'), tuple(spec['View']))
+
+    @classmethod
+    def load(cls, p4):
+        """Loads the workspace's stat cache, or returns an empty one if
+        there isn't one or if it was built for a different client spec.
+        """
+        cache = cls(workspace_cache_path(cls.FILENAME, p4), get_client_spec(p4))
+        st = stat_key(cache.path)
+        if cache.path in cls.in_memory:
+            in_memory_st, in_memory_cache = cls.in_memory[cache.path]
+            if in_memory_st == st and in_memory_cache.spec_key() == cache.spec_key():
+                in_memory_cache.start = time.time()
+                in_memory_cache.have_list = None
+                return in_memory_cache
+        try:
+            with open(cache.path, 'rb') as f:
+                state = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+            return cache
+        if state.get('version') == cls.VERSION and state.get('spec') == cache.spec_key():
+            cache.entries = state['entries']
+            cache.saved = state['saved']
+            cls.in_memory[cache.path] = (st, cache)
+        return cache
+
+    def save(self):
+        if not self.dirty:
+            return
+        state = {'version': self.VERSION,
+                 'spec': self.spec_key(),
+                 'entries': self.entries,
+                 'saved': self.start}
+        try:
+            write_file_atomically(self.path, cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError), e:
+            sys.stderr.write('r4: could not save %s: %s\n' % (self.path, e))
+        else:
+            self.in_memory[self.path] = (stat_key(self.path), self)
+        self.dirty = False
+
+    def refresh(self, p4, specs):
+        """Fetches the have list of the files in a list of file
+        specifications, and forgets what we knew about the ones that
+        have been synced to other revisions since.
+        """
+        self.have_list = HaveList.fetch(p4, specs)
+        # A directory at a time.
+        for path in sorted(self.entries, key=lambda path: path.rpartition('/')[0]):
+            entry = self.entries[path]
+            rev = self.have_list.revision(path)
+            if rev is not None and entry[self.REV] != rev:
+                entry[self.REV] = rev
+                entry[self.DIGEST] = entry[self.MODIFIED] = None
+                self.dirty = True
+
+    def rebuild(self, p4, specs):
+        "Throws away the cache and fetches the have list of specs."
+        self.entries = {}
+        self.dirty = True
+        self.refresh(p4, specs)
+
+    def check(self, p4, jobs=None):
+        """Compares the files on the have list fetched by refresh whose
+        entries we would trust to say whether they're modified against
+        their have revisions.  Returns a list of descriptions of the
+        entries that are wrong.
+        """
+        def describe_modified(modified):
+            if modified:
+                return 'modified'
+            return 'unmodified'
+
+        trusted = []
+        for path, entry in self.entries.iteritems():
+            if entry[self.MODIFIED] is not None and path in self.have_list:
+                st = stat_key(path)
+                if st is not None and self.is_fresh(entry, st):
+                    trusted.append(path)
+        modified = find_modified_files(p4, trusted, jobs=jobs)
+        problems = []
+        for path in sorted(trusted):
+            if self.entries[path][self.MODIFIED] != (path in modified):
+                problems.append('%s: cache says %s, file is %s' % (
+                    path, describe_modified(self.entries[path][self.MODIFIED]),
+                    describe_modified(path in modified)))
+        return problems
+
+    def is_fresh(self, entry, st):
+        # Files changed just before the cache was saved might have
+        # been changed again without their stat info changing, so we
+        # don't trust those.
+        return entry[self.STAT] == st and self.saved is not None and st[3] < self.saved - 1
+
+    def modified_paths(self, p4, paths, jobs=None, trusted=None):
+        """Given a list of opened files (absolute local paths), returns
+        the set of those that have been modified, checking only files
+        whose stat info has changed.  trusted, if given, is a function
+        that says whether we can trust a path's entry without looking
+        at the file at all.
+        """
+        modified = set()
+        stale = []
+        for path in paths:
+            entry = self.entries.get(path)
+            if trusted and entry is not None and entry[self.MODIFIED] is not None and trusted(path):
+                if entry[self.MODIFIED]:
+                    modified.add(path)
+                continue
+            st = stat_key(path)
+            if st is None:
+                continue
+            if entry is not None and entry[self.MODIFIED] is not None and self.is_fresh(entry, st):
+                if entry[self.MODIFIED]:
+                    modified.add(path)
+            else:
+                stale.append((path, st))
+        if stale:
+            digests = {}
+            for path, st in stale:
+                entry = self.entries.get(path)
+                if entry is not None and entry[self.DIGEST] is not None:
+                    digests[path] = entry[self.DIGEST]
+            stale_modified = find_modified_files(p4, [path for path, st in stale], digests, jobs=jobs)
+            for path, st in stale:
+                entry = self.entries.get(path)
+                if entry is None:
+                    entry = self.entries[path] = [st, self.have_list.revision(path), None, None]
+                entry[self.STAT] = st
+                entry[self.DIGEST] = digests.get(path)
+                entry[self.MODIFIED] = path in stale_modified
+            modified |= stale_modified
+            self.dirty = True
+        return modified
 
 
 # --------------------
-# Custom commands
+# Finding modified files locally.  Instead of having the server diff
+# opened files one at a time ('p4 diff -sa'), we fetch the digests of
+# the have revisions in bulk and compare them to MD5s of the local
+# files, which we compute in parallel.
 # --------------------
 
-# Base class for all custom commands.
-class R4Command:
-    def __init__(self):
-        pass
-    def short_description(self):
-        raise NotImplementedError
-    def long_description(self):
-        raise NotImplementedError
-    def usage(self):
-        raise NotImplementedError
-    def run(self, p4, command, args):
-        raise NotImplementedError
+# Filetypes whose local contents are byte-for-byte what the server
+# digests.  Text files only qualify if the client uses LF line
+# endings.
+TEXT_FILETYPES = ['text', 'xtext', 'ctext', 'cxtext', 'ltext', 'xltext']
+BINARY_FILETYPES = ['binary', 'xbinary', 'ubinary', 'uxbinary', 'tempobj', 'ctempobj', 'xtempobj']
+
+# Files bigger than this get mmapped instead of read.
+MMAP_THRESHOLD = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+# Don't bother starting worker processes for fewer files than this.
+MIN_FILES_FOR_POOL = 16
+
+
+def is_locally_digestible(filetype, line_end):
+    """Checks whether we can compute the server's digest of a file of
+    the given type (e.g. 'text+x') locally.  Keyword-expanded and
+    unicode files are stored differently on the server than in the
+    workspace, so for those we need the server to do the diff.
+    """
+    base_type, _, modifiers = filetype.partition('+')
+    if 'k' in modifiers:
+        return False
+    if base_type in BINARY_FILETYPES:
+        return True
+    if base_type in TEXT_FILETYPES:
+        return line_end == 'unix' or (line_end in (None, 'local') and os.linesep == '\n')
+    return False
+
+def md5_file(path):
+    """Returns the MD5 digest of a file, in the uppercase hex format p4
+    uses, or None if the file can't be read.
+    """
+    digest = hashlib.md5()
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= MMAP_THRESHOLD:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    digest.update(m)
+                finally:
+                    m.close()
+            else:
+                while True:
+                    data = f.read(READ_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest().upper()
+
+def md5_files(paths, jobs=None):
+    "Returns a dictionary mapping each path to its MD5 digest."
+    if jobs is None:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    if jobs <= 1 or len(paths) < MIN_FILES_FOR_POOL:
+        return dict((path, md5_file(path)) for path in paths)
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        chunksize = max(1, len(paths) / (jobs * 4))
+        return dict(zip(paths, pool.map(md5_file, paths, chunksize)))
+    finally:
+        pool.terminate()
+
+# The fstat command that gets us what we need to know about digests.
+DIGEST_FSTAT_COMMAND = ['fstat', '-Ol', '-T', 'clientFile,headType,digest,fileSize']
+
+def record_depot_digests(fstat_info, digests, line_end):
+    """Given the output of DIGEST_FSTAT_COMMAND, fills in digests with
+    the digest and size of each file whose digest we can compute
+    locally.
+    """
+    for i in fstat_info:
+        if 'digest' in i and is_locally_digestible(i['headType'], line_end):
+            digests[i['clientFile']] = (i['digest'], int(i['fileSize']))
+
+def fetch_depot_digests(p4, paths, digests):
+    """Fills in digests with the digest and size of the have revision
+    of each path, or False for files whose digest we can't compute
+    locally.
+    """
+    for path in paths:
+        digests[path] = False
+    fstat_info = run_on_files(p4, DIGEST_FSTAT_COMMAND, paths, revision='#have')
+    record_depot_digests(fstat_info, digests, get_client_spec(p4).get('LineEnd'))
+
+def find_modified_files(p4, paths, digests=None, jobs=None):
+    """Given a list of files opened for edit (absolute local paths),
+    returns the set of those whose contents differ from their have
+    revisions.  digests is a dictionary of the depot digests we
+    already know, as filled in by fetch_depot_digests; any we have to
+    fetch are added to it.
+    """
+    if digests is None:
+        digests = {}
+    fetch_depot_digests(p4, [path for path in paths if path not in digests], digests)
+
+    modified = set()
+    to_hash = []
+    server_paths = []
+    for path in paths:
+        if not digests[path]:
+            server_paths.append(path)
+            continue
+        digest, size = digests[path]
+        try:
+            if os.path.getsize(path) != size:
+                modified.add(path)
+            else:
+                to_hash.append(path)
+        except OSError:
+            # Deleted locally, which 'p4 diff -sa' doesn't count.
+            pass
+    for path, digest in md5_files(to_hash, jobs).items():
+        if digest is not None and digest != digests[path][0]:
+            modified.add(path)
+
+    if server_paths:
+        diff_info = run_on_files(p4, ['diff', '-sa'], server_paths)
+        modified.update([i['clientFile'] for i in diff_info if isinstance(i, dict)])
+    return modified
+
+
+# --------------------
+# Running p4 commands concurrently.
+# --------------------
+
+# The number of connections we use to run independent queries at the
+# same time.
+DEFAULT_POOL_SIZE = 4
+
+class P4ConnectionPool:
+    """A pool of P4 connections for running independent commands at
+    the same time.  A P4 object can only run one command at a time, so
+    each thread takes its own connection from the pool.  The
+    connection the pool is created with is its first member; the rest
+    are opened with get_p4_connection as they're needed.
+    """
+    def __init__(self, p4, size=DEFAULT_POOL_SIZE):
+        import threading
+        self.idle = [p4]
+        self.opened = []
+        self.lock = threading.Lock()
+        self.available = threading.Semaphore(size)
+
+    def acquire(self):
+        self.available.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        try:
+            p4 = get_p4_connection()
+        except:
+            self.available.release()
+            raise
+        with self.lock:
+            self.opened.append(p4)
+        return p4
+
+    def release(self, p4):
+        with self.lock:
+            self.idle.append(p4)
+        self.available.release()
+
+    def call(self, function):
+        "Calls function with a connection from the pool."
+        p4 = self.acquire()
+        try:
+            return function(p4)
+        finally:
+            self.release(p4)
+
+    def run_concurrently(self, *functions):
+        """Calls each function with its own connection from the pool,
+        all at the same time, and returns a list of their results.  If
+        any of them raise an exception, the first one is re-raised
+        once they've all finished.
+        """
+        import threading
+        results = [None] * len(functions)
+        errors = []
+        def run(i, function):
+            try:
+                results[i] = self.call(function)
+            except:
+                errors.append(sys.exc_info())
+        threads = [threading.Thread(target=run, args=(i, f)) for i, f in enumerate(functions)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            # Joining with a timeout lets KeyboardInterrupt through.
+            while thread.isAlive():
+                thread.join(0.1)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    def close(self):
+        "Disconnects the connections the pool opened."
+        for p4 in self.opened:
+            try:
+                p4.disconnect()
+            except Exception:
+                pass
+        self.opened = []
+
+
+def imap_ordered(pool, function, items, jobs, window=None):
+    """Calls function(p4, item) for each item, running up to jobs
+    calls at a time on connections from pool, and yields the results
+    in the same order as items.  At most window results (by default
+    four per job) are kept waiting to be yielded.
+    """
+    import threading
+    import Queue
+    if window is None:
+        window = jobs * 4
+    items = list(items)
+    free_slots = threading.Semaphore(window)
+    todo = Queue.Queue()
+    done = {}
+    done_changed = threading.Condition()
+    stopped = []
+
+    def feed():
+        for i, item in enumerate(items):
+            free_slots.acquire()
+            if stopped:
+                break
+            todo.put((i, item))
+        for j in range(jobs):
+            todo.put(None)
+
+    def work():
+        while True:
+            job = todo.get()
+            if job is None or stopped:
+                return
+            i, item = job
+            try:
+                result = (True, pool.call(lambda p4: function(p4, item)))
+            except:
+                result = (False, sys.exc_info())
+            with done_changed:
+                done[i] = result
+                done_changed.notify()
+
+    threads = [threading.Thread(target=feed)] + [threading.Thread(target=work) for j in range(jobs)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        for i in range(len(items)):
+            with done_changed:
+                while i not in done:
+                    # Waiting with a timeout lets KeyboardInterrupt
+                    # through.
+                    done_changed.wait(0.1)
+                succeeded, result = done.pop(i)
+            free_slots.release()
+            if not succeeded:
+                raise result[0], result[1], result[2]
+            yield result
+    finally:
+        stopped.append(True)
+        free_slots.release()
+
+
+# --------------------
+# Streaming command output.  P4Python normally collects all of a
+# command's output into a list before returning it; with an output
+# handler we can process each record as the server sends it.
+# --------------------
+
+def make_output_handler(callback):
+    """Returns a P4.OutputHandler that passes each tagged record to
+    callback and then discards it.
+    """
+    class StreamingOutputHandler(P4.OutputHandler):
+        def outputStat(self, stat):
+            if g_tracer:
+                trace_count(1, record_size(stat))
+            callback(stat)
+            return P4.OutputHandler.HANDLED
+
+    return StreamingOutputHandler()
+
+def run_streaming(p4, callback, *args):
+    """Runs a p4 command, calling callback with each tagged record of
+    its output as it arrives.  Returns any output that isn't a tagged
+    record.
+    """
+    old_handler = p4.handler
+    p4.handler = make_output_handler(callback)
+    try:
+        return p4.run(*args)
+    finally:
+        p4.handler = old_handler
+
+
+# --------------------
+# Output.  status and grep write their results through a formatter,
+# which writes them as lines of text, as text with a NUL after each
+# path (-z) so that any path can be told apart from what follows it,
+# or as JSON objects, one per line (--json).  The formatter writes to
+# a BufferedOutput, so that long listings are written in a few big
+# chunks instead of a line at a time.
+# --------------------
+
+OUTPUT_BUFFER_SIZE = 64 * 1024
+
+class BufferedOutput:
+    """Collects what's written to a stream and writes it in large
+    chunks.  Output to a terminal is written right away, so that
+    people see results as they're found.
+    """
+    def __init__(self, stream, size=OUTPUT_BUFFER_SIZE):
+        self.stream = stream
+        self.size = size
+        try:
+            if stream.isatty():
+                self.size = 0
+        except AttributeError:
+            pass
+        self.chunks = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            data = ''.join(self.chunks)
+            self.chunks = []
+            self.buffered = 0
+            self.stream.write(data)
+        self.stream.flush()
+
+class TextFormatter:
+    "Writes results as lines of text."
+    def __init__(self, stream):
+        self.stream = stream
+
+    def status(self, status, path):
+        self.stream.write('%s %s\n' % (status, path))
+
+    def matching_line(self, path, lower, upper, line, sign=''):
+        """Writes a line that matched in revisions lower through upper of
+        a file.  sign is '+' or '-' for lines a revision added or
+        removed.
+        """
+        if not line.endswith('\n'):
+            line += '\n'
+        self.stream.write('%s%s: %s%s' % (path, canonicalize_revision_range(lower, upper), sign, line))
+
+    def matching_file(self, path, lower, upper, binary=False):
+        "Writes a range of revisions of a file that has matches."
+        if binary:
+            self.stream.write('Binary file %s%s matches\n' % (path, canonicalize_revision_range(lower, upper)))
+        else:
+            self.stream.write('%s%s\n' % (path, canonicalize_revision_range(lower, upper)))
+
+class NulFormatter(TextFormatter):
+    """Writes results as text with a NUL after each path instead of
+    the ': ' or newline that would follow it, like git's -z.
+    """
+    def status(self, status, path):
+        self.stream.write('%s %s\0' % (status, path))
+
+    def matching_line(self, path, lower, upper, line, sign=''):
+        if not line.endswith('\n'):
+            line += '\n'
+        self.stream.write('%s%s\0%s%s' % (path, canonicalize_revision_range(lower, upper), sign, line))
+
+    def matching_file(self, path, lower, upper, binary=False):
+        if binary:
+            self.stream.write('Binary file %s%s matches\0' % (path, canonicalize_revision_range(lower, upper)))
+        else:
+            self.stream.write('%s%s\0' % (path, canonicalize_revision_range(lower, upper)))
+
+class JsonFormatter:
+    """Writes each result as a JSON object on a line of its own.  Text
+    that isn't UTF-8 is taken to be Latin-1.
+    """
+    def __init__(self, stream):
+        from json.encoder import encode_basestring_ascii
+        self.stream = stream
+        self.encode_string = encode_basestring_ascii
+
+    def string(self, text):
+        try:
+            return self.encode_string(text)
+        except UnicodeDecodeError:
+            return self.encode_string(text.decode('latin-1'))
+
+    def status(self, status, path):
+        self.stream.write('{"status": "%s", "path": %s}\n' % (status, self.string(path)))
+
+    def matching_line(self, path, lower, upper, line, sign=''):
+        if line.endswith('\n'):
+            line = line[:-1]
+        if sign:
+            sign = ', "sign": "%s"' % (sign,)
+        self.stream.write('{"path": %s, "lower": %d, "upper": %d, "line": %s%s}\n'
+                          % (self.string(path), int(lower), int(upper), self.string(line), sign))
+
+    def matching_file(self, path, lower, upper, binary=False):
+        if binary:
+            binary = ', "binary": true'
+        else:
+            binary = ''
+        self.stream.write('{"path": %s, "lower": %d, "upper": %d%s}\n'
+                          % (self.string(path), int(lower), int(upper), binary))
+
+# The formatters for each output format.
+OUTPUT_FORMATTERS = {'text': TextFormatter, 'nul': NulFormatter, 'json': JsonFormatter}
+
+
+# --------------------
+# Revision cache.  Once submitted, a revision never changes, and
+# neither does the output of a command like 'annotate' over a range
+# of revisions given by number.  We keep that output in ~/.r4 so
+# searching history a second time doesn't go to the server.
+#
+# Entries are named by a hash of the server, the kind of data and a
+# key like '//depot/foo.c#1,7', and hold gzipped batches of pickled
+# records.  They're written to a temporary file and renamed into
+# place, so concurrent r4 processes never see partial entries.  The
+# least recently used entries are deleted when the cache grows past
+# its size limit.
+#
+# Blame entries are the exception: they're keyed by depot path alone,
+# and replaced as the file gets new revisions.
+# --------------------
+
+REVISION_CACHE_DIR = 'revisions'
+
+# The size limit, which can be overridden with $R4_REVISION_CACHE_SIZE
+# (in megabytes).
+DEFAULT_REVISION_CACHE_SIZE = 1024 * 1024 * 1024
+
+# When the cache is over its limit, evict down to this fraction of it.
+REVISION_CACHE_LOW_WATER = 0.8
+
+# Records are pickled this many at a time.
+REVISION_CACHE_BATCH = 512
+
+class RevisionCache:
+    def __init__(self, port, directory=None, max_size=None):
+        self.port = port
+        if directory is None:
+            directory = os.path.dirname(user_cache_path(REVISION_CACHE_DIR, 'size'))
+        self.directory = directory
+        if max_size is None:
+            max_size = DEFAULT_REVISION_CACHE_SIZE
+            if os.environ.get('R4_REVISION_CACHE_SIZE'):
+                max_size = int(os.environ['R4_REVISION_CACHE_SIZE']) * 1024 * 1024
+        self.max_size = max_size
+
+    def entry_path(self, kind, key):
+        digest = hashlib.sha1('\0'.join([self.port, kind, key])).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def records(self, kind, key):
+        """Returns an iterator over the records cached for key, or None
+        if there aren't any.
+        """
+        import gzip
+        path = self.entry_path(kind, key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        # Reading an entry makes it the most recently used.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return self.read_records(gzip.GzipFile(fileobj=f, mode='rb'), f)
+
+    def read_records(self, gzip_file, f):
+        try:
+            while True:
+                try:
+                    batch = cPickle.load(gzip_file)
+                except EOFError:
+                    break
+                for record in batch:
+                    yield record
+        finally:
+            gzip_file.close()
+            f.close()
+
+    def writer(self, kind, key):
+        "Returns a RevisionCacheWriter that creates the entry for key."
+        path = self.entry_path(kind, key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Another process may have just created it.
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        return RevisionCacheWriter(self, path)
+
+    def locked(self):
+        """Returns a file holding an exclusive lock on the cache's size
+        accounting, which is released when the file is closed.
+        """
+        import fcntl
+        f = open(os.path.join(self.directory, 'lock'), 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    def read_size(self):
+        try:
+            with open(os.path.join(self.directory, 'size')) as f:
+                return int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def write_size(self, size):
+        write_file_atomically(os.path.join(self.directory, 'size'), '%d\n' % (size,))
+
+    def install(self, temp_path, path):
+        """Renames a new entry written to temp_path into place, replacing
+        the entry at path if there is one, and accounts for the change in
+        the cache's size, evicting old entries if that puts the cache over
+        its limit.
+        """
+        size = os.path.getsize(temp_path)
+        with self.locked():
+            try:
+                replaced_size = os.path.getsize(path)
+            except OSError:
+                replaced_size = 0
+            os.rename(temp_path, path)
+            total = max(0, self.read_size() + size - replaced_size)
+            if total > self.max_size:
+                total = self.evict(int(self.max_size * REVISION_CACHE_LOW_WATER))
+            self.write_size(total)
+
+    def evict(self, target_size):
+        """Deletes the least recently used entries until the cache is no
+        larger than target_size.  Returns the resulting size.  Must be
+        called with the lock held.
+        """
+        entries = []
+        total = 0
+        for subdirectory in os.listdir(self.directory):
+            subdirectory = os.path.join(self.directory, subdirectory)
+            if not os.path.isdir(subdirectory):
+                continue
+            for name in os.listdir(subdirectory):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(subdirectory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= target_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+        return total
+
+class RevisionCacheWriter:
+    """Writes a revision cache entry one record at a time.  The entry
+    only appears in the cache once commit is called.
+    """
+    def __init__(self, cache, path):
+        import gzip
+        import tempfile
+        self.cache = cache
+        self.path = path
+        fd, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp.')
+        self.file = os.fdopen(fd, 'wb')
+        self.gzip_file = gzip.GzipFile(fileobj=self.file, mode='wb')
+        self.batch = []
+
+    def add(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= REVISION_CACHE_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            cPickle.dump(self.batch, self.gzip_file, cPickle.HIGHEST_PROTOCOL)
+            self.batch = []
+
+    def commit(self):
+        try:
+            self.flush()
+            self.gzip_file.close()
+            self.file.close()
+            self.cache.install(self.temp_path, self.path)
+        except:
+            self.abort()
+            raise
+
+    def abort(self):
+        self.gzip_file.close()
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+def get_revision_cache(p4):
+    return RevisionCache(p4.port)
+
+def run_cached(p4, cache, callback, kind, key, *args):
+    """Like run_streaming, but uses the records cached for key if there
+    are any, and caches the records otherwise.  Only use it for
+    commands whose output never changes.
+    """
+    if cache is None:
+        run_streaming(p4, callback, *args)
+        return
+    records = cache.records(kind, key)
+    if records is not None:
+        for record in records:
+            callback(record)
+        return
+    writer = cache.writer(kind, key)
+    def add_record(record):
+        writer.add(record)
+        callback(record)
+    try:
+        run_streaming(p4, add_record, *args)
+    except:
+        writer.abort()
+        raise
+    writer.commit()
+
+def run_text_cached(p4, cache, kind, key, *args):
+    """Runs a p4 command whose text output never changes and returns
+    the text, from the revision cache if possible.
+    """
+    if cache is not None:
+        records = cache.records(kind, key)
+        if records is not None:
+            return ''.join(records)
+    text = ''.join([c for c in p4.run(*args) if isinstance(c, str)])
+    if cache is not None:
+        writer = cache.writer(kind, key)
+        writer.add(text)
+        writer.commit()
+    return text
+
+def get_file_contents(p4, depot_file, rev, cache=None):
+    """Returns the contents of revision number rev of a depot file,
+    from the revision cache if possible.
+    """
+    spec = '%s#%s' % (depot_file, rev)
+    return run_text_cached(p4, cache, 'print', spec, 'print', '-q', spec)
+
+def get_revision_diff(p4, depot_file, rev, cache=None):
+    """Returns the unified diff, without context, between revision
+    number rev of a depot file and the revision before it.
+    """
+    spec = '%s#%s' % (depot_file, rev)
+    return run_text_cached(p4, cache, 'diff2 -du0', spec,
+                           'diff2', '-du0', '%s#%d' % (depot_file, int(rev) - 1), spec)
+
+def pinned_revision_range(revision, rev):
+    """Given the revision specifier or range a file was named with and
+    the revision number 'p4 files' resolved it to, returns an
+    equivalent range given by revision numbers, which will always
+    select the same revisions.  Returns None if there isn't one.
+    """
+    if revision.startswith('@='):
+        # Shelved files can be changed.
+        return None
+    if ',' not in revision:
+        # A single revision means every revision up to it.
+        return '#%s' % (rev,)
+    lower = revision.split(',', 1)[0]
+    if re.match(r'#\d+$', lower):
+        return '%s,%s' % (lower, rev)
+    return None
+
+def pinned_revision_bounds(revision, rev):
+    """Like pinned_revision_range, but returns the first and last
+    revision numbers of the range.
+    """
+    pinned_range = pinned_revision_range(revision, rev)
+    if pinned_range is None:
+        return None
+    if ',' in pinned_range:
+        return int(pinned_range[1:].split(',')[0]), int(rev)
+    return 1, int(rev)
+
+
+# --------------------
+# Matching lines against grep's patterns.  Most patterns contain some
+# literal text that every match must contain, and looking for that
+# with a substring test is much cheaper than running the regex, so we
+# only run the regex on lines that pass the test.
+# --------------------
+
+def regex_literal_query(pattern, flags=0):
+    """Returns a query for the literal strings that any text matching
+    pattern must contain.  A query is either a string, a tuple ('and',
+    [query, ...]) or ('or', [query, ...]), or None if any text might
+    match.
+    """
+    import sre_parse
+    return sequence_literal_query(sre_parse.parse(pattern, flags))
+
+def sequence_literal_query(items):
+    import sre_constants
+    queries = []
+    literal = []
+    def end_literal():
+        if literal:
+            queries.append(''.join(literal))
+        del literal[:]
+
+    for op, av in items:
+        if op == sre_constants.LITERAL and av < 256:
+            literal.append(chr(av))
+            continue
+        end_literal()
+        if op == sre_constants.SUBPATTERN:
+            queries.append(sequence_literal_query(av[-1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min_count, max_count, item = av
+            if min_count >= 1:
+                queries.append(sequence_literal_query(item))
+        elif op == sre_constants.BRANCH:
+            queries.append(make_query('or', [sequence_literal_query(branch) for branch in av[1]]))
+        # Anything else might match any text.
+    end_literal()
+    return make_query('and', queries)
+
+def make_query(operator, subqueries):
+    """Combines queries with 'and' or 'or', simplifying the result.
+    None stands for a query any text might match.
+    """
+    if operator == 'and':
+        subqueries = [q for q in subqueries if q is not None]
+        if not subqueries:
+            return None
+    elif None in subqueries:
+        return None
+    if len(subqueries) == 1:
+        return subqueries[0]
+    return (operator, subqueries)
+
+def regex_literal_text(pattern):
+    """Returns the text a regex matches if it only matches one literal
+    string, e.g. 'a\\.b' -> 'a.b', or None if it doesn't.  Regexes that
+    set flags, like '(?i)abc' or '(?x)a b', don't count.
+    """
+    import sre_parse
+    import sre_constants
+    items = sre_parse.parse(pattern)
+    if items.pattern.flags:
+        return None
+    if not all([op == sre_constants.LITERAL and av < 256 for op, av in items]):
+        return None
+    return ''.join([chr(av) for op, av in items])
+
+def literal_alternation_regex(strings):
+    """Returns a regex that matches any of strings.  The alternatives
+    are factored into a trie, e.g. 'ab', 'ac' -> 'a(?:b|c)', so the
+    regex engine tries them all in one pass over the text instead of
+    one pass per string.
+    """
+    trie = {}
+    for string in strings:
+        node = trie
+        for c in string:
+            node = node.setdefault(c, {})
+        node[''] = {}
+
+    def node_regex(node):
+        alternatives = [re.escape(c) + node_regex(child) for c, child in sorted(node.items()) if c]
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        regex = '(?:%s)' % ('|'.join(alternatives),)
+        if '' in node:
+            regex += '?'
+        return regex
+
+    return node_regex(trie)
+
+def required_literal(query):
+    """Returns the longest literal string that a literal query says
+    any match must contain, or None.
+    """
+    if isinstance(query, str):
+        return query
+    if isinstance(query, tuple) and query[0] == 'and':
+        literals = [q for q in query[1] if isinstance(q, str)]
+        if literals:
+            return max(literals, key=len)
+    return None
+
+class LineMatcher:
+    """Matches lines against any of a list of patterns, either regexes
+    or, with fixed_strings, literal strings.  Like a compiled regex,
+    has a search method that returns whether a line matches.
+
+    text_filter is a regex that finds something every matching line
+    contains, for skipping over the parts of a file that can't match,
+    or None if there's no such thing.
+    """
+    def __init__(self, patterns, fixed_strings=False, ignore_case=False):
+        flags = 0
+        if ignore_case:
+            flags |= re.IGNORECASE
+        if not fixed_strings:
+            literals = [regex_literal_text(p) for p in patterns]
+            if None not in literals:
+                patterns = literals
+                fixed_strings = True
+
+        if fixed_strings:
+            self.query = make_query('or', list(patterns))
+            regexp = re.compile(literal_alternation_regex(patterns), flags)
+            if len(patterns) == 1 and not ignore_case:
+                literal = patterns[0]
+                self.matchers = [lambda line: literal in line]
+            else:
+                self.matchers = [regexp.search]
+            self.text_filter = regexp
+        else:
+            queries = []
+            literals = []
+            literal_flags = flags
+            self.matchers = []
+            for pattern in patterns:
+                regexp = re.compile(pattern, flags)
+                query = regex_literal_query(pattern, flags)
+                literal = required_literal(query)
+                if literal and regexp.flags & re.IGNORECASE:
+                    literal = literal.lower()
+                    literal_flags |= re.IGNORECASE
+                queries.append(query)
+                literals.append(literal)
+                self.matchers.append(self.prefiltered(regexp, literal))
+            self.query = make_query('or', queries)
+            # Text that doesn't contain any pattern's literal can't
+            # have a matching line.
+            if all(literals):
+                self.text_filter = re.compile(literal_alternation_regex(literals), literal_flags)
+            else:
+                self.text_filter = None
+
+    def prefiltered(self, regexp, literal):
+        """Returns a function that only runs regexp on lines containing
+        literal.
+        """
+        if not literal:
+            return regexp.search
+        if regexp.flags & re.IGNORECASE:
+            return lambda line: literal in line.lower() and regexp.search(line)
+        return lambda line: literal in line and regexp.search(line)
+
+    def search(self, line):
+        "Checks whether a line matches."
+        for matcher in self.matchers:
+            if matcher(line):
+                return True
+        return False
+
+    def trigram_query(self):
+        "Returns a query for the trigram index."
+        return literal_trigram_query(self.query)
+
+
+# --------------------
+# Searching files in the workspace, for 'r4 grep --local'.  The files
+# are searched in a pool of processes, each of which builds its own
+# LineMatcher since those can't be pickled.
+# --------------------
+
+# How much of a file we look at to decide whether it's binary.
+BINARY_CHECK_SIZE = 8192
+
+g_local_grep = None
+
+def init_local_grep(patterns, fixed_strings, ignore_case, invert_matches,
+                    just_list_filenames, binary_files, max_size):
+    global g_local_grep
+    g_local_grep = (LineMatcher(patterns, fixed_strings, ignore_case), invert_matches,
+                    just_list_filenames, binary_files, max_size)
+
+def grep_local_file(path):
+    """Searches a file in the workspace with the settings from
+    init_local_grep.  Returns a list of the matching lines, True if
+    it's a binary file that should be reported as matching, or None if
+    there's nothing to report.
+    """
+    matcher, invert_matches, just_list_filenames, binary_files, max_size = g_local_grep
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0 or (max_size is not None and size > max_size):
+                return None
+            if size >= MMAP_THRESHOLD:
+                text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                text = f.read()
+            try:
+                binary = '\0' in text[:BINARY_CHECK_SIZE]
+                if binary and binary_files == 'without-match':
+                    return None
+                just_one = just_list_filenames or (binary and binary_files == 'binary')
+                lines = search_text(text, matcher, invert_matches, just_one)
+            finally:
+                if size >= MMAP_THRESHOLD:
+                    text.close()
+    except (IOError, OSError):
+        return None
+    if not lines:
+        return None
+    if binary and binary_files == 'binary':
+        return True
+    return lines
+
+def search_text(text, matcher, invert_matches=False, just_one=False):
+    """Returns a list of the lines of text (a string or an mmap) that
+    match, or with just_one, of the first one.
+    """
+    matches = []
+    if invert_matches or matcher.text_filter is None:
+        for line in text[:].splitlines(True):
+            if bool(matcher.search(line)) != invert_matches:
+                matches.append(line)
+                if just_one:
+                    break
+        return matches
+
+    # Only look at the lines where the filter finds something.
+    position = 0
+    while True:
+        match = matcher.text_filter.search(text, position)
+        if not match or match.start() >= len(text):
+            break
+        start = text.rfind('\n', 0, match.start()) + 1
+        end = text.find('\n', match.start())
+        if end == -1:
+            end = len(text)
+        else:
+            end += 1
+        line = text[start:end]
+        if matcher.search(line):
+            matches.append(line)
+            if just_one:
+                break
+        position = end
+    return matches
+
+def local_spec_regexes(p4, specs):
+    """Returns regexes matching the local paths of the files in a list
+    of file specifications in depot, client or local syntax.
+    """
+    regexes = []
+    for spec in specs:
+        if spec.startswith('//'):
+            paths = [w['path'] for w in p4.run_where(spec) if 'unmap' not in w]
+        else:
+            paths = [os.path.abspath(spec)]
+        regexes.extend([wildcard_regex(path) for path in paths])
+    return regexes
+
+def wildcard_regex(path):
+    "Returns a regex matching the paths a path with Perforce wildcards names."
+    parts = re.split(r'(\.\.\.|\*)', path)
+    return re.compile(''.join([{'...': '.*', '*': '[^/]*'}.get(part, re.escape(part))
+                               for part in parts]) + '$')
+
+def make_ignore_checker(root):
+    """Returns a function that checks whether a file under root is
+    ignored by the .r4ignore rules, either itself or because a
+    directory it's in is.
+    """
+    walker = IgnoreWalker()
+    ignored_directories = {}
+
+    def directory_ignored(directory):
+        if directory not in ignored_directories:
+            parent, name = os.path.split(directory)
+            ignored_directories[directory] = (
+                directory != root and parent != directory and
+                (directory_ignored(parent) or
+                 walker.rules_for(parent).is_ignored(name, is_directory=True)))
+        return ignored_directories[directory]
+
+    def is_ignored(path):
+        directory, name = os.path.split(path)
+        return directory_ignored(directory) or walker.rules_for(directory).is_ignored(name)
+
+    return is_ignored
+
+
+# --------------------
+# Trigram index of file revisions, for 'r4 index' and 'r4 grep
+# --indexed'.  For each revision we record which three character
+# substrings (trigrams) its lowercased contents contain.  Any line a
+# regex matches contains the literal strings the regex requires, so
+# only revisions containing all of their trigrams can have a match.
+#
+# The index is a SQLite database in ~/.r4/index, one per server.
+# Each trigram has a posting list of the ids of the revisions that
+# contain it.
+# --------------------
+
+INDEX_DIR = 'index'
+
+# The file types whose contents we index.  annotate only works on
+# text, so grep never needs the others.
+INDEXED_FILETYPES = TEXT_FILETYPES + ['ktext', 'kxtext', 'unicode', 'xunicode',
+                                      'utf8', 'xutf8', 'utf16', 'xutf16']
+
+# Posting lists are written out after this many revisions.
+INDEX_FLUSH_REVISIONS = 2000
+
+def has_text_contents(filetype):
+    "Checks whether files of a type like 'text+x' hold searchable text."
+    return filetype.partition('+')[0] in INDEXED_FILETYPES
+
+def index_path(p4):
+    return user_cache_path(INDEX_DIR, cache_file_name(p4.port) + '.db')
+
+class TrigramIndex:
+    def __init__(self, path):
+        import sqlite3
+        import array
+        self.array = array.array
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS revisions (
+                id INTEGER PRIMARY KEY,
+                depot_file TEXT NOT NULL,
+                rev INTEGER NOT NULL,
+                UNIQUE (depot_file, rev));
+            CREATE TABLE IF NOT EXISTS posting_chunks (
+                trigram TEXT NOT NULL,
+                ids BLOB NOT NULL);
+            CREATE INDEX IF NOT EXISTS posting_chunks_trigram ON posting_chunks (trigram);
+            CREATE TABLE IF NOT EXISTS specs (
+                spec TEXT PRIMARY KEY,
+                change INTEGER NOT NULL);
+            ''')
+        # Posting lists of revisions that have been added but not
+        # written out yet.
+        self.pending = {}
+        self.pending_revisions = 0
+        self.posting_cache = {}
+
+    def specs(self):
+        "Returns the file specifications that have been indexed."
+        return [row[0] for row in self.db.execute('SELECT spec FROM specs ORDER BY spec')]
+
+    def indexed_change(self, spec):
+        "Returns the last change indexed for spec, or 0."
+        row = self.db.execute('SELECT change FROM specs WHERE spec = ?', (spec,)).fetchone()
+        if row:
+            return row[0]
+        return 0
+
+    def set_indexed_change(self, spec, change):
+        self.flush()
+        self.db.execute('INSERT OR REPLACE INTO specs (spec, change) VALUES (?, ?)', (spec, change))
+        self.db.commit()
+
+    def has_revision(self, depot_file, rev):
+        return self.db.execute('SELECT 1 FROM revisions WHERE depot_file = ? AND rev = ?',
+                               (depot_file, rev)).fetchone() is not None
+
+    def file_revisions(self, depot_file):
+        "Returns a dict mapping each indexed revision of a file to its id."
+        return dict(self.db.execute('SELECT rev, id FROM revisions WHERE depot_file = ?',
+                                    (depot_file,)))
+
+    def add_revision(self, depot_file, rev, contents):
+        """Adds a revision to the index.  contents is None for
+        revisions that don't have any we index, like deleted and binary
+        revisions.
+        """
+        cursor = self.db.execute('INSERT OR IGNORE INTO revisions (depot_file, rev) VALUES (?, ?)',
+                                 (depot_file, rev))
+        if not cursor.rowcount:
+            return
+        if contents:
+            id = cursor.lastrowid
+            for trigram in trigrams(contents.lower()):
+                posting = self.pending.get(trigram)
+                if posting is None:
+                    posting = self.pending[trigram] = self.array('i')
+                posting.append(id)
+        self.pending_revisions += 1
+        if self.pending_revisions >= INDEX_FLUSH_REVISIONS:
+            self.flush()
+
+    def flush(self):
+        """Writes out the pending posting lists, each as a new chunk of
+        its trigram's posting list, so that flushing costs the same
+        however big the index is.
+        """
+        import sqlite3
+        self.db.executemany('INSERT INTO posting_chunks (trigram, ids) VALUES (?, ?)',
+                            [(trigram, sqlite3.Binary(posting.tostring()))
+                             for trigram, posting in self.pending.iteritems()])
+        self.db.commit()
+        self.pending = {}
+        self.pending_revisions = 0
+        self.posting_cache = {}
+
+    def posting(self, trigram):
+        "Returns the set of ids of the revisions that contain trigram."
+        if trigram not in self.posting_cache:
+            ids = self.array('i')
+            for row in self.db.execute('SELECT ids FROM posting_chunks WHERE trigram = ?', (trigram,)):
+                ids.fromstring(str(row[0]))
+            self.posting_cache[trigram] = set(ids)
+        return self.posting_cache[trigram]
+
+    def matching_revisions(self, query):
+        """Returns the set of ids of the revisions that might match a
+        query from literal_trigram_query, or None if any might.
+        """
+        if query is None:
+            return None
+        if isinstance(query, str):
+            return self.posting(query)
+        operator, subqueries = query
+        results = [self.matching_revisions(q) for q in subqueries]
+        if operator == 'and':
+            results = [r for r in results if r is not None]
+            if not results:
+                return None
+            results.sort(key=len)
+            return results[0].intersection(*results[1:])
+        else:
+            if None in results:
+                return None
+            return set().union(*results)
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+def trigrams(text):
+    return set([text[i:i + 3] for i in xrange(len(text) - 2)])
+
+def literal_trigram_query(query):
+    """Turns a query for literal strings from regex_literal_query into
+    a query for their trigrams.
+    """
+    if query is None:
+        return None
+    if isinstance(query, str):
+        if len(query) < 3:
+            return None
+        return ('and', sorted(trigrams(query.lower())))
+    operator, subqueries = query
+    return make_query(operator, [literal_trigram_query(q) for q in subqueries])
+
+def narrow_file_revisions(index, query, files, following_revisions=0, unindexed=()):
+    """Given a list of files from expand_file_specs, returns the ones
+    that might contain a match for the query, with their revision
+    ranges narrowed to the first and last revisions that might, plus
+    up to following_revisions revisions after the last one.
+    Revisions that aren't in the index might match, as might any
+    revision of the files in unindexed, like binary files, whose
+    contents the index leaves out.
+    """
+    candidates = index.matching_revisions(query)
+    if candidates is None:
+        return files
+    narrowed = []
+    for depot_file, revision, rev in files:
+        bounds = pinned_revision_bounds(revision, rev)
+        if bounds is None or depot_file in unindexed:
+            narrowed.append((depot_file, revision, rev))
+            continue
+        lower, upper = bounds
+        indexed = index.file_revisions(depot_file)
+        possible = [r for r in xrange(lower, upper + 1)
+                    if r not in indexed or indexed[r] in candidates]
+        if possible:
+            last = min(upper, possible[-1] + following_revisions)
+            narrowed.append((depot_file, '#%d,%d' % (possible[0], last), str(last)))
+    return narrowed
+
+
+# --------------------
+# Mirror of changelist metadata, for 'r4 changes --cached' and for
+# the commands that would otherwise ask the server about history one
+# file or change at a time: blame, bisect and grep.  For each file
+# specification mirrored we record its submitted changes (user,
+# client, time and description) and the file revisions they
+# submitted.
+#
+# The mirror is a SQLite database in ~/.r4/changes, one per server.
+# Like the trigram index, it's updated incrementally, from the change
+# after the last one mirrored.  Only 'r4 changes --cached' updates it;
+# the other commands use it when it has what they need and ask the
+# server when it doesn't.
+# --------------------
+
+MIRROR_DIR = 'changes'
+
+# SQLite allows at most 999 parameters in a statement.
+MIRROR_QUERY_BATCH = 500
+
+def mirror_path(p4):
+    return user_cache_path(MIRROR_DIR, cache_file_name(p4.port) + '.db')
+
+def open_change_mirror(p4):
+    """Returns the server's change mirror, or None if nothing has been
+    mirrored yet.
+    """
+    path = mirror_path(p4)
+    if not os.path.exists(path):
+        return None
+    return ChangeMirror(path)
+
+def spec_contains(spec, path):
+    """Checks whether a file specification includes every file that
+    path, a depot file or another specification, names.  Both are in
+    depot syntax, without revisions.
+    """
+    if spec == path:
+        return True
+    if not re.search(r'\.\.\.|\*', path):
+        return wildcard_regex(spec).match(path) is not None
+    prefix = spec[:-3]
+    return spec.endswith('...') and not re.search(r'\.\.\.|\*', prefix) and path.startswith(prefix)
+
+class ChangeMirror:
+    def __init__(self, path):
+        import sqlite3
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.regexes = {}
+        self.db.create_function('regexp', 2, self.matches_wildcards)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS changes (
+                change INTEGER PRIMARY KEY,
+                user TEXT NOT NULL,
+                client TEXT NOT NULL,
+                time INTEGER NOT NULL,
+                description TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS changes_user ON changes (user);
+            CREATE INDEX IF NOT EXISTS changes_client ON changes (client);
+            CREATE INDEX IF NOT EXISTS changes_time ON changes (time);
+            CREATE TABLE IF NOT EXISTS revisions (
+                depot_file TEXT NOT NULL,
+                rev INTEGER NOT NULL,
+                change INTEGER NOT NULL,
+                action TEXT NOT NULL,
+                type TEXT NOT NULL,
+                PRIMARY KEY (depot_file, rev));
+            CREATE INDEX IF NOT EXISTS revisions_change ON revisions (change);
+            CREATE TABLE IF NOT EXISTS specs (
+                spec TEXT PRIMARY KEY,
+                change INTEGER NOT NULL);
+            ''')
+
+    def matches_wildcards(self, spec, depot_file):
+        "The REGEXP function: checks whether spec names depot_file."
+        if spec not in self.regexes:
+            self.regexes[spec] = wildcard_regex(spec)
+        return self.regexes[spec].match(depot_file) is not None
+
+    def specs(self):
+        "Returns the file specifications that have been mirrored."
+        return [row[0] for row in self.db.execute('SELECT spec FROM specs ORDER BY spec')]
+
+    def mirrored_change(self, path):
+        """Returns the last change mirrored for a depot file or file
+        specification, or 0 if it isn't mirrored.
+        """
+        return max([change for spec, change in self.db.execute('SELECT spec, change FROM specs')
+                    if spec_contains(spec, path)] or [0])
+
+    def update(self, p4, spec, change):
+        """Adds the changes to spec submitted since it was last
+        mirrored, up to change, and the revisions they submitted.
+        Returns how many changes were added.
+        """
+        since = self.db.execute('SELECT change FROM specs WHERE spec = ?', (spec,)).fetchone()
+        since = since and since[0] or 0
+        if since >= change:
+            return 0
+        revision_range = '%s@%d,@%d' % (spec, since + 1, change)
+        added = []
+
+        def add_change(info):
+            self.db.execute('INSERT OR REPLACE INTO changes (change, user, client, time, description) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (int(info['change']), info['user'], info['client'], int(info['time']),
+                             info['desc']))
+            added.append(info['change'])
+
+        def add_revision(info):
+            if 'depotFile' in info:
+                self.db.execute('INSERT OR REPLACE INTO revisions (depot_file, rev, change, action, type) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (info['depotFile'], int(info['rev']), int(info['change']),
+                                 info['action'], info['type']))
+
+        run_streaming(p4, add_change, 'changes', '-l', '-s', 'submitted', revision_range)
+        run_streaming(p4, add_revision, 'files', '-a', revision_range)
+        self.db.execute('INSERT OR REPLACE INTO specs (spec, change) VALUES (?, ?)', (spec, change))
+        self.db.commit()
+        return len(added)
+
+    def change_range(self, revision):
+        """Turns a revision specifier or range like '@1234', '@100,@200'
+        or '@2011/01/01,@now' into the first and last changes it
+        includes, either of which is None if there's no limit.  Dates
+        are in local time.  Raises ValueError for the ones that don't
+        name changes, like '#3'.
+        """
+        if not revision:
+            return None, None
+        bounds = revision.split(',')
+        if len(bounds) > 2 or [b for b in bounds if not b.startswith('@')]:
+            raise ValueError('Only @change and @date revisions can be used: %s' % (revision,))
+        if len(bounds) == 1:
+            return None, self.change_bound(bounds[0][1:], upper=True)
+        return (self.change_bound(bounds[0][1:], upper=False),
+                self.change_bound(bounds[1][1:], upper=True))
+
+    def change_bound(self, bound, upper):
+        if bound == 'now':
+            return None
+        if re.match(r'\d+$', bound):
+            return int(bound)
+        for date_format in ['%Y/%m/%d:%H:%M:%S', '%Y/%m/%d']:
+            try:
+                timestamp = time.mktime(time.strptime(bound, date_format))
+                break
+            except ValueError:
+                pass
+        else:
+            raise ValueError('Invalid change or date: %s' % (bound,))
+        if upper:
+            row = self.db.execute('SELECT MAX(change) FROM changes WHERE time <= ?', (timestamp,)).fetchone()
+            return row[0] or 0
+        row = self.db.execute('SELECT MIN(change) FROM changes WHERE time >= ?', (timestamp,)).fetchone()
+        if row[0] is None:
+            return sys.maxint
+        return row[0]
+
+    def changes(self, ranges, user=None, client=None, limit=None):
+        """Returns the mirrored changes in any of ranges, newest first,
+        as (change, user, client, time, description) tuples.  Each range
+        is a (spec, lower, upper) tuple: a file specification in depot
+        syntax, or None for any files, and the first and last changes,
+        or None for no limit.
+        """
+        clauses = []
+        parameters = []
+        for spec, lower, upper in ranges:
+            conditions = []
+            if spec is not None:
+                # The range of paths with the specification's prefix is
+                # found with the primary key's index.
+                prefix = re.split(r'\.\.\.|\*', spec)[0]
+                conditions.append('change IN (SELECT change FROM revisions WHERE depot_file >= ? '
+                                  'AND depot_file < ? AND depot_file REGEXP ?)')
+                parameters.extend([prefix, prefix + '\xff', spec])
+            if lower is not None:
+                conditions.append('change >= ?')
+                parameters.append(lower)
+            if upper is not None:
+                conditions.append('change <= ?')
+                parameters.append(upper)
+            clauses.append('(%s)' % (' AND '.join(conditions) or '1',))
+        query = 'SELECT change, user, client, time, description FROM changes WHERE (%s)' % (
+            ' OR '.join(clauses) or '1',)
+        if user is not None:
+            query += ' AND user = ?'
+            parameters.append(user)
+        if client is not None:
+            query += ' AND client = ?'
+            parameters.append(client)
+        query += ' ORDER BY change DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            parameters.append(limit)
+        return self.db.execute(query, parameters).fetchall()
+
+    def change_users(self, changes):
+        "Returns a dict mapping the changes that are mirrored to their (user, time)."
+        changes = list(changes)
+        users = {}
+        for start in range(0, len(changes), MIRROR_QUERY_BATCH):
+            batch = changes[start:start + MIRROR_QUERY_BATCH]
+            for change, user, timestamp in self.db.execute(
+                    'SELECT change, user, time FROM changes WHERE change IN (%s)' % (
+                        ','.join(['?'] * len(batch)),), batch):
+                users[change] = (user, timestamp)
+        return users
+
+    def file_revisions(self, depot_file, rev):
+        """Returns a dict mapping each revision number of a depot file,
+        up to rev, to a dict with its 'change', 'action' and 'type',
+        like filelog_revisions does, or None if revision rev isn't
+        mirrored.  The mirror has every revision of a file before one
+        it has.
+        """
+        revisions = {}
+        for number, change, action, filetype in self.db.execute(
+                'SELECT rev, change, action, type FROM revisions WHERE depot_file = ? AND rev <= ?',
+                (depot_file, rev)):
+            revisions[number] = {'change': str(change), 'action': action, 'type': filetype}
+        if rev not in revisions:
+            return None
+        return revisions
+
+    def pinned_revision_range(self, depot_file, revision, rev):
+        """Like pinned_revision_range, but also pins ranges that start
+        with a change, like '@1234,@5678', using the revisions the
+        mirror has.  Returns None if it can't.
+        """
+        pinned_range = pinned_revision_range(revision, rev)
+        match = re.match(r'@(\d+),', revision)
+        if pinned_range is not None or not match:
+            return pinned_range
+        if not self.db.execute('SELECT 1 FROM revisions WHERE depot_file = ? AND rev = ?',
+                               (depot_file, int(rev))).fetchone():
+            return None
+        row = self.db.execute('SELECT MIN(rev) FROM revisions WHERE depot_file = ? AND change >= ? '
+                              'AND rev <= ?', (depot_file, int(match.group(1)), int(rev))).fetchone()
+        if row[0] is None:
+            return None
+        return '#%d,%s' % (row[0], rev)
+
+    def close(self):
+        self.db.close()
+
+
+# --------------------
+# Daemon.  'r4 daemon start' runs a process that keeps a connection
+# to the server, the translation maps, the ignore rules and the stat
+# cache loaded, and runs commands for the r4 processes started in the
+# workspace.  Those look for the daemon's socket in the workspace's .r4
+# directory before importing P4, and if it's there they send it the
+# command line and copy what it sends back to stdout and stderr.
+#
+# Messages are a one character kind, a four byte length and that many
+# bytes of data:
+#
+#   r  request: a pickled dict with 'argv', 'cwd' and 'env'
+#   q  request that the daemon exit
+#   o  output for stdout
+#   e  output for stderr
+#   x  the command's exit status
+#   f  the daemon can't run the command, so run it yourself
+# --------------------
+
+DAEMON_SOCKET = 'daemon.sock'
+DAEMON_PID_FILE = 'daemon.pid'
+DAEMON_LOG = 'daemon.log'
+
+# The daemon exits after this many seconds without a request.
+DAEMON_IDLE_TIMEOUT = 3600
+
+# The daemon only runs commands for processes whose environment has
+# the same values of these as its own.
+DAEMON_ENVIRONMENT = ['P4PORT', 'P4CLIENT', 'P4USER', 'P4PASSWD', 'P4CONFIG',
+                      'P4CHARSET', 'P4TICKETS', 'HOME']
+
+# Output is sent to the client in messages of up to this size.
+DAEMON_OUTPUT_BUFFER = 16 * 1024
+
+def daemon_environment():
+    return dict((name, os.environ.get(name)) for name in DAEMON_ENVIRONMENT)
+
+def send_daemon_message(connection, kind, data=''):
+    import struct
+    connection.sendall(kind + struct.pack('!I', len(data)) + data)
+
+def receive_daemon_message(connection):
+    """Returns the (kind, data) of the next message, or (None, None) if
+    the connection was closed.
+    """
+    import struct
+    header = receive_exactly(connection, 5)
+    if header is None:
+        return None, None
+    data = receive_exactly(connection, struct.unpack('!I', header[1:])[0])
+    if data is None:
+        return None, None
+    return header[0], data
+
+def receive_exactly(connection, size):
+    chunks = []
+    while size > 0:
+        chunk = connection.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def find_daemon_socket(directory):
+    """Returns the path of the socket of the daemon for the workspace
+    containing directory, or None if there isn't one.
+    """
+    while True:
+        path = os.path.join(directory, R4_DIR, DAEMON_SOCKET)
+        if os.path.exists(path):
+            return path
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+def run_in_daemon(argv):
+    """Has the workspace's daemon run an r4 command, if there is one,
+    and exits with the command's status.  Returns if there's no daemon
+    or it can't run the command.
+    """
+    if os.environ.get('R4_NO_DAEMON'):
+        return
+    try:
+        path = find_daemon_socket(os.getcwd())
+    except OSError:
+        return
+    if path is None:
+        return
+    import socket
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        send_daemon_message(connection, 'r', cPickle.dumps(
+            {'argv': argv[1:], 'cwd': os.getcwd(), 'env': daemon_environment()},
+            cPickle.HIGHEST_PROTOCOL))
+    except socket.error:
+        # The daemon is gone, and left its socket behind.
+        return
+    output = False
+    while True:
+        try:
+            kind, data = receive_daemon_message(connection)
+        except socket.error:
+            kind = None
+        if kind == 'o':
+            sys.stdout.write(data)
+            output = True
+        elif kind == 'e':
+            sys.stderr.write(data)
+            output = True
+        elif kind == 'x':
+            sys.exit(int(data))
+        elif output:
+            sys.stderr.write('r4: lost the connection to the daemon\n')
+            sys.exit(1)
+        else:
+            return
+
+class DaemonOutput:
+    """Stands in for stdout or stderr while the daemon runs a command,
+    sending what's written to the client.  Both streams share a buffer,
+    so the client sees them in the order they were written.
+    """
+    def __init__(self, connection, kind, buffer):
+        self.connection = connection
+        self.kind = kind
+        self.buffer = buffer
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if self.buffer and self.buffer[-1][0] == self.kind:
+            self.buffer[-1][1].append(data)
+        else:
+            self.buffer.append((self.kind, [data]))
+        self.buffer.size += len(data)
+        if self.buffer.size >= DAEMON_OUTPUT_BUFFER:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        for kind, chunks in self.buffer:
+            send_daemon_message(self.connection, kind, ''.join(chunks))
+        del self.buffer[:]
+        self.buffer.size = 0
+
+    def isatty(self):
+        return False
+
+class DaemonOutputBuffer(list):
+    "The (kind, chunks) pairs DaemonOutputs haven't sent yet."
+    size = 0
+
+class Daemon:
+    """Listens on the workspace's daemon socket and runs the commands
+    it's sent, one at a time, on one connection to the server.
+    """
+    def __init__(self, p4, socket_path):
+        self.p4 = p4
+        self.socket_path = socket_path
+        self.environment = daemon_environment()
+
+    def serve(self):
+        import signal
+        import socket
+        # A client that goes away shouldn't take us with it.
+        signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        # Only we can connect.
+        old_umask = os.umask(077)
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        listener.listen(16)
+        listener.settimeout(DAEMON_IDLE_TIMEOUT)
+        try:
+            while True:
+                try:
+                    connection, address = listener.accept()
+                except socket.timeout:
+                    break
+                connection.settimeout(None)
+                try:
+                    if not self.handle(connection):
+                        break
+                except socket.error:
+                    # The client went away.
+                    pass
+                finally:
+                    connection.close()
+        finally:
+            listener.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def handle(self, connection):
+        """Runs the command a client sent.  Returns False if the daemon
+        should exit.
+        """
+        kind, data = receive_daemon_message(connection)
+        if kind == 'q':
+            send_daemon_message(connection, 'x', '0')
+            return False
+        if kind != 'r':
+            return True
+        request = cPickle.loads(data)
+        argv = request['argv']
+        handler = get_r4_command(argv[0])
+        if (request['env'] != self.environment or handler is None
+            or not handler.runs_in_daemon):
+            send_daemon_message(connection, 'f')
+            return True
+
+        buffer = DaemonOutputBuffer()
+        stdout = DaemonOutput(connection, 'o', buffer)
+        saved_stdout, saved_stderr = sys.stdout, sys.stderr
+        sys.stdout = stdout
+        sys.stderr = DaemonOutput(connection, 'e', buffer)
+        try:
+            status = self.run_command(argv, request['cwd'])
+        finally:
+            sys.stdout, sys.stderr = saved_stdout, saved_stderr
+        stdout.flush()
+        send_daemon_message(connection, 'x', str(status or 0))
+        return True
+
+    def run_command(self, argv, cwd):
+        import socket
+        import traceback
+        p4 = self.p4
+        try:
+            os.chdir(cwd)
+            p4.cwd = cwd
+            if not p4.connected():
+                p4.connect()
+            refresh_translation_map(p4)
+            return handle_command(argv[0], argv[1:], p4=p4)
+        except SystemExit, e:
+            return e.code
+        except socket.error:
+            raise
+        except P4.P4Exception, e:
+            sys.stderr.write('%s\n' % (e,))
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+
+def read_daemon_pid(p4):
+    "Returns the pid of the workspace's daemon, or None if it isn't running."
+    try:
+        with open(workspace_cache_path(DAEMON_PID_FILE, p4)) as f:
+            pid = int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return None
+    return pid
+
+
+# --------------------
+# Watching the workspace.  With 'r4 daemon start --watch', the daemon
+# uses Linux's inotify to find out about every file and directory
+# created, deleted, renamed or modified under the client root, and
+# keeps a snapshot of the directory tree.  status walks the snapshot
+# instead of the disk, after re-reading just the directories that
+# changed, and trusts the stat cache about every file that hasn't
+# changed since status last looked at it.  If the kernel's event
+# queue overflows, or a directory is renamed, we don't know what
+# changed and rescan everything.
+# --------------------
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# The watcher the daemon is running, if any.
+g_workspace_watcher = None
+
+class WatcherError(Exception):
+    pass
+
+class WorkspaceWatcher:
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+        import threading
+        self.root = os.path.abspath(root)
+        self.excluded = os.path.join(self.root, R4_DIR)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise WatcherError('inotify is not available')
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatcherError('inotify_init1: %s' % (os.strerror(ctypes.get_errno()),))
+        self.lock = threading.Lock()
+        # Maps watch descriptors to directories.
+        self.watches = {}
+        # What the events since the last update say needs looking at.
+        self.dirty_directories = set()
+        self.dirty_trees = set()
+        self.dirty_files = set()
+        self.overflowed = False
+        # Set if we ran out of watches or couldn't read events, after
+        # which we're no use.
+        self.failed = False
+        # Maps each directory under the root to its (dirnames,
+        # filenames), like os.walk.
+        self.tree = {}
+        # The files that may have changed since the update before the
+        # last one, or None if that could be any of them.
+        self.changed = None
+        # The files status has checked the stat cache entries of since
+        # we started watching them.
+        self.checked = set()
+
+    def start(self):
+        import threading
+        thread = threading.Thread(target=self.read_events)
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def add_watch(self, directory):
+        import ctypes
+        import errno
+        wd = self.libc.inotify_add_watch(self.fd, directory, WATCH_MASK)
+        if wd < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                sys.stderr.write('r4: out of inotify watches; not watching %s\n' % (self.root,))
+                self.failed = True
+            return
+        with self.lock:
+            self.watches[wd] = directory
+
+    def read_events(self):
+        import errno
+        import struct
+        header_size = struct.calcsize('iIII')
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                # Without events the snapshot can't be kept up to
+                # date, so status goes back to walking the disk.
+                sys.stderr.write('r4: could not read inotify events; not watching %s: %s\n' % (
+                    self.root, e))
+                with self.lock:
+                    self.failed = True
+                return
+            offset = 0
+            with self.lock:
+                while offset < len(data):
+                    wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                    name = data[offset + header_size:offset + header_size + length].rstrip('\0')
+                    offset += header_size + length
+                    self.handle_event(wd, mask, name)
+
+    def handle_event(self, wd, mask, name):
+        "Records what an event says has changed.  Called with the lock held."
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        if mask & IN_MOVE_SELF or (mask & IN_MOVED_FROM and mask & IN_ISDIR):
+            # The watches under a renamed directory have the wrong
+            # paths now.
+            self.overflowed = True
+            return
+        if mask & IN_DELETE_SELF:
+            return
+        path = os.path.join(directory, name)
+        if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+            self.dirty_directories.add(directory)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have been created in it before we watch it.
+                self.dirty_trees.add(path)
+        self.dirty_files.add(path)
+
+    def update(self):
+        "Brings the snapshot up to date with the events since the last update."
+        with self.lock:
+            dirty_directories, self.dirty_directories = self.dirty_directories, set()
+            dirty_trees, self.dirty_trees = self.dirty_trees, set()
+            dirty_files, self.dirty_files = self.dirty_files, set()
+            overflowed, self.overflowed = self.overflowed, False
+        if self.failed:
+            self.changed = None
+            return
+        if overflowed or not self.tree:
+            self.tree = {}
+            self.checked = set()
+            self.changed = None
+            self.scan(self.root, None)
+            return
+        changed = dirty_files
+        for directory in dirty_trees:
+            self.forget(directory)
+            if os.path.dirname(directory) in self.tree:
+                self.scan(directory, changed)
+        for directory in dirty_directories:
+            if directory in self.tree and directory not in dirty_trees:
+                self.relist(directory, changed)
+        self.changed = changed
+
+    def scan(self, directory, changed):
+        """Adds directory and everything under it to the snapshot,
+        watching each directory before listing it so no change is
+        missed.  Adds the files and directories found to changed.
+        """
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            if directory == self.excluded:
+                continue
+            self.add_watch(directory)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            dirnames, filenames = self.split_names(directory, names)
+            self.tree[directory] = (dirnames, filenames)
+            for name in dirnames:
+                path = os.path.join(directory, name)
+                if not os.path.islink(path):
+                    stack.append(path)
+            if changed is not None:
+                changed.update([os.path.join(directory, name) for name in names])
+
+    def relist(self, directory, changed):
+        "Reads a directory whose entries have changed again."
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            self.forget(directory)
+            return
+        old_dirnames, old_filenames = self.tree[directory]
+        dirnames, filenames = self.split_names(directory, names)
+        for name in set(old_dirnames) - set(dirnames):
+            self.forget(os.path.join(directory, name))
+        for name in set(dirnames) - set(old_dirnames):
+            path = os.path.join(directory, name)
+            if not os.path.islink(path):
+                self.scan(path, changed)
+        self.tree[directory] = (dirnames, filenames)
+        changed.update([os.path.join(directory, name)
+                        for name in set(filenames) ^ set(old_filenames)])
+
+    def split_names(self, directory, names):
+        "Splits the names in a directory into (dirnames, filenames), like os.walk."
+        dirnames = []
+        filenames = []
+        for name in names:
+            if os.path.isdir(os.path.join(directory, name)):
+                dirnames.append(name)
+            else:
+                filenames.append(name)
+        return dirnames, filenames
+
+    def forget(self, directory):
+        "Removes a directory and everything under it from the snapshot."
+        prefix = os.path.join(directory, '')
+        for path in [path for path in self.tree if path == directory or path.startswith(prefix)]:
+            del self.tree[path]
+
+    def covers(self, directory):
+        "Checks whether walk can walk a directory."
+        directory = os.path.abspath(directory)
+        return (not self.failed and
+                (directory == self.root or directory.startswith(os.path.join(self.root, ''))))
+
+    def walk(self, top):
+        """Like os.walk(top), but walks the snapshot.  As with os.walk,
+        removing names from the dirnames it yields keeps it from
+        walking those directories.
+        """
+        stack = [top]
+        while stack:
+            dirpath = stack.pop()
+            entry = self.tree.get(os.path.abspath(dirpath))
+            if entry is None:
+                continue
+            dirnames, filenames = list(entry[0]), list(entry[1])
+            yield dirpath, dirnames, filenames
+            for name in reversed(dirnames):
+                stack.append(os.path.join(dirpath, name))
+
+    def is_trusted(self, path):
+        """Checks whether the stat cache's entry for a file can be
+        trusted without looking at the file: status has checked it
+        since we started watching, and it hasn't changed since.
+        """
+        return self.changed is not None and path in self.checked and path not in self.changed
+
+    def mark_checked(self, paths):
+        self.checked.update(paths)
+
+
+# --------------------
+# Tracing.  'r4 --trace command' times every p4 command run through a
+# connection from get_p4_connection, and the main phases of the
+# commands that do a lot of work, counting the records and bytes each
+# one handles.  When the command exits we print a table of where the
+# time went, or with --trace=file write a trace that chrome://tracing
+# or Perfetto can load.
+# --------------------
+
+g_tracer = None
+
+# getrusage's code for the calling thread on Linux, which the resource
+# module doesn't know about.
+RUSAGE_THREAD = 1
+
+# How many of a p4 command's arguments we keep in a trace.
+TRACED_ARGUMENTS = 10
+
+def thread_cpu_time():
+    """Returns the CPU time, in seconds, used by the calling thread, or
+    by the whole process where we can't tell threads apart.
+    """
+    import resource
+    if sys.platform.startswith('linux'):
+        usage = resource.getrusage(RUSAGE_THREAD)
+    else:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def record_size(record):
+    "Returns roughly how many bytes of text a record of p4 output has."
+    if isinstance(record, basestring):
+        return len(record)
+    elif isinstance(record, dict):
+        return sum([len(key) + record_size(value) for key, value in record.iteritems()])
+    elif isinstance(record, (list, tuple)):
+        return sum([record_size(r) for r in record])
+    else:
+        return 0
+
+def flatten_arguments(args):
+    "Flattens p4 command arguments the way P4.run does."
+    flat = []
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            flat.extend(flatten_arguments(arg))
+        else:
+            flat.append(str(arg))
+    return flat
+
+class NullTraceSpan:
+    "What trace returns when we're not tracing."
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def count(self, records=1, size=0):
+        pass
+
+NULL_TRACE_SPAN = NullTraceSpan()
+
+def trace(name, category='phase', **args):
+    """Returns a context manager that records how long the code inside
+    it takes, as a phase called name, if we're tracing.
+    """
+    if g_tracer is None:
+        return NULL_TRACE_SPAN
+    return g_tracer.span(name, category, args)
+
+def trace_count(records=1, size=0):
+    """Adds records and bytes to the innermost phase the calling thread
+    is in, if we're tracing.
+    """
+    if g_tracer is not None:
+        g_tracer.current_span().count(records, size)
+
+class TraceSpan:
+    "One timed phase, or p4 command, on one thread."
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.records = 0
+        self.size = 0
+
+    def __enter__(self):
+        import threading
+        thread = threading.currentThread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.getName()
+        self.tracer.push(self)
+        self.cpu_start = thread_cpu_time()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.time() - self.start
+        self.cpu = thread_cpu_time() - self.cpu_start
+        self.tracer.pop(self)
+        return False
+
+    def count(self, records=1, size=0):
+        self.records += records
+        self.size += size
+
+class Tracer:
+    """Collects the phases a command goes through.  Phases can nest,
+    and can run at the same time on different threads, so their times
+    overlap.  Things that happen too often to record each time, like
+    writing output, are only added to the totals.
+    """
+    def __init__(self, command, path=None):
+        import threading
+        self.command = command
+        self.path = path
+        self.start = time.time()
+        self.cpu_start = os.times()
+        self.spans = []
+        # Maps each name to [count, wall, cpu, records, bytes], with
+        # the names in the order they first finished.
+        self.totals = {}
+        self.names = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def span(self, name, category='phase', args={}):
+        return TraceSpan(self, name, category, args)
+
+    def open_spans(self):
+        spans = getattr(self.local, 'spans', None)
+        if spans is None:
+            spans = self.local.spans = []
+        return spans
+
+    def push(self, span):
+        self.open_spans().append(span)
+
+    def pop(self, span):
+        self.open_spans().remove(span)
+        with self.lock:
+            self.spans.append(span)
+            self.add(span.name, span.wall, span.cpu, span.records, span.size)
+
+    def current_span(self):
+        spans = self.open_spans()
+        if spans:
+            return spans[-1]
+        return NULL_TRACE_SPAN
+
+    def add(self, name, wall, cpu, records=0, size=0):
+        "Adds to the totals for name.  Call with the lock held."
+        totals = self.totals.get(name)
+        if totals is None:
+            totals = self.totals[name] = [0, 0.0, 0.0, 0, 0]
+            self.names.append(name)
+        totals[0] += 1
+        totals[1] += wall
+        totals[2] += cpu
+        totals[3] += records
+        totals[4] += size
+
+    def add_total(self, name, wall, cpu, records=0, size=0):
+        with self.lock:
+            self.add(name, wall, cpu, records, size)
+
+    def instrument(self, p4):
+        "Makes p4 trace every command it runs."
+        run = p4.run
+        def traced_run(*args, **kwargs):
+            arguments = flatten_arguments(args)
+            if len(arguments) > TRACED_ARGUMENTS:
+                arguments[TRACED_ARGUMENTS:] = ['... (%d more)' % (len(arguments) - TRACED_ARGUMENTS,)]
+            with self.span('p4 ' + arguments[0], 'p4', {'command': ' '.join(arguments)}) as span:
+                results = run(*args, **kwargs)
+                span.count(len(results), record_size(results))
+            return results
+        p4.run = traced_run
+
+    def trace_output(self, stream, name):
+        "Returns a stream that adds the time spent writing to stream to the totals."
+        return TracedStream(self, stream, name)
+
+    def finish(self):
+        "Prints the table of totals, or writes the trace file."
+        sys.stdout.flush()
+        if self.path:
+            self.write_trace()
+        else:
+            self.print_totals(sys.stderr)
+
+    def print_totals(self, stream):
+        wall = time.time() - self.start
+        times = os.times()
+        cpu = (times[0] - self.cpu_start[0]) + (times[1] - self.cpu_start[1])
+        stream.write('r4 %s: %.1f ms, %.1f ms CPU\n' % (self.command, wall * 1000.0, cpu * 1000.0))
+        stream.write('%-36s %6s %11s %11s %9s %12s\n' % ('phase', 'count', 'wall (ms)', 'cpu (ms)',
+                                                         'records', 'bytes'))
+        for name in self.names:
+            count, wall, cpu, records, size = self.totals[name]
+            stream.write('%-36s %6d %11.1f %11.1f %9d %12d\n' % (name, count, wall * 1000.0, cpu * 1000.0,
+                                                                 records, size))
+
+    def write_trace(self):
+        """Writes the phases as complete events in Chrome's trace event
+        format, with the threads' CPU time as their thread durations.
+        """
+        import json
+        pid = os.getpid()
+        events = []
+        thread_names = {}
+        for span in self.spans:
+            thread_names[span.thread_id] = span.thread_name
+            args = dict(span.args)
+            args['records'] = span.records
+            args['bytes'] = span.size
+            events.append({'name': span.name, 'cat': span.category, 'ph': 'X',
+                           'pid': pid, 'tid': span.thread_id,
+                           'ts': (span.start - self.start) * 1e6, 'dur': span.wall * 1e6,
+                           'tts': span.cpu_start * 1e6, 'tdur': span.cpu * 1e6,
+                           'args': args})
+        for thread_id, thread_name in thread_names.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_id,
+                           'args': {'name': thread_name}})
+        # The totals include what we didn't record separately.
+        totals = dict([(name, {'count': count, 'wall_ms': wall * 1000.0, 'cpu_ms': cpu * 1000.0,
+                               'records': records, 'bytes': size})
+                       for name, (count, wall, cpu, records, size) in self.totals.items()])
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                           'otherData': {'command': self.command, 'totals': totals}}, f)
+        except IOError, e:
+            sys.stderr.write('r4: could not write trace: %s\n' % (e,))
+
+class TracedStream:
+    """Wraps an output stream, adding the time spent writing to it to
+    the tracer's totals.
+    """
+    def __init__(self, tracer, stream, name):
+        self.tracer = tracer
+        self.stream = stream
+        self.name = name
+
+    def write(self, data):
+        cpu_start = thread_cpu_time()
+        start = time.time()
+        self.stream.write(data)
+        self.tracer.add_total(self.name, time.time() - start, thread_cpu_time() - cpu_start,
+                              data.count('\n'), len(data))
+
+    def flush(self):
+        cpu_start = thread_cpu_time()
+        start = time.time()
+        self.stream.flush()
+        self.tracer.add_total(self.name, time.time() - start, thread_cpu_time() - cpu_start)
+
+    def __getattr__(self, attribute):
+        return getattr(self.stream, attribute)
+
+def start_tracing(command, path=None):
+    """Starts tracing a command, replacing sys.stdout so we count the
+    time spent writing output.
+    """
+    global g_tracer
+    g_tracer = Tracer(command, path)
+    sys.stdout = g_tracer.trace_output(sys.stdout, 'write output')
+
+
+# --------------------
+# Process commands
+# --------------------
+
+def handle_command(command, args, p4=None):
+    # If we have a custom implementation, use it, otherwise fall back
+    # to regular p4.
+    handler = get_r4_command(command)
+    if handler:
+        return handler.run_command(command, args, p4=p4)
+    else:
+        run_standard_p4_command(command, args)
+
+def run_standard_p4_command(command, args):
+    """Runs a standard p4 command.  Uses exec, so this will be the
+    last function you ever call.  Used to transfer control to stock p4
+    for non-custom commands.
+    """
+    if command:
+        args = [command] + args
+    os.execvp('p4', ['p4'] + args)
+
+class MissingOrWrongArguments(Exception):
+    pass
+
+
+# --------------------
+# Custom commands
+# --------------------
+
+# Base class for all custom commands.
+class R4Command:
+    # Whether the daemon can run the command for r4 processes.
+    runs_in_daemon = True
+
+    def __init__(self):
+        pass
+    def short_description(self):
+        raise NotImplementedError
+    def long_description(self):
+        raise NotImplementedError
+    def usage(self):
+        raise NotImplementedError
+    def run(self, p4, command, args):
+        raise NotImplementedError
+
+    def passes_to_p4(self, args):
+        """Checks whether p4 should run the command instead, for
+        commands that only change what p4 does with some arguments.
+        """
+        return False
+
+    def run_command(self, command, args, p4=None):
+        try:
+            if not p4:
+                p4 = get_p4_connection()
+            return self.run(p4, command, args)
+        except MissingOrWrongArguments:
+            self.print_usage(stream=sys.stderr)
+            sys.stderr.write('Missing/wrong number of arguments.\n')
+        except getopt.GetoptError, e:
+            self.print_usage(stream=sys.stderr)
+            sys.stderr.write('%s\n' % (e,))
+            
+
+    def print_usage(self, stream=None):
+        if stream is None:
+            stream = sys.stdout
+        # Replace '%prog' in usage text with the name of the program.
+        stream.write('Usage: %s\n' % (self.usage().replace('prog', sys.argv[0])))
+            
+
+class OpenedFileIndex:
+    """Indexes the output of 'p4 opened' by local path, so that status
+    can look up each file it sees in constant time.
+    """
+    def __init__(self, opened_info):
+        # Maps the local path of each opened file to its status code.
+        self.states = {}
+        # Maps each directory to the names of the files in it that
+        # are opened for delete.
+        self.deleted_children = {}
+        # opened's output's 'depotFile' is a depot path.
+        paths = translate_depot_paths_to_local([i['depotFile'] for i in opened_info])
+        for i, path in zip(opened_info, paths):
+            if i['action'] == 'add':
+                self.states[path] = 'A'
+            elif i['action'] == 'delete':
+                self.states[path] = 'D'
+                directory, name = os.path.split(path)
+                self.deleted_children.setdefault(directory, set()).add(name)
+            else:
+                self.states[path] = 'O'
+
+    def edited_files(self):
+        "Returns the opened files that might have been modified."
+        return [path for path, state in self.states.iteritems() if state == 'O']
+
+    def mark_modified(self, paths):
+        for path in paths:
+            if self.states.get(path) == 'O':
+                self.states[path] = 'M'
+
+
+class R4Status(R4Command):
+    def short_description(self):
+        return 'Print the status of working copy files and directories'
+
+    def usage(self):
+        return 'status [ --no-ignore ] [ -j jobs ] [ -z | --json ] [ --no-cache | --rebuild-cache | --check-cache ] [ path ... ]'
+    
+    def long_description(self):
+        return """
+    status -- %s
+
+    r4 %s
+
+    Lists all locally modified files under the specified paths (if no
+    paths are supplied the current working directory is used).
+
+    The --no-ignore flag forces files that are ignored because they
+    matched a pattern in a .r4ignore file to be printed with an 'I'
+    prefix.
+
+    The first column in the output is one character wide, and
+    indicates the file's status:
+
+      '?' Item is not under version control
+      'A' Added
+      'D' Deleted
+      'M' Modified
+      'O' Opened for editing--may be unchanged, branched or integrated
+      'I' Ignored (only with --no-ignore)
+
+    status keeps a cache of whether each opened file was modified,
+    along with its stat info, in the .r4 directory at the root of the
+    client workspace, so that it only has to check the opened files
+    that have changed since the last time it ran.  The have list of the
+    files under the given paths is fetched from the server every time.
+    The cache is thrown away whenever the client spec changes.
+
+    The --no-cache flag makes status ignore the cache and check every
+    opened file.
+
+    The --rebuild-cache flag throws away the cache and rebuilds it.
+
+    The --check-cache flag checks every opened file under the given
+    paths that the cache would trust to say whether it was modified and
+    prints any entries that are wrong, instead of printing status
+    information.
+
+    Opened files are checked for modifications by comparing MD5s of
+    the local files against the digests the server has for their have
+    revisions.  The -j/--jobs option sets the number of processes used
+    to compute the MD5s (the default is the number of CPUs).  Files
+    whose digests can't be computed locally, like keyword-expanded and
+    unicode files, are diffed by the server.
+
+    The -z/--null flag ends each line with a NUL instead of a newline,
+    so that paths with newlines in them can't be confused with the
+    lines that follow.  The --json flag prints each file as a JSON
+    object with its status and path on a line of its own:
+
+      {"status": "M", "path": "src/main.c"}
+""" % (self.short_description(), self.usage())
+
+    def run(self, p4, command, args):
+        no_ignores = False
+        use_cache = True
+        rebuild_cache = False
+        check_cache = False
+        jobs = None
+        output_format = 'text'
+
+        optlist, args = getopt.getopt(args, 'j:z', ['no-ignore', 'no-cache', 'rebuild-cache',
+                                                    'check-cache', 'jobs=', 'null', 'json'])
+        for opt, value in optlist:
+            if opt == '--no-ignore':
+                no_ignores = True
+            elif opt in ['-z', '--null']:
+                if output_format == 'json':
+                    raise getopt.GetoptError('-z and --json can\'t be used together.')
+                output_format = 'nul'
+            elif opt == '--json':
+                if output_format == 'nul':
+                    raise getopt.GetoptError('-z and --json can\'t be used together.')
+                output_format = 'json'
+            elif opt in ['-j', '--jobs']:
+                try:
+                    jobs = int(value)
+                except ValueError:
+                    raise getopt.GetoptError('Invalid number of jobs: %s' % (value,))
+            elif opt == '--no-cache':
+                use_cache = False
+            elif opt == '--rebuild-cache':
+                rebuild_cache = True
+            elif opt == '--check-cache':
+                check_cache = True
+
+        cache = None
+        if use_cache or rebuild_cache or check_cache:
+            with trace('status: load cache'):
+                cache = StatCache.load(p4)
+
+        # Was a path specified or should we just use the current
+        # directory?
+        if len(args) == 0:
+            dirs = ['.']
+        else:
+            dirs = args
+        specs = [os.path.join(dir, '...') for dir in dirs]
+
+        if check_cache:
+            cache.refresh(p4, specs)
+            problems = cache.check(p4, jobs=jobs)
+            for problem in problems:
+                print problem
+            cache.save()
+            return bool(problems)
+
+        # We make one query per command for all the paths, and run the
+        # independent queries at the same time on separate
+        # connections.
+        pool = P4ConnectionPool(p4)
+        try:
+            with trace('status: query server'):
+                if cache:
+                    if rebuild_cache:
+                        update_cache = cache.rebuild
+                    else:
+                        update_cache = cache.refresh
+                    opened_info, _ = pool.run_concurrently(
+                        lambda p4: p4.run_opened(*specs),
+                        lambda p4: update_cache(p4, specs))
+                else:
+                    opened_info, have_list, fstat_info, _ = pool.run_concurrently(
+                        lambda p4: p4.run_opened(*specs),
+                        lambda p4: HaveList.fetch(p4, specs),
+                        # The digests of opened files, for finding the
+                        # modified ones.
+                        lambda p4: p4.run(*(DIGEST_FSTAT_COMMAND + ['-Ro'] +
+                                            [spec + '#have' for spec in specs])),
+                        ensure_translation_map)
+
+            opened_index = OpenedFileIndex(opened_info)
+
+            # The daemon's watcher can tell us what's changed since we
+            # last looked.
+            watcher = None
+            if cache and g_workspace_watcher and g_workspace_watcher.root == workspace_root(p4):
+                watcher = g_workspace_watcher
+                watcher.update()
+
+            edited_files = opened_index.edited_files()
+            with trace('status: check files'):
+                if cache:
+                    have_paths = cache.have_list
+                    modified_files = cache.modified_paths(p4, edited_files, jobs=jobs,
+                                                          trusted=watcher and watcher.is_trusted)
+                    if watcher:
+                        watcher.mark_checked(edited_files)
+                else:
+                    have_paths = have_list
+                    digests = {}
+                    record_depot_digests(fstat_info, digests, get_client_spec(p4).get('LineEnd'))
+                    for path in edited_files:
+                        digests.setdefault(path, False)
+                    modified_files = find_modified_files(p4, edited_files, digests, jobs=jobs)
+                opened_index.mark_modified(modified_files)
+        finally:
+            pool.close()
+            if cache:
+                with trace('status: save cache'):
+                    cache.save()
+
+        # Files are printed as the walk finds them, so that a listing
+        # of the whole workspace is never kept in memory.
+        with trace('status: walk') as span:
+            output = BufferedOutput(sys.stdout)
+            formatter = OUTPUT_FORMATTERS[output_format](output)
+            try:
+                for dir in dirs:
+                    listing = self.walk(dir, no_ignores, opened_index, watcher)
+                    span.count(self.print_listing(listing, opened_index, have_paths, formatter))
+            finally:
+                output.flush()
+
+    def print_listing(self, listing, opened_index, have_paths, formatter):
+        """Writes the status info for each file in a listing made by walk
+        to a formatter.  Returns the number of files in the listing.
+        """
+        states = opened_index.states
+        write_status = formatter.status
+        count = 0
+        for status, print_path, full_path in listing:
+            count += 1
+            if not status:
+                status = states.get(full_path)
+                if status is None and full_path not in have_paths:
+                    status = '?'
+            if status:
+                write_status(status, print_path)
+        return count
+
+    def walk(self, dir, no_ignores, opened_index, watcher=None):
+        """Walks the directory tree under dir, yielding (status,
+        print_path, full_path) tuples in the order in which they should
+        be printed.  status is 'I' for ignored files and directories
+        (only with no_ignores), otherwise None.  If a WorkspaceWatcher
+        is given, walks its snapshot of the tree instead of the disk.
+        """
+        ignores = IgnoreWalker()
+        cache_dir = workspace_cache_dir()
+        if watcher and watcher.covers(dir):
+            walk = watcher.walk(dir)
+        else:
+            walk = os.walk(dir, topdown=True)
+        for dirpath, dirnames, filenames in walk:
+            full_dirpath = os.path.abspath(dirpath)
+            # What we put in front of names to get the paths we print.
+            print_prefix = os.path.join(os.path.normpath(dirpath), '')
+            if print_prefix == os.path.join(os.curdir, ''):
+                print_prefix = ''
+
+            # Get rid of the ignored files.
+            with trace('status: ignore matching') as span:
+                span.count(len(filenames) + len(dirnames))
+                ignore_rules = ignores.rules_for(full_dirpath)
+                if not no_ignores:
+                    filenames = [f for f in filenames if not ignore_rules.is_ignored(f)]
+
+                ignored_dirnames = []
+                for dirname in dirnames[:]:
+                    if os.path.join(full_dirpath, dirname) == cache_dir:
+                        dirnames.remove(dirname)
+                    elif ignore_rules.is_ignored(dirname, is_directory=True):
+                        dirnames.remove(dirname)
+                        ignored_dirnames.append(dirname)
+            if no_ignores:
+                for dirname in ignored_dirnames:
+                    yield ('I', print_prefix + dirname, None)
+            dirnames.sort()
+            # If there are any files marked for delete in this
+            # directory, add them to the list of files to print
+            # status info for.
+            deleted = opened_index.deleted_children.get(full_dirpath)
+            if deleted:
+                filenames = list(set(filenames) | deleted)
+
+            for f in sorted(filenames):
+                full_path = os.path.join(full_dirpath, f)
+                print_path = print_prefix + f
+                if no_ignores and ignore_rules.is_ignored(f):
+                    yield ('I', print_path, full_path)
+                else:
+                    yield (None, print_path, full_path)
+
+
+class R4Blame(R4Command):
+    def short_description(self):
+        return 'Show the change, user and date that last modified each line of a file'
+
+    def usage(self):
+        return 'blame [ -i | -I ] [ --no-cache ] file[rev]'
+
+    def long_description(self):
+        return """
+    blame -- %s
+
+    r4 %s
+    
+    Annotates each line in the given file with the changelist which
+    last modified the line, the user who submitted it and the date it
+    was submitted.
+
+    The -i flag follows the file back through the files it was
+    branched from, and -I also follows integrations into it, like
+    'p4 annotate -i' and 'p4 annotate -I'.
+
+    The blame of a file is cached in ~/.r4.  Once a file has been
+    blamed, blaming a newer revision only looks at the revisions
+    submitted since, so blaming the same file again is fast.  The
+    --no-cache flag doesn't use or update the cache.
+
+    The users and dates of the changes come from the mirror kept by
+    'r4 changes --cached', when it has them.
+    """ % (self.short_description(), self.usage())
+
+    def run(self, p4, command, args):
+        follow = None
+        use_cache = True
+        options, args = getopt.getopt(args, 'iI', ['no-cache'])
+        for option, value in options:
+            if option in ['-i', '-I']:
+                follow = option
+            elif option == '--no-cache':
+                use_cache = False
+        if len(args) != 1:
+            raise MissingOrWrongArguments()
+
+        file_info = {}
+        files = expand_file_specs(p4, args, file_info)
+        if not files:
+            sys.stderr.write('%s - no such file(s).\n' % (args[0],))
+            return
+        if len(files) > 1:
+            raise getopt.GetoptError('%s names more than one file' % (args[0],))
+        depot_file, revision, rev = files[0]
+        if not has_text_contents(file_info[depot_file]['headType']):
+            sys.stderr.write('%s#%s - not a text file.\n' % (depot_file, rev))
+            return
+
+        cache = None
+        if use_cache:
+            cache = get_revision_cache(p4)
+        mirror = open_change_mirror(p4)
+        try:
+            lines, changes = blame_file(p4, depot_file, int(rev), follow, cache, mirror)
+        finally:
+            if mirror:
+                mirror.close()
+        self.print_blame(lines, changes)
+
+    def print_blame(self, lines, changes):
+        if not lines:
+            return
+        change_width = max([len(str(change)) for change, line in lines])
+        user_width = max([len(changes.get(change, ('?',))[0]) for change, line in lines])
+        number_width = len(str(len(lines)))
+        output = sys.stdout
+        for number, (change, line) in enumerate(lines):
+            user, timestamp = changes.get(change, ('?', None))
+            if timestamp is None:
+                date = '????/??/??'
+            else:
+                date = time.strftime('%Y/%m/%d', time.localtime(timestamp))
+            if not line.endswith('\n'):
+                line += '\n'
+            output.write('%*d %-*s %s %*d: %s' % (change_width, change, user_width, user,
+                                                  date, number_width, number + 1, line))
+
+
+# The actions whose revisions blame_file can apply to a cached blame
+# when following integrations.  Other actions bring in lines from
+# other files, and we annotate the file again instead.
+FOLLOWED_BLAME_ACTIONS = ['add', 'edit', 'delete']
+
+# With more new revisions than this, annotating the file again is
+# faster than diffing them one at a time.
+MAX_BLAME_DIFFS = 50
+
+def blame_file(p4, depot_file, rev, follow=None, cache=None, mirror=None):
+    """Returns the blame of revision number rev of a depot file: a list
+    of (change, line) pairs, one for each line, giving the change that
+    last modified it, and a dict mapping those changes to their
+    (user, time).  follow is None, '-i' or '-I', as for 'p4 annotate'.
+
+    The blame of the newest revision blamed so far is kept in the
+    revision cache.  If rev is newer, the diffs of the revisions since
+    are applied to it, instead of annotating the whole file again.
+    The file's revisions and the users of the changes are looked up in
+    the change mirror, if there's one that has them.
+    """
+    kind = ' '.join(['blame'] + (follow and [follow] or []))
+    cached_rev = None
+    if cache is not None:
+        records = cache.records(kind, depot_file)
+        if records is not None:
+            header = records.next()
+            cached_rev, changes = header['rev'], header['changes']
+            if cached_rev == rev:
+                return list(records), changes
+            if cached_rev < rev:
+                lines = list(records)
+            else:
+                records.close()
+
+    revisions = None
+    if mirror is not None and not follow:
+        revisions = mirror.file_revisions(depot_file, rev)
+    if revisions is None:
+        revisions, changes = blame_filelog(p4, depot_file, rev, follow)
+    else:
+        changes = mirror.change_users(set([int(r['change']) for r in revisions.values()]))
+    new_revisions = []
+    if cached_rev is not None and cached_rev < rev:
+        new_revisions = range(cached_rev + 1, rev + 1)
+        if len(new_revisions) > MAX_BLAME_DIFFS:
+            new_revisions = []
+        elif follow and [r for r in new_revisions if r not in revisions or
+                       revisions[r]['action'] not in FOLLOWED_BLAME_ACTIONS]:
+            new_revisions = []
+    if new_revisions:
+        def has_text(r):
+            return (r in revisions and revisions[r]['action'] not in DELETE_ACTIONS
+                    and has_text_contents(revisions[r]['type']))
+        for r in new_revisions:
+            change = int(revisions[r]['change'])
+            if has_text(r) and has_text(r - 1):
+                lines = apply_blame_diff(lines, get_revision_diff(p4, depot_file, r, cache), change)
+            elif has_text(r):
+                lines = [(change, line) for line in
+                         get_file_contents(p4, depot_file, r, cache).splitlines(True)]
+            else:
+                lines = []
+    else:
+        args = ['annotate', '-c'] + (follow and [follow] or []) + ['%s#%s' % (depot_file, rev)]
+        lines = [(int(info['lower']), info['data']) for info in p4.run(*args)
+                 if 'lower' in info]
+
+    # Lines integrated from files we don't have the filelog of.
+    missing = set([change for change, line in lines]) - set(changes)
+    if missing and mirror is not None:
+        changes.update(mirror.change_users(missing))
+        missing -= set(changes)
+    if missing:
+        for info in p4.run('describe', '-s', *[str(change) for change in sorted(missing)]):
+            if 'change' in info:
+                changes[int(info['change'])] = (info['user'], int(info['time']))
+
+    if cache is not None and (cached_rev is None or cached_rev < rev):
+        writer = cache.writer(kind, depot_file)
+        writer.add({'rev': rev, 'changes': changes})
+        for line in lines:
+            writer.add(line)
+        writer.commit()
+    return lines, changes
+
+def blame_filelog(p4, depot_file, rev, follow=None):
+    """Returns the revisions of a depot file up to rev, like
+    filelog_revisions, and a dict mapping the changes in its filelog
+    to their (user, time).  With follow, the filelog includes the
+    files it was branched from.
+    """
+    revisions = {}
+    changes = {}
+    args = ['filelog'] + (follow and ['-i'] or []) + ['%s#%s' % (depot_file, rev)]
+    for info in p4.run(*args):
+        if 'rev' not in info:
+            continue
+        for i, number in enumerate(info['rev']):
+            changes[int(info['change'][i])] = (info['user'][i], int(info['time'][i]))
+            if info['depotFile'] == depot_file:
+                revisions[int(number)] = {'change': info['change'][i],
+                                          'action': info['action'][i],
+                                          'type': info['type'][i]}
+    return revisions, changes
+
+def apply_blame_diff(lines, text, change):
+    """Given the blame of a revision, as a list of (change, line) pairs,
+    and the unified diff without context from it to the next revision,
+    returns the blame of the next revision, in which the lines the
+    diff adds come from change.
+    """
+    lines = list(lines)
+    # Going backwards, each hunk's line numbers are still right.
+    for start, count, removed, added in reversed(list(unified_diff_hunks(text))):
+        if count:
+            start -= 1
+        lines[start:start + count] = [(change, line) for line in added]
+    return lines
+
+
+class R4Bisect(R4Command):
+    # It syncs the workspace and runs test commands that need the
+    # terminal.
+    runs_in_daemon = False
+
+    def short_description(self):
+        return 'Efficiently finds the change that introduced a bug'
+
+    def usage(self):
+        return ('bisect { start [ bad [ good ] ] [ -- file ... ] | good [ change ] | '
+                'bad [ change ] | skip [ change ] | run [ -k ways ] command [ arg ... ] | '
+                'log | reset }')
+
+    def long_description(self):
+        return """
+    bisect -- %s
+
+    r4 %s
+
+    An implementation of git's bisect command for Perforce.  Given a
+    change where the files worked and a later one where they didn't,
+    bisect does a binary search over the changes to the files in
+    between to find the one that broke them.
+
+    'r4 bisect start' starts a bisection of the given files (by
+    default, the client's whole view), optionally marking a bad and a
+    good change.  Then 'r4 bisect good' and 'r4 bisect bad' mark
+    changes as good or bad (by default, the change the workspace is
+    synced to), and bisect syncs the workspace to the next change to
+    test.  'r4 bisect skip' marks a change that can't be tested.
+
+    'r4 bisect run' runs a command to test each change instead.  The
+    command's exit status says whether the change is good (0), bad (1
+    through 127, except 125) or can't be tested (125); any other status
+    stops the bisection.  With -k, it tests that many changes at a
+    time, each in its own temporary client and directory, which cuts
+    the number of rounds of testing from log2(n) to log(n)/log(k+1).
+    The command is run in the directory of the temporary client that
+    corresponds to the current directory, with $P4CLIENT set to the
+    temporary client, and its output goes to .r4/bisect-<change>.log.
+
+    'r4 bisect log' prints the changes marked so far, and 'r4 bisect
+    reset' ends the bisection, syncs each file back to the revision the
+    workspace had when the bisection started and deletes the temporary
+    clients.
+
+    The changes to the files are only fetched from the server once, and
+    the bisection's state is kept in the workspace's .r4 directory.
+    """ % (self.short_description(), self.usage())
+
+    def run(self, p4, command, args):
+        if not args:
+            raise MissingOrWrongArguments()
+        subcommands = {'start': self.start, 'good': self.mark, 'bad': self.mark,
+                       'skip': self.mark, 'run': self.run_tests, 'log': self.log,
+                       'reset': self.reset}
+        subcommand, args = args[0], args[1:]
+        if subcommand not in subcommands:
+            raise getopt.GetoptError('Unknown bisect subcommand: %s' % (subcommand,))
+        try:
+            return subcommands[subcommand](p4, subcommand, args)
+        except BisectError, e:
+            sys.stderr.write('%s\n' % (e,))
+            return 1
+
+    def start(self, p4, subcommand, args):
+        files = []
+        if '--' in args:
+            files = args[args.index('--') + 1:]
+            args = args[:args.index('--')]
+        if len(args) > 2:
+            raise MissingOrWrongArguments()
+        if BisectState.load(p4):
+            raise BisectError("A bisection is already in progress; use 'r4 bisect reset' to end it.")
+        specs = []
+        for f in files or ['//%s/...' % (p4.client,)]:
+            specs.extend(depot_syntax_specs(p4, f))
+        if not specs:
+            raise BisectError('No files to bisect in the client view.')
+
+        state = BisectState(workspace_cache_path(BisectState.FILENAME, p4), specs)
+        where = p4.run_where(*specs)
+        if [w for w in where if 'unmap' in w]:
+            state.view_specs = [w['clientFile'] for w in where if 'unmap' not in w]
+        state.original = have_revisions(p4, specs)
+        for kind, arg in zip(['bad', 'good'], args):
+            state.mark(kind, parse_change(arg))
+        self.next_step(p4, state)
+
+    def mark(self, p4, kind, args):
+        state = BisectState.require(p4)
+        if args:
+            changes = [parse_change(arg) for arg in args]
+        elif state.current is not None:
+            changes = [state.current]
+        else:
+            changes = [have_change(p4, state.specs)]
+        for change in changes:
+            state.mark(kind, change)
+        self.next_step(p4, state)
+
+    def next_step(self, p4, state):
+        "Syncs the workspace to the next change to test, if there is one."
+        try:
+            if state.good is None or state.bad is None:
+                print 'Waiting for both a good and a bad change.'
+                return
+            state.fetch_changes(p4)
+            if self.report_result(state):
+                return
+            change = state.probes(1)[0]
+            left = len(state.untested()) - 1
+            print 'Bisecting: %d changes left to test after this (roughly %d steps)' % (
+                left, bisect_rounds(left, 1))
+            p4.run('sync', '-q', *['%s@%d' % (spec, change) for spec in state.specs])
+            state.current = change
+            print 'Synced to change %s' % (state.describe(change),)
+        finally:
+            state.save()
+
+    def report_result(self, state):
+        """Prints the first bad change and returns True if the bisection
+        is done.
+        """
+        suspects = state.suspects()
+        if not suspects:
+            raise BisectError('No changes to %s between %d and %d.' % (
+                ' '.join(state.specs), state.good, state.bad))
+        if state.untested():
+            return False
+        if len(suspects) == 1:
+            print 'Change %s is the first bad change.' % (state.describe(suspects[0]),)
+        else:
+            print 'There are only skipped changes left to test.'
+            print 'The first bad change could be any of:'
+            for change in suspects:
+                print state.describe(change)
+        return True
+
+    def run_tests(self, p4, subcommand, args):
+        ways = 1
+        options, command = getopt.getopt(args, 'k:')
+        for option, value in options:
+            if option == '-k':
+                try:
+                    ways = int(value)
+                except ValueError:
+                    raise getopt.GetoptError('Invalid number of ways: %s' % (value,))
+        if not command or ways < 1:
+            raise MissingOrWrongArguments()
+        state = BisectState.require(p4)
+        if state.good is None or state.bad is None:
+            raise BisectError("Mark a good and a bad change before 'r4 bisect run'.")
+
+        try:
+            while True:
+                state.fetch_changes(p4)
+                if self.report_result(state):
+                    return 0
+                changes = state.probes(ways)
+                left = len(state.untested()) - len(changes)
+                print 'Bisecting: testing %s (%d changes left after this, roughly %d rounds)' % (
+                    ', '.join([str(c) for c in changes]), max(left, 0),
+                    bisect_rounds(max(left, 0), ways))
+                if ways == 1:
+                    p4.run('sync', '-q', *['%s@%d' % (spec, changes[0]) for spec in state.specs])
+                    state.current = changes[0]
+                    statuses = [run_bisect_test(command)]
+                else:
+                    statuses = self.test_in_clients(p4, state, changes, command)
+                for change, status in zip(changes, statuses):
+                    if bisect_test_result(status) is None:
+                        raise BisectError('bisect run failed: %s exited with status %d at change %d.' % (
+                            command[0], status, change))
+                self.mark_results(state, [(change, bisect_test_result(status))
+                                          for change, status in zip(changes, statuses)])
+                state.save()
+        finally:
+            state.save()
+
+    def mark_results(self, state, results):
+        """Marks the results of testing several changes at once.  A good
+        change after a bad one can't be right, so those are ignored.
+        """
+        bad_changes = [change for change, result in results if result == 'bad']
+        for change, result in results:
+            if result == 'good' and bad_changes and change > min(bad_changes):
+                print 'Change %d is good but comes after bad change %d; ignoring it.' % (
+                    change, min(bad_changes))
+                continue
+            print 'Change %d is %s.' % (change, result)
+            state.mark(result, change)
+
+    def test_in_clients(self, p4, state, changes, command):
+        """Syncs a temporary client to each change and runs the test
+        command in each of them at the same time.  Returns the exit
+        statuses.
+        """
+        clients = self.temporary_clients(p4, state, len(changes))
+        root = get_client_spec(p4)['Root']
+        relative_cwd = os.path.relpath(os.getcwd(), root)
+        if relative_cwd.startswith(os.pardir):
+            relative_cwd = os.curdir
+        log_paths = [workspace_cache_path('bisect-%d.log' % (change,), p4) for change in changes]
+
+        def test(p4, (client, client_root), change, log_path):
+            saved_client = p4.client
+            p4.client = client
+            try:
+                p4.run('sync', '-q', *['%s@%d' % (spec, change) for spec in state.specs])
+            finally:
+                p4.client = saved_client
+            cwd = os.path.join(client_root, relative_cwd)
+            if not os.path.isdir(cwd):
+                cwd = client_root
+            env = dict(os.environ)
+            env['P4CLIENT'] = client
+            env['PWD'] = cwd
+            with open(log_path, 'w') as log:
+                return run_bisect_test(command, cwd=cwd, env=env, stdout=log, stderr=log)
+
+        pool = P4ConnectionPool(p4, size=len(changes))
+        try:
+            return pool.run_concurrently(*[
+                (lambda p4, client=client, change=change, log_path=log_path:
+                 test(p4, client, change, log_path))
+                for client, change, log_path in zip(clients, changes, log_paths)])
+        finally:
+            pool.close()
+
+    def temporary_clients(self, p4, state, count):
+        """Returns count (name, root) pairs of temporary clients with the
+        same view as the current client, creating any that don't exist
+        yet.
+        """
+        import tempfile
+        spec = get_client_spec(p4)
+        while len(state.clients) < count:
+            name = '%s-r4-bisect-%d' % (spec['Client'], len(state.clients) + 1)
+            root = tempfile.mkdtemp(prefix='r4-bisect-')
+            client = p4.fetch_client(name)
+            client['Root'] = root
+            for field in ['Options', 'LineEnd']:
+                if field in spec:
+                    client[field] = spec[field]
+            client['View'] = [line.replace('//%s/' % (spec['Client'],), '//%s/' % (name,))
+                              for line in spec['View']]
+            p4.save_client(client)
+            state.clients.append((name, root))
+            state.save()
+        for name, root in state.clients[:count]:
+            if not os.path.isdir(root):
+                # Its files are gone, so it doesn't have any.
+                os.makedirs(root)
+                saved_client = p4.client
+                p4.client = name
+                try:
+                    p4.run('sync', '-k', '//%s/...#none' % (name,))
+                finally:
+                    p4.client = saved_client
+        return state.clients[:count]
+
+    def log(self, p4, subcommand, args):
+        state = BisectState.require(p4)
+        print 'r4 bisect start -- %s' % (' '.join(state.specs),)
+        for kind, change in state.marks:
+            print 'r4 bisect %s %d' % (kind, change)
+
+    def reset(self, p4, subcommand, args):
+        import glob
+        import shutil
+        state = BisectState.require(p4)
+        for name, root in state.clients:
+            p4.run('client', '-d', name)
+            shutil.rmtree(root, ignore_errors=True)
+        state.clients = []
+        if state.current is not None:
+            self.restore_have_list(p4, state)
+        for path in glob.glob(os.path.join(workspace_cache_dir(p4), 'bisect-*.log')):
+            os.unlink(path)
+        state.delete()
+
+    def restore_have_list(self, p4, state):
+        """Syncs each file back to the revision the workspace had before
+        the bisection started.
+        """
+        have = have_revisions(p4, state.specs)
+        revisions = ['%s#%d' % (depot_file, rev)
+                     for depot_file, rev in sorted(state.original.items())
+                     if have.get(depot_file) != rev]
+        revisions += ['%s#none' % (depot_file,)
+                      for depot_file in sorted(have) if depot_file not in state.original]
+        for start in range(0, len(revisions), MAX_P4_ARGS):
+            p4.run('sync', '-q', *revisions[start:start + MAX_P4_ARGS])
+        print 'Synced %d files back to the revisions they had before the bisection' % (
+            len(revisions),)
+
+
+class BisectError(Exception):
+    pass
+
+class BisectState:
+    """The state of a bisection, which is kept in the workspace's .r4
+    directory between r4 bisect commands.  Change numbers are ints.
+    """
+    FILENAME = 'bisect'
+
+    def __init__(self, path, specs):
+        self.path = path
+        # The files being bisected, in depot syntax.
+        self.specs = specs
+        # If the client view excludes some of the files in specs, the
+        # files in the view, in client syntax, or else None.
+        self.view_specs = None
+        # The revision the workspace had of each file before the
+        # bisection started, by depot path.
+        self.original = {}
+        self.good = None
+        self.bad = None
+        self.skipped = set()
+        # The change bisect last synced the workspace to.
+        self.current = None
+        # The changes to the files, in order, from 'p4 changes' for
+        # the range changes_range, and their (user, description).
+        self.changes = []
+        self.changes_range = None
+        self.descriptions = {}
+        # (kind, change) for each change marked, in order.
+        self.marks = []
+        # The (name, root) of each temporary client made by run -k.
+        self.clients = []
+
+    @classmethod
+    def load(cls, p4):
+        "Returns the workspace's bisection, or None if there isn't one."
+        state = cls(workspace_cache_path(cls.FILENAME, p4), [])
+        try:
+            with open(state.path, 'rb') as f:
+                state.__dict__.update(cPickle.load(f))
+        except IOError:
+            return None
+        state.path = workspace_cache_path(cls.FILENAME, p4)
+        return state
 
-    def run_command(self, command, args, p4=None):
+    @classmethod
+    def require(cls, p4):
+        state = cls.load(p4)
+        if state is None:
+            raise BisectError("No bisection in progress; use 'r4 bisect start' to start one.")
+        return state
+
+    def save(self):
+        write_file_atomically(self.path, cPickle.dumps(self.__dict__, cPickle.HIGHEST_PROTOCOL))
+
+    def delete(self):
         try:
-            if not p4:
-                p4 = get_p4_connection()
-            return self.run(p4, command, args)
-        except MissingOrWrongArguments:
-            self.print_usage(stream=sys.stderr)
-            sys.stderr.write('Missing/wrong number of arguments.\n')
-        except getopt.GetoptError, e:
-            self.print_usage(stream=sys.stderr)
-            sys.stderr.write('%s\n' % (e,))
-            
+            os.unlink(self.path)
+        except OSError:
+            pass
 
-    def print_usage(self, stream=sys.stdout):
-        # Replace '%prog' in usage text with the name of the program.
-        stream.write('Usage: %s\n' % (self.usage().replace('prog', sys.argv[0])))
-            
+    def mark(self, kind, change):
+        if kind == 'good':
+            if self.bad is not None and change >= self.bad:
+                raise BisectError('Good change %d must come before bad change %d.' % (change, self.bad))
+            if self.good is None or change > self.good:
+                self.good = change
+        elif kind == 'bad':
+            if self.good is not None and change <= self.good:
+                raise BisectError('Bad change %d must come after good change %d.' % (change, self.good))
+            if self.bad is None or change < self.bad:
+                self.bad = change
+        else:
+            self.skipped.add(change)
+        self.marks.append((kind, change))
 
-class R4Status(R4Command):
-    def short_description(self):
-        return 'Print the status of working copy files and directories'
+    def fetch_changes(self, p4):
+        """Fetches the changes to the files between the good and the bad
+        change, unless we already have them.  Marking changes only ever
+        narrows the range, so that's once per bisection.  They come from
+        the change mirror if it has them.
+        """
+        if self.changes_range is not None:
+            lower, upper = self.changes_range
+            if lower <= self.good and self.bad <= upper:
+                return
+        descriptions = {}
+        # Only given client syntax does 'p4 changes' leave out changes
+        # to the files the client view excludes.  The mirror can't.
+        mirror = None
+        if not self.view_specs:
+            mirror = open_change_mirror(p4)
+        try:
+            if mirror and not [spec for spec in self.specs if mirror.mirrored_change(spec) < self.bad]:
+                for change, user, client, timestamp, description in mirror.changes(
+                        [(spec, self.good + 1, self.bad) for spec in self.specs]):
+                    descriptions[change] = (user, description.strip())
+            else:
+                for spec in self.view_specs or self.specs:
+                    for info in p4.run('changes', '-s', 'submitted',
+                                       '%s@%d,@%d' % (spec, self.good + 1, self.bad)):
+                        descriptions[int(info['change'])] = (info['user'], info['desc'].strip())
+        finally:
+            if mirror:
+                mirror.close()
+        self.changes = sorted(descriptions)
+        self.descriptions = descriptions
+        self.changes_range = (self.good, self.bad)
 
-    def usage(self):
-        return 'status [ --no-ignore ] [ path ... ]'
-    
-    def long_description(self):
-        return """
-    status -- %s
+    def suspects(self):
+        """Returns the changes that might be the first bad one.  The last
+        one is known to be bad: either it's the bad change, or the bad
+        change didn't touch the files.
+        """
+        return [change for change in self.changes if self.good < change <= self.bad]
 
-    r4 %s
+    def untested(self):
+        "Returns the suspects that are left to test."
+        return [change for change in self.suspects()[:-1] if change not in self.skipped]
 
-    Lists all locally modified files under the specified paths (if no
-    paths are supplied the current working directory is used).
+    def probes(self, ways):
+        "Returns the changes to test next, evenly spaced among the untested ones."
+        untested = self.untested()
+        if len(untested) <= ways:
+            return untested
+        return [untested[(i + 1) * len(untested) // (ways + 1)] for i in range(ways)]
 
-    The --no-ignore flag forces files that are ignored because they
-    matched a pattern in a .r4ignore file to be printed with an 'I'
-    prefix.
+    def describe(self, change):
+        if change not in self.descriptions:
+            return str(change)
+        user, description = self.descriptions[change]
+        return '%d by %s: %s' % (change, user, (description.splitlines() or [''])[0])
 
-    The first column in the output is one character wide, and
-    indicates the file's status:
+def have_revisions(p4, specs):
+    """Returns a dict mapping the depot path of each file in specs the
+    workspace has to the revision it has.
+    """
+    revisions = {}
+    def add_record(record):
+        if 'haveRev' in record:
+            revisions[record['depotFile']] = int(record['haveRev'])
+    run_streaming(p4, add_record, 'have', *specs)
+    return revisions
 
-      '?' Item is not under version control
-      'A' Added
-      'D' Deleted
-      'M' Modified
-      'O' Opened for editing--may be unchanged, branched or integrated
-      'I' Ignored (only with --no-ignore)
-""" % (self.short_description(), self.usage())
+def have_change(p4, specs):
+    """Returns the latest change the workspace has any of the files
+    synced to, or None if it has none of them.
+    """
+    changes = [int(i['change'])
+               for spec in specs
+               for i in p4.run('changes', '-m1', '-s', 'submitted', spec + '#have')]
+    return max(changes) if changes else None
 
-    def run(self, p4, command, args):
-        no_ignores = False
+def parse_change(change):
+    "Parses a change number, like '1234' or '@1234'."
+    match = re.match(r'@?(\d+)$', change)
+    if not match:
+        raise getopt.GetoptError('Invalid change: %s' % (change,))
+    return int(match.group(1))
 
-        optlist, args = getopt.getopt(args, '', ['no-ignore'])
-        for opt, value in optlist:
-            if opt == '--no-ignore':
-                no_ignores = True
+def bisect_rounds(count, ways):
+    """Returns how many rounds of testing ways changes at a time it
+    takes to find the bad one among count untested changes.
+    """
+    rounds = 0
+    while count > 0:
+        count = count // (ways + 1)
+        rounds += 1
+    return rounds
 
-        # Was a path specified or should we just use the current
-        # directory?
-        if len(args) == 0:
-            dirs = ['.']
-        else:
-            dirs = args
+def bisect_test_result(status):
+    """Returns 'good', 'bad' or 'skip' for an exit status of the test
+    command, the way git bisect run does, or None if the bisection
+    should stop.
+    """
+    if status == 0:
+        return 'good'
+    elif status == 125:
+        return 'skip'
+    elif 0 < status < 128:
+        return 'bad'
+    return None
 
-        for dir in dirs:
-
-            # Build a list of files that are in p4 under the directory
-            # we're checking.
-            info = p4.run('have', os.path.join(dir, '...'))
-            have_paths = set([i['path'] for i in info])
-
-            # Build a list of opened files that have been modified
-            # under the directory we're checking.
-            diff_info = p4.run_diff('-sa', os.path.join(dir, '...'))
-            # run_diff returns a list that contains dictionaries
-            # interspersed with strings containing diff output.  The
-            # dicts have the filenames, so here we extract the
-            # filenames from dicts. The 'clientFile' keys gives us a
-            # local pathname.
-            modified_files = [i['clientFile'] for i in diff_info if isinstance(i, dict)]
-
-            # Build a list of files that have been marked for addition
-            # or deletion, but are not yet committed.
-            opened_info = p4.run_opened(os.path.join(dir, '...'))
-
-            # opened's output's 'depotFile' is a depot path.
-            added_files = [translate_depot_to_local(i['depotFile']) for i in opened_info if i['action'] == 'add']
-            deleted_files = [translate_depot_to_local(i['depotFile']) for i in opened_info if i['action'] == 'delete']
-            opened_files = [translate_depot_to_local(i['depotFile']) for i in opened_info]
-
-            for dirpath, dirnames, filenames in os.walk(dir, topdown=True):
-                # Get rid of the ignored files.
-                ignore_patterns = ignore_patterns_for(dirpath)
-                if not no_ignores:
-                    filenames = [f for f in filenames if not is_ignored(ignore_patterns, f)]
+def run_bisect_test(command, **kwargs):
+    "Runs the test command with subprocess.call and returns its exit status."
+    import subprocess
+    try:
+        return subprocess.call(command, **kwargs)
+    except OSError, e:
+        raise BisectError("Can't run %s: %s" % (command[0], e.strerror))
 
-                for dirname in dirnames[:]:
-                    if is_ignored(ignore_patterns, dirname):
-                        dirnames.remove(dirname)
-                        if no_ignores:
-                            print 'I %s' % (os.path.normpath(os.path.join(dirpath, dirname)),)
-                dirnames.sort()
-                # If there are any files marked for delete in this
-                # directory, add them to the list of files to print
-                # status info for.
-                dirpath = os.path.normpath(dirpath)
-                for f in deleted_files:
-                    if os.path.dirname(f) == os.path.abspath(dirpath):
-                        filenames += [os.path.basename(f)]
-
-                # Print the status info for each file in this
-                # directory.
-                for f in sorted(filenames):
-                    full_path = os.path.abspath(os.path.join(dirpath, f))
-                    print_path = os.path.normpath(os.path.join(dirpath, f))
-                    if no_ignores and is_ignored(ignore_patterns, f):
-                        print 'I %s' % (print_path,)
-                    elif full_path in added_files:
-                        print 'A %s' % (print_path,)
-                    elif full_path in deleted_files:
-                        print 'D %s' % (print_path,)
-                    elif full_path in modified_files:
-                        print 'M %s' % (print_path,)
-                    elif full_path in opened_files:
-                        print 'O %s' % (print_path,)
-                    elif not full_path in have_paths:
-                        print '? %s' % (print_path,)
 
+class AnnotateGrepper:
+    """Matches the output of 'p4 annotate -a' against a LineMatcher,
+    one record at a time, and writes the matches to a formatter.
+    """
+    def __init__(self, matcher, invert_matches=False, just_list_filenames=False,
+                 output=None, binary=False):
+        self.matcher = matcher
+        self.invert_matches = invert_matches
+        # With binary, we just say which revisions match, like GNU
+        # grep does for binary files.
+        self.binary = binary
+        self.just_list_filenames = just_list_filenames or binary
+        self.output = output or TextFormatter(sys.stdout)
+        self.path = None
+        self.match_ranges = RevisionRangeSet()
+
+    def add_record(self, record):
+        # There are two types of annotate records:
+        #
+        # 1. Info on the file who's data follows. Contains
+        #    'depotFile' members and others.
+        #
+        # 2. Info on a line in the file.  Contains 'upper',
+        #    'lower' and 'data' members.
+        if 'depotFile' in record:
+            # Finish up the previous file, if there was one, and
+            # prepare to handle the new file.
+            self.finish_file()
+            self.path = strip_revision_specifiers(record['depotFile'])
+        else:
+            re_matches = self.matcher.search(record['data'])
+            if self.invert_matches: re_matches = not re_matches
+            if re_matches:
+                if self.just_list_filenames:
+                    self.match_ranges.add(record['lower'], record['upper'])
+                else:
+                    self.output.matching_line(self.path, record['lower'], record['upper'], record['data'])
 
-class R4Blame(R4Command):
-    def short_description(self):
-        return 'Show what revision and author last modified each line of a file--TBD'
+    def finish_file(self):
+        if self.path and self.match_ranges:
+            for lower, upper in self.match_ranges:
+                self.output.matching_file(self.path, lower, upper, self.binary)
+        self.path = None
+        self.match_ranges = RevisionRangeSet()
 
-    def usage(self):
-        return 'blame'
 
-    def long_description(self):
-        return """
-    blame -- %s
+class IntroducedGrepper:
+    """Finds the revisions of a file that changed how many lines match
+    a LineMatcher, looking only at the lines each revision added or
+    removed, and writes those lines to a formatter.
+    """
+    def __init__(self, matcher, just_list_filenames=False, output=None, cache=None,
+                 filelogs=None):
+        self.matcher = matcher
+        self.just_list_filenames = just_list_filenames
+        self.output = output or TextFormatter(sys.stdout)
+        self.cache = cache
+        # Maps depot files to their revisions, like filelog_revisions
+        # returns, for the files whose revisions are already known.
+        self.filelogs = filelogs or {}
 
-    r4 %s
-    
-    Annotates each line in the given file with information on the
-    revision which last modified the line.
-    """ % (self.short_description(), self.usage())
+    def search_file(self, p4, depot_file, lower, upper):
+        "Searches revisions lower through upper of a file."
+        revisions = self.filelogs.get(depot_file) or filelog_revisions(p4, depot_file, upper)
 
-    def run(self, p4, command, args):
-        print args
-        annotate_info = p4.run_annotate('-i', args[0])
-        filelog_info = p4.run('filelog', '-i', args[0])
-        pprint.pprint(annotate_info)
-        pprint.pprint(filelog_info)
+        def has_text(rev):
+            return (rev in revisions and revisions[rev]['action'] not in DELETE_ACTIONS
+                    and has_text_contents(revisions[rev]['type']))
 
+        for rev in range(lower, upper + 1):
+            if has_text(rev) and has_text(rev - 1):
+                removed, added = unified_diff_changes(
+                    get_revision_diff(p4, depot_file, rev, self.cache))
+            elif has_text(rev):
+                removed = []
+                added = get_file_contents(p4, depot_file, rev, self.cache).splitlines(True)
+            elif has_text(rev - 1):
+                removed = get_file_contents(p4, depot_file, rev - 1, self.cache).splitlines(True)
+                added = []
+            else:
+                continue
+            removed = [line for line in removed if self.matcher.search(line)]
+            added = [line for line in added if self.matcher.search(line)]
+            if len(removed) != len(added):
+                self.print_change(depot_file, rev, removed, added)
 
-class R4Bisect(R4Command):
-    def short_description(self):
-        return 'Efficiently finds the change that introduced a bug--TBD'
+    def print_change(self, depot_file, rev, removed, added):
+        if self.just_list_filenames:
+            self.output.matching_file(depot_file, rev, rev)
+            return
+        for sign, lines in (('-', removed), ('+', added)):
+            for line in lines:
+                self.output.matching_line(depot_file, rev, rev, line, sign)
 
-    def usage(self):
-        return 'bisect <subcommand> <options>'
+def filelog_revisions(p4, depot_file, rev):
+    """Returns a dict mapping each revision number of a depot file, up
+    to rev, to a dict with the 'change', 'action' and 'type' of the
+    revision from 'p4 filelog'.
+    """
+    revisions = {}
+    for info in p4.run('filelog', '%s#%s' % (depot_file, rev)):
+        if 'rev' not in info:
+            continue
+        for i, number in enumerate(info['rev']):
+            revisions[int(number)] = {'change': info['change'][i],
+                                      'action': info['action'][i],
+                                      'type': info['type'][i]}
+    return revisions
 
-    def long_description(self):
-        return """
-    bisect -- %s
+def unified_diff_hunks(text):
+    """Given a unified diff, like 'p4 diff2 -du' prints, yields a
+    (start, count, removed, added) tuple for each hunk, where start
+    and count are the old file's line numbers from the hunk header,
+    removed is a list of the lines it removes and added is a list of
+    the lines it adds.
+    """
+    lines = text.splitlines(True)
+    i = 0
+    while i < len(lines):
+        match = re.match(r'@@ -(\d+)(?:,(\d+))? \+\d+(?:,(\d+))? @@', lines[i])
+        i += 1
+        if not match:
+            continue
+        # The hunk header tells us how many lines follow, which is the
+        # only safe way to tell a removed line like '-- x' from a
+        # header.
+        start = int(match.group(1))
+        count = old_count = int(match.group(2) or 1)
+        new_count = int(match.group(3) or 1)
+        removed = []
+        added = []
+        while (old_count > 0 or new_count > 0) and i < len(lines):
+            line = lines[i]
+            i += 1
+            if line.startswith('\\'):
+                # '\ No newline at end of file'
+                continue
+            elif line.startswith('-'):
+                removed.append(line[1:])
+                old_count -= 1
+            elif line.startswith('+'):
+                added.append(line[1:])
+                new_count -= 1
+            else:
+                old_count -= 1
+                new_count -= 1
+        yield start, count, removed, added
 
-    r4 %s
+def unified_diff_changes(text):
+    """Given a unified diff, returns a list of the lines it removes and
+    a list of the lines it adds.
+    """
+    removed = []
+    added = []
+    for start, count, hunk_removed, hunk_added in unified_diff_hunks(text):
+        removed.extend(hunk_removed)
+        added.extend(hunk_added)
+    return removed, added
 
-    An implementation of git's bisect command for Perforce.
-    """ % (self.short_description(), self.usage())
-    
 
 class R4Grep(R4Command):
     def short_description(self):
         return 'Search across revisions of files for lines matching a pattern'
 
     def usage(self):
-        return 'grep [ -i ] [ -l ] [ -v ] pattern file[revRange]...'
+        return 'grep [ -i ] [ -l ] [ -v ] [ -F ] [ -j jobs ] [ --no-cache ] [ --indexed ] [ --introduced ] [ --binary-files=type ] [ --type=types ] [ --exclude-type=types ] [ --max-size=size ] [ --local ] [ -z | --json ] { pattern | -e pattern... | -f file } file[revRange]...'
 
     def long_description(self):
         return """
@@ -416,6 +4384,21 @@ class R4Grep(R4Command):
       r4 grep pattern ./...
       r4 grep pattern ./.../file
 
+    The -e/--regexp option gives a pattern, and can be used more than
+    once to search for lines matching any of several patterns.  The
+    -f/--file option reads patterns from a file, one per line.  When
+    either is used, every argument is a file to search.
+
+    Example:
+
+      r4 grep -e ALL -e TESTS Makefile
+      r4 grep -F -f symbols.txt ./...
+
+    The -F/--fixed-strings flag treats the patterns as literal strings
+    instead of regular expressions.  Any number of strings are matched
+    in a single pass over each line, so searching for hundreds of
+    names at once costs little more than searching for one.
+
     The -i/--ignore-case flag causes the matching to be done while
     ignoring case distinctions.
 
@@ -433,77 +4416,712 @@ class R4Grep(R4Command):
 
     The -v/--invert-match flag inverts the sense of matching, to
     select non-matching lines.
+
+    The -j/--jobs option searches that many files at a time, each
+    using its own connection to the server.  Output is printed in the
+    same order as with a single job.
+
+    The revisions grep searches are kept in a cache in ~/.r4, so
+    searching them again doesn't have to go to the server.  The cache
+    is limited to 1 GB, or the number of megabytes in
+    $R4_REVISION_CACHE_SIZE.  The --no-cache flag doesn't use the
+    cache.
+
+    The --indexed flag uses the index built by 'r4 index' to skip the
+    files and revisions that can't contain a match, which makes
+    searching large parts of the depot's history practical.
+    Revisions submitted since the index was last updated are always
+    searched.  The index can't help with -v, or with patterns that
+    don't require a literal string of at least three characters.
+
+    Before searching, grep gets the type and size of every file with
+    one 'p4 fstat' per file argument, and leaves out the files it
+    doesn't need to search.  Binary files are left out unless
+    --binary-files says otherwise: with --binary-files=text they're
+    searched as if they were text, and with --binary-files=binary
+    they're searched but only a "Binary file ... matches" line is
+    printed for the revisions that match.  The --type option only
+    searches files of the given types, and --exclude-type leaves out
+    files of the given types; both take a comma-separated list of
+    types like 'text' or 'text+x'.  The --max-size option leaves out
+    files bigger than the given size, like 512k or 10M.  Only the
+    revisions the server keeps of +S files are searched.
+
+    The --local flag searches the files in the workspace instead of
+    their history in the depot.  Only files on the have list are
+    searched, and files ignored by .r4ignore are left out.  Files are
+    searched in a pool of processes, by default one per CPU, or as
+    many as -j says.  Matches are printed with the depot path and the
+    have revision of the file, as if it hadn't been modified.  Apart
+    from fetching the have list of the given files, this doesn't
+    involve the server.
+
+    Example:
+
+      $ r4 grep --local ALL ./...
+      //depot/project/Makefile#5: ALL     :=      tools scripts tests
+
+    The --introduced flag finds the revisions that changed how many
+    lines match, like git log -S, instead of every revision that
+    contains a match.  Only the lines each revision added or removed
+    are looked at, which for files with long histories is much less
+    than annotate has to read.  The matching lines each revision added
+    or removed are printed with a '+' or '-'.  With -l, just the
+    revisions are printed.
+
+    Example:
+
+      $ r4 grep --introduced tests Makefile
+      //depot/project/Makefile#3: +ALL     :=      tools scripts tests
+      //depot/project/Makefile#4: -ALL     :=      tools scripts tests
+      //depot/project/Makefile#5: +ALL     :=      tools scripts tests
+
+    The -z/--null flag prints a NUL after each file name and revision
+    instead of the ': ' (or, with -l, the newline) that would follow
+    it, so that file names can't be confused with what follows them.
+
+    The --json flag prints each match as a JSON object on a line of
+    its own, with the file's depot path, the lower and upper
+    revisions of the range that matched and the matching line (with
+    --introduced, with a sign of '+' or '-').  With -l, the objects
+    don't have lines, and binary matches have a binary member.
+
+    Example:
+
+      $ r4 grep --json tests Makefile
+      {"path": "//depot/project/Makefile", "lower": 3, "upper": 5, "line": "ALL     :=      tools scripts tests"}
     
     """ % (self.short_description(), self.usage())
     
     def run(self, p4, command, args):
-        import re
         # Process options.
         case_sensitive = True
         just_list_filenames = False
         invert_matches = False
-        options, args = getopt.getopt(args, 'ilv', ['ignore-case', 'files-with-matches',
-                                                    'invert-match'])
+        jobs = None
+        use_cache = True
+        use_index = False
+        introduced = False
+        local = False
+        binary_files = 'without-match'
+        include_types = []
+        exclude_types = []
+        max_size = None
+        fixed_strings = False
+        output_format = 'text'
+        patterns = []
+        options, args = getopt.getopt(args, 'ilvzFe:f:j:', ['ignore-case', 'files-with-matches',
+                                                           'invert-match', 'fixed-strings',
+                                                           'regexp=', 'file=', 'jobs=',
+                                                           'no-cache', 'indexed', 'introduced',
+                                                           'binary-files=', 'type=',
+                                                           'exclude-type=', 'max-size=', 'local',
+                                                           'null', 'json'])
         for option, value in options:
-            if option in ['-i', '--ignore-case']:
+            if option in ['-e', '--regexp']:
+                patterns.append(value)
+            elif option in ['-f', '--file']:
+                try:
+                    with open(value) as f:
+                        patterns.extend(f.read().splitlines())
+                except IOError, e:
+                    raise getopt.GetoptError('Could not read patterns: %s' % (e,))
+            elif option in ['-F', '--fixed-strings']:
+                fixed_strings = True
+            elif option in ['-i', '--ignore-case']:
                 case_sensitive = False
             elif option in ['-l', '--files-with-matches']:
                 just_list_filenames = True
             elif option in ['-v', '--invert-match']:
                 invert_matches = True
+            elif option in ['-j', '--jobs']:
+                try:
+                    jobs = int(value)
+                except ValueError:
+                    raise getopt.GetoptError('Invalid number of jobs: %s' % (value,))
+            elif option == '--no-cache':
+                use_cache = False
+            elif option == '--indexed':
+                use_index = True
+            elif option == '--introduced':
+                introduced = True
+            elif option == '--local':
+                local = True
+            elif option in ['-z', '--null']:
+                if output_format == 'json':
+                    raise getopt.GetoptError('-z and --json can\'t be used together.')
+                output_format = 'nul'
+            elif option == '--json':
+                if output_format == 'nul':
+                    raise getopt.GetoptError('-z and --json can\'t be used together.')
+                output_format = 'json'
+            elif option == '--binary-files':
+                if value not in BINARY_FILES_POLICIES:
+                    raise getopt.GetoptError('Invalid --binary-files: %s' % (value,))
+                binary_files = value
+            elif option == '--type':
+                include_types.extend(value.split(','))
+            elif option == '--exclude-type':
+                exclude_types.extend(value.split(','))
+            elif option == '--max-size':
+                try:
+                    max_size = parse_size(value)
+                except ValueError, e:
+                    raise getopt.GetoptError(str(e))
 
-        if len(args) < 2:
+        if not patterns:
+            if not args:
+                raise MissingOrWrongArguments('Missing/wrong number of arguments.')
+            patterns = args[:1]
+            args = args[1:]
+        if not args:
             raise MissingOrWrongArguments('Missing/wrong number of arguments.')
+        if introduced and invert_matches:
+            raise getopt.GetoptError('--introduced and -v can\'t be used together.')
+        if local and (introduced or use_index or include_types or exclude_types):
+            raise getopt.GetoptError('--local can\'t be used with --introduced, --indexed, --type or --exclude-type.')
+        if local and [f for f in args if split_revision_specifier(f)[1]]:
+            raise getopt.GetoptError('--local searches the workspace, so files can\'t have revisions.')
+        if use_index and not os.path.exists(index_path(p4)):
+            sys.stderr.write("r4: there's no index for %s; run 'r4 index' first\n" % (p4.port,))
+            return 1
             
-        regex = args[0]
-        files = args[1:]
-
-        # Build our regex.
-        re_flags = 0
-        if not case_sensitive:
-            re_flags |= re.IGNORECASE
-        regexp = re.compile(regex, re_flags)
-
-        got_match = False
-        match_ranges = []
-        path = None
-        
-        # Search through files.
-        for file in files:
-            annotate_info = p4.run_annotate('-a', file)
-            # Each element in annotate_info is a dictionary, and there are two types:
-            #
-            # 1. Info on the file who's data follows. Contains
-            #    'depotFile' members and others.
-            #
-            # 2. Info on a line in the file.  Contains 'upper',
-            #    'lower' and 'data' members.
-            for line in annotate_info:
-                if 'depotFile' in line:
-                    # Finish up the previous file, if there was one.
-                    if path:
-                        if just_list_filenames and got_match:
-                            for lower, upper in coalesce_revision_ranges(match_ranges):
-                                print '%s%s' % (path, (canonicalize_revision_range(lower, upper)))
-                    # Prepare to handle the new file.
-                    got_match = False
-                    match_ranges = []
-                    path = strip_revision_specifiers(line['depotFile'])
+        files = args
+        try:
+            matcher = LineMatcher(patterns, fixed_strings, ignore_case=not case_sensitive)
+        except re.error, e:
+            raise getopt.GetoptError('Invalid pattern: %s' % (e,))
+
+        formatter_class = OUTPUT_FORMATTERS[output_format]
+        output = BufferedOutput(sys.stdout)
+        formatter = formatter_class(output)
+        try:
+            if local:
+                return self.run_local(p4, files, (patterns, fixed_strings, not case_sensitive),
+                                      invert_matches, just_list_filenames, binary_files, max_size, jobs,
+                                      formatter)
+            if jobs is None:
+                jobs = 1
+
+            if use_cache:
+                cache = get_revision_cache(p4)
+            else:
+                cache = None
+
+            # The files we search as text even though they aren't.
+            binary_paths = set()
+
+            def annotate_file(p4, grepper, file):
+                depot_file, revision, rev = file
+                flags = ['-a']
+                if depot_file in binary_paths:
+                    flags.append('-t')
+                # We process annotate's output as it arrives instead of
+                # waiting for all of it.
+                pinned_range = pinned_revision_range(revision, rev)
+                if pinned_range is None:
+                    run_streaming(p4, grepper.add_record, 'annotate', flags, depot_file + revision)
+                else:
+                    spec = depot_file + pinned_range
+                    run_cached(p4, cache, grepper.add_record, ' '.join(['annotate'] + flags), spec,
+                               'annotate', flags, spec)
+
+            def grep_file(p4, file, output):
+                if introduced:
+                    depot_file, revision, rev = file
+                    lower, upper = pinned_revision_bounds(revision, rev) or (1, int(rev))
+                    grepper = IntroducedGrepper(matcher, just_list_filenames, output, cache, filelogs)
+                    grepper.search_file(p4, depot_file, lower, upper)
+                else:
+                    binary = binary_files == 'binary' and file[0] in binary_paths
+                    grepper = AnnotateGrepper(matcher, invert_matches, just_list_filenames, output, binary)
+                    annotate_file(p4, grepper, file)
+                    grepper.finish_file()
+
+            filtering = include_types or exclude_types or max_size is not None or binary_files != 'without-match'
+            if jobs <= 1 and not (use_cache or use_index or introduced or filtering):
+                with trace('grep: search'):
+                    grepper = AnnotateGrepper(matcher, invert_matches, just_list_filenames, formatter)
+                    for file in files:
+                        run_streaming(p4, grepper.add_record, 'annotate', '-a', file)
+                    grepper.finish_file()
+                return
+
+            # Leave out the files that can't match or that we were asked
+            # not to search, so we never have the server annotate them.
+            # The change mirror, if there is one, turns ranges of changes
+            # into ranges of revisions, which can be cached and
+            # narrowed, and has the filelogs --introduced needs.
+            filelogs = {}
+            with trace('grep: list files') as span:
+                file_info = {}
+                files = expand_file_specs(p4, files, file_info)
+                mirror = open_change_mirror(p4)
+                if mirror:
+                    try:
+                        pinned_files = []
+                        for depot_file, revision, rev in files:
+                            pinned_files.append((depot_file, mirror.pinned_revision_range(
+                                depot_file, revision, rev) or revision, rev))
+                            if introduced:
+                                filelogs[depot_file] = mirror.file_revisions(depot_file, int(rev))
+                        files = pinned_files
+                    finally:
+                        mirror.close()
+                searched = []
+                for depot_file, revision, rev in files:
+                    info = file_info[depot_file]
+                    filetype = info.get('headType', 'text')
+                    base_type = filetype.partition('+')[0]
+                    if include_types and filetype not in include_types and base_type not in include_types:
+                        continue
+                    if filetype in exclude_types or base_type in exclude_types:
+                        continue
+                    if max_size is not None and int(info.get('fileSize', 0)) > max_size:
+                        continue
+                    if not has_text_contents(filetype):
+                        if binary_files == 'without-match':
+                            continue
+                        binary_paths.add(depot_file)
+                    # Older revisions of +S files have been purged.
+                    stored = stored_revisions(filetype)
+                    if stored is not None:
+                        lower, upper = pinned_revision_bounds(revision, rev) or (1, int(rev))
+                        revision = '#%d,%d' % (max(lower, upper - stored + 1), upper)
+                    searched.append((depot_file, revision, rev))
+                files = searched
+                span.count(len(files))
+
+            if use_index and not invert_matches:
+                # Only search the files and revisions that might match.
+                # A revision that removes matching lines comes right after
+                # the last one that has them.
+                with trace('grep: narrow with index') as span:
+                    index = TrigramIndex(index_path(p4))
+                    try:
+                        files = narrow_file_revisions(index, matcher.trigram_query(), files,
+                                                      following_revisions=introduced and 1 or 0,
+                                                      unindexed=binary_paths)
+                    finally:
+                        index.close()
+                    span.count(len(files))
+
+            with trace('grep: search') as span:
+                span.count(len(files))
+                if jobs <= 1:
+                    for file in files:
+                        grep_file(p4, file, formatter)
                 else:
-                    re_matches = regexp.search(line['data'])
-                    if invert_matches: re_matches = not re_matches
-                    if re_matches:
-                        if just_list_filenames:
-                            got_match = True
-                            match_ranges.append((line['lower'], line['upper']))
-                        else:
-                            revisions = canonicalize_revision_range(line['lower'], line['upper'])
-                            sys.stdout.write('%s%s: %s' % (path, revisions, line['data']))
-            # Finish up the previous file, if there was one.
+                    # Search each file separately, several at a time, and
+                    # print each file's output in order once it's done.
+                    def buffered_grep_file(p4, file):
+                        with trace('grep: search file'):
+                            buffer = cStringIO.StringIO()
+                            grep_file(p4, file, formatter_class(buffer))
+                            return buffer.getvalue()
+
+                    pool = P4ConnectionPool(p4, size=jobs)
+                    try:
+                        for data in imap_ordered(pool, buffered_grep_file, files, jobs):
+                            output.write(data)
+                    finally:
+                        pool.close()
+        finally:
+            output.flush()
+
+    def run_local(self, p4, specs, matcher_args, invert_matches, just_list_filenames,
+                  binary_files, max_size, jobs, formatter):
+        """Searches the files in the workspace that are on the have list,
+        which we get for the files in specs from the stat cache that
+        status uses, and writes the matches to a formatter.
+        """
+        import multiprocessing
+        with trace('grep: list files') as span:
+            regexes = local_spec_regexes(p4, specs)
+            cache = StatCache.load(p4)
+            cache.refresh(p4, specs)
+            cache.save()
+            have_list = cache.have_list
+            is_ignored = make_ignore_checker(os.path.abspath(get_client_spec(p4)['Root']))
+            paths = sorted([path for path, rev in have_list.files()
+                            if [r for r in regexes if r.match(path)] and not is_ignored(path)])
+            span.count(len(paths))
+
+        init_args = tuple(matcher_args) + (invert_matches, just_list_filenames, binary_files, max_size)
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        if jobs <= 1 or len(paths) < MIN_FILES_FOR_POOL:
+            pool = None
+            init_local_grep(*init_args)
+            results = itertools.imap(grep_local_file, paths)
+        else:
+            pool = multiprocessing.Pool(jobs, init_local_grep, init_args)
+            results = pool.imap(grep_local_file, paths, max(1, len(paths) / (jobs * 4)))
+
+        ensure_translation_map(p4)
+        local_to_depot = get_translation_map('local', 'depot')
+        with trace('grep: search'):
+            try:
+                for path, result in itertools.izip(paths, results):
+                    if result is None:
+                        continue
+                    depot_file = local_to_depot.translate(path)
+                    rev = have_list.revision(path)
+                    if result is True:
+                        formatter.matching_file(depot_file, rev, rev, binary=True)
+                    elif just_list_filenames:
+                        formatter.matching_file(depot_file, rev, rev)
+                    else:
+                        for line in result:
+                            formatter.matching_line(depot_file, rev, rev, line)
+            finally:
+                if pool:
+                    pool.terminate()
+
+
+class R4Index(R4Command):
+    def short_description(self):
+        return 'Index file revisions for grep --indexed'
+
+    def usage(self):
+        return 'index [ -j jobs ] [ file ... ]'
+
+    def long_description(self):
+        return """
+    index -- %s
+
+    r4 %s
+
+    Builds or updates an index of the contents of every revision of
+    the named files, which 'r4 grep --indexed' uses to search history
+    without annotating every revision.  The index is kept in
+    ~/.r4/index.
+
+    Updates are incremental: only revisions submitted in changelists
+    after the last one indexed are added.  With no files, updates all
+    of the files indexed before, or the client's whole view if nothing
+    has been indexed yet.
+
+    Examples:
+
+      r4 index //depot/project/...
+      r4 index
+
+    The -j/--jobs option fetches that many revisions at a time, each
+    using its own connection to the server.
+    
+    """ % (self.short_description(), self.usage())
+
+    def run(self, p4, command, args):
+        jobs = 1
+        options, args = getopt.getopt(args, 'j:', ['jobs='])
+        for option, value in options:
+            if option in ['-j', '--jobs']:
+                try:
+                    jobs = int(value)
+                except ValueError:
+                    raise getopt.GetoptError('Invalid number of jobs: %s' % (value,))
+
+        index = TrigramIndex(index_path(p4))
+        try:
+            specs = []
+            for arg in args:
+                specs.extend(depot_syntax_specs(p4, arg))
+            if not specs:
+                specs = index.specs() or ['//%s/...' % (p4.client,)]
+
+            change = latest_change(p4)
+            for spec in specs:
+                count = self.update(p4, index, spec, change, jobs)
+                print '%s: %d revisions indexed through change %d' % (spec, count, change)
+        finally:
+            index.close()
+
+    def update(self, p4, index, spec, change, jobs):
+        """Adds the revisions of spec submitted since it was last
+        indexed, up to change.  Returns how many revisions were added.
+        """
+        since = index.indexed_change(spec)
+        if since >= change:
+            return 0
+        revisions = [i for i in p4.run_files('-a', '%s@%d,@%d' % (spec, since + 1, change))
+                     if 'depotFile' in i and not index.has_revision(i['depotFile'], int(i['rev']))]
+
+        def fetch_contents(p4, info):
+            if info['action'] in DELETE_ACTIONS or not has_text_contents(info['type']):
+                return None
+            return get_file_contents(p4, info['depotFile'], info['rev'])
+
+        pool = P4ConnectionPool(p4, size=jobs)
+        try:
+            for info, contents in itertools.izip(revisions, imap_ordered(pool, fetch_contents,
+                                                                         revisions, jobs)):
+                index.add_revision(info['depotFile'], int(info['rev']), contents)
+        finally:
+            pool.close()
+        index.set_indexed_change(spec, change)
+        return len(revisions)
+
+
+class R4Changes(R4Command):
+    def short_description(self):
+        return 'List submitted changes from a local mirror of their metadata'
+
+    def usage(self):
+        return ('changes --cached [ -l -t ] [ -c client ] [ -m max ] [ -u user ] '
+                '[ file[revRange] ... ]')
+
+    def long_description(self):
+        return """
+    changes -- %s
+
+    r4 %s
+
+    Without --cached, this is 'p4 changes'.
+
+    With --cached, lists the submitted changes to the named files from
+    a mirror of the changes' metadata and the files they submitted,
+    kept in ~/.r4/changes, instead of asking the server.  The mirror
+    is first brought up to date, which only fetches the changes
+    submitted since the last time.  Named files that aren't mirrored
+    yet are added to it; if there are none and nothing has been
+    mirrored, the client's whole view is.
+
+    The files can have a revision range of changes or dates, like
+    @1234,@5678 or @2011/01/01,@now.  Dates are in local time.
+
+    The -l flag prints the whole description, -t prints the time as
+    well as the date, -c and -u list only the changes submitted from a
+    client or by a user, and -m lists at most max changes, as for 'p4
+    changes'.
+
+    'r4 blame', 'r4 bisect' and 'r4 grep' also use the mirror, when it
+    has the changes they need, instead of asking the server for the
+    changes and filelogs of files.
+
+    Examples:
+
+      r4 changes --cached -u bob //depot/project/...
+      r4 changes --cached -m 10 ...@2011/01/01,@2011/02/01
+    
+    """ % (self.short_description(), self.usage())
+
+    def passes_to_p4(self, args):
+        return '--cached' not in args
+
+    def run(self, p4, command, args):
+        long_descriptions = False
+        show_times = False
+        client = None
+        user = None
+        limit = None
+        options, args = getopt.getopt(args, 'ltc:m:u:', ['cached'])
+        for option, value in options:
+            if option == '-l':
+                long_descriptions = True
+            elif option == '-t':
+                show_times = True
+            elif option == '-c':
+                client = value
+            elif option == '-u':
+                user = value
+            elif option == '-m':
+                try:
+                    limit = int(value)
+                except ValueError:
+                    raise getopt.GetoptError('Invalid maximum: %s' % (value,))
+
+        files = []
+        for arg in args:
+            path, revision = split_revision_specifier(arg)
             if path:
-                if just_list_filenames and got_match:
-                    for lower, upper in coalesce_revision_ranges(match_ranges):
-                        print '%s%s' % (path, (canonicalize_revision_range(lower, upper)))
+                files.extend([(spec, revision) for spec in depot_syntax_specs(p4, path)])
+            else:
+                files.append((None, revision))
+
+        mirror = ChangeMirror(mirror_path(p4))
+        try:
+            with trace('changes: update mirror'):
+                specs = mirror.specs()
+                new_specs = [spec for spec, revision in files
+                             if spec is not None and not [s for s in specs if spec_contains(s, spec)]]
+                if not specs and not new_specs:
+                    new_specs = [w['depotFile'] for w in p4.run_where('//%s/...' % (p4.client,))
+                                 if 'unmap' not in w]
+                change = latest_change(p4)
+                for spec in specs + sorted(set(new_specs)):
+                    mirror.update(p4, spec, change)
+
+            ranges = []
+            for spec, revision in files or [(None, '')]:
+                try:
+                    lower, upper = mirror.change_range(revision)
+                except ValueError, e:
+                    raise getopt.GetoptError(str(e))
+                ranges.append((spec, lower, upper))
+            with trace('changes: query'):
+                changes = mirror.changes(ranges, user, client, limit)
+        finally:
+            mirror.close()
+        self.print_changes(changes, long_descriptions, show_times)
+
+    def print_changes(self, changes, long_descriptions=False, show_times=False):
+        "Prints changes the way 'p4 changes' does."
+        output = BufferedOutput(sys.stdout)
+        date_format = show_times and '%Y/%m/%d %H:%M:%S' or '%Y/%m/%d'
+        for change, user, client, timestamp, description in changes:
+            header = 'Change %d on %s by %s@%s' % (change, time.strftime(date_format, time.localtime(timestamp)),
+                                                   user, client)
+            if long_descriptions:
+                output.write('%s\n\n%s\n' % (header, ''.join(['\t%s\n' % (line,)
+                                                               for line in description.splitlines()])))
+            else:
+                output.write("%s '%s'\n" % (header, description.replace('\n', ' ')[:31]))
+        output.flush()
+
+
+class R4Daemon(R4Command):
+    runs_in_daemon = False
+
+    def short_description(self):
+        return 'Run a daemon that makes r4 commands in the workspace faster'
+
+    def usage(self):
+        return 'daemon { start [ --watch ] | stop | status | run [ --watch ] }'
+
+    def long_description(self):
+        return """
+    daemon -- %s
+
+    r4 %s
+
+    'r4 daemon start' starts a daemon for the current workspace, which
+    keeps a connection to the server and the client's view, ignore
+    rules and status cache loaded between commands.  While it's
+    running, r4 commands run in the workspace are sent to it instead
+    of starting up from scratch.  That takes the cost of starting up
+    out of frequent commands like 'r4 status', which still asks the
+    server for the have list of the files it looks at.
+
+    'r4 daemon stop' stops it, 'r4 daemon status' says whether it's
+    running and 'r4 daemon run' runs it in the foreground.  The daemon
+    exits by itself after an hour without a command.
+
+    With --watch (only on Linux), the daemon uses inotify to keep
+    track of the files that change in the workspace, so that 'r4
+    status' only has to look at those instead of walking the whole
+    workspace.
+
+    The daemon only runs commands for processes with the same P4PORT,
+    P4CLIENT, P4USER, P4PASSWD, P4CONFIG, P4CHARSET, P4TICKETS and HOME
+    as it has; other r4 processes run commands themselves, as do all of
+    them if R4_NO_DAEMON is set.  'r4 bisect' always runs by itself.
+    """ % (self.short_description(), self.usage())
+
+    def run(self, p4, command, args):
+        if not args:
+            raise MissingOrWrongArguments()
+        subcommand, args = args[0], args[1:]
+        watch = False
+        options, args = getopt.getopt(args, '', ['watch'])
+        for option, value in options:
+            if option == '--watch':
+                watch = True
+        if args:
+            raise MissingOrWrongArguments()
+        if subcommand == 'start':
+            return self.start(p4, watch)
+        elif subcommand == 'run':
+            return self.serve(p4, watch)
+        elif subcommand == 'stop':
+            return self.stop(p4)
+        elif subcommand == 'status':
+            return self.status(p4)
+        raise getopt.GetoptError('Unknown daemon subcommand: %s' % (subcommand,))
+
+    def start(self, p4, watch):
+        pid = read_daemon_pid(p4)
+        if pid:
+            print 'The r4 daemon is already running (pid %d).' % (pid,)
+            return
+        socket_path = workspace_cache_path(DAEMON_SOCKET, p4)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        log_path = workspace_cache_path(DAEMON_LOG, p4)
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            for i in range(100):
+                if os.path.exists(socket_path):
+                    print 'Started the r4 daemon (pid %d).' % (read_daemon_pid(p4),)
+                    return
+                time.sleep(0.05)
+            sys.stderr.write('The r4 daemon did not start; see %s\n' % (log_path,))
+            return 1
+
+        # Detach from the terminal, the way daemons do.
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        try:
+            with open(os.devnull) as devnull:
+                os.dup2(devnull.fileno(), 0)
+            with open(log_path, 'a') as log:
+                os.dup2(log.fileno(), 1)
+                os.dup2(log.fileno(), 2)
+            self.serve(get_p4_connection(), watch)
+        except:
+            import traceback
+            traceback.print_exc()
+        os._exit(0)
+
+    def serve(self, p4, watch=False):
+        global g_workspace_watcher
+        if watch:
+            try:
+                g_workspace_watcher = WorkspaceWatcher(workspace_root(p4)).start()
+            except WatcherError, e:
+                sys.stderr.write('r4: not watching the workspace: %s\n' % (e,))
+        pid_path = workspace_cache_path(DAEMON_PID_FILE, p4)
+        write_file_atomically(pid_path, '%d\n' % (os.getpid(),))
+        try:
+            Daemon(p4, workspace_cache_path(DAEMON_SOCKET, p4)).serve()
+        finally:
+            try:
+                os.unlink(pid_path)
+            except OSError:
+                pass
+
+    def stop(self, p4):
+        import socket
+        if not read_daemon_pid(p4):
+            print "The r4 daemon isn't running."
+            return
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(workspace_cache_path(DAEMON_SOCKET, p4))
+            send_daemon_message(connection, 'q')
+            receive_daemon_message(connection)
+        finally:
+            connection.close()
+        print 'Stopped the r4 daemon.'
+
+    def status(self, p4):
+        pid = read_daemon_pid(p4)
+        if pid:
+            print 'The r4 daemon is running (pid %d).' % (pid,)
+        else:
+            print "The r4 daemon isn't running."
+
+
+def depot_syntax_specs(p4, spec):
+    """Translates a file specification in local or client syntax into
+    depot syntax, so that it means the same thing from any directory.
+    """
+    path, revision = split_revision_specifier(spec)
+    if path.startswith('//') and not path.startswith('//%s/' % (p4.client,)):
+        return [path]
+    return [w['depotFile'] for w in p4.run_where(path) if 'unmap' not in w]
 
 
 def canonicalize_revision_range(lower, upper):
@@ -521,14 +5139,64 @@ def strip_revision_specifiers(path):
     specifier, returns just the file specification without a revision
     specifier.
     """
-    at_pos = path.rfind('@')
-    if at_pos != -1:
-        return path[0:at_pos]
-    else:
-        hash_pos = path.rfind('#')
-        if hash_pos != -1:
-            return path[0:hash_pos]
-    return path
+    return split_revision_specifier(path)[0]
+
+def split_revision_specifier(path):
+    """Splits a file specification into the file part and the
+    revision specifier or range, e.g. '//depot/foo.c#3,5' -> ('//depot/foo.c',
+    '#3,5').  Literal '@' and '#' characters in paths are always
+    escaped, so the first one starts the revision.
+    """
+    match = re.search('[@#]', path)
+    if match:
+        return path[:match.start()], path[match.start():]
+    return path, ''
+
+# The actions that leave a revision without any contents.
+DELETE_ACTIONS = ['delete', 'move/delete', 'purge', 'archive']
+
+# What expand_file_specs asks fstat for.
+EXPAND_FSTAT_COMMAND = ['fstat', '-Ol', '-T', 'depotFile,headRev,headType,headAction,fileSize']
+
+def expand_file_specs(p4, specs, file_info=None):
+    """Expands the wildcards in a list of file specifications with a
+    single 'p4 fstat' per specification.  Returns a (depot file,
+    revision specifier, revision number) tuple for each file, where
+    the revision specifier is the one the file was named with and the
+    number is the revision it resolved to.  Files whose revision is
+    deleted are left out.  If file_info is given, it's filled in with
+    the fstat record of each file, which includes its 'headType' and
+    'fileSize'.
+    """
+    expanded = []
+    for spec in specs:
+        path, revision = split_revision_specifier(spec)
+        for i in p4.run(*(EXPAND_FSTAT_COMMAND + [spec])):
+            if 'headRev' in i and i.get('headAction') not in DELETE_ACTIONS:
+                expanded.append((i['depotFile'], revision, i['headRev']))
+                if file_info is not None:
+                    file_info[i['depotFile']] = i
+    return expanded
+
+# The values of grep's --binary-files option.
+BINARY_FILES_POLICIES = ['binary', 'text', 'without-match']
+
+def stored_revisions(filetype):
+    """Returns how many revisions the server keeps of files with the
+    given type, like 'binary+S4', or None if it keeps them all.
+    """
+    match = re.search(r'\+\w*S(\d*)', filetype)
+    if not match:
+        return None
+    return int(match.group(1) or 1)
+
+def parse_size(size):
+    "Parses a size in bytes, like '512', '64k' or '10M'."
+    match = re.match(r'(\d+)([kKmMgG]?)$', size)
+    if not match:
+        raise ValueError('Invalid size: %s' % (size,))
+    multiplier = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[match.group(2).lower()]
+    return int(match.group(1)) * multiplier
     
     
 
@@ -565,43 +5233,100 @@ class R4Help(R4Command):
 def get_p4_connection():
     p4 = P4.P4()
     p4.exception_level = p4.RAISE_ERROR
-    p4.connect()
+    with trace('p4 connect', 'p4'):
+        p4.connect()
+    if g_tracer:
+        g_tracer.instrument(p4)
     return p4
 
 
 
+class RevisionRangeSet:
+    """A set of revision numbers, kept as a sorted list of disjoint,
+    non-adjacent ranges like [(1, 10), (12, 13)].  Adding a range
+    merges it with the ranges it overlaps or touches.
+    """
+    def __init__(self, ranges=()):
+        # The lower and upper ends of the ranges, in parallel lists so
+        # we can bisect on either.
+        self.lowers = []
+        self.uppers = []
+        for lower, upper in sorted([(int(l), int(u)) for l, u in ranges]):
+            if self.uppers and lower <= self.uppers[-1] + 1:
+                if upper > self.uppers[-1]:
+                    self.uppers[-1] = upper
+            else:
+                self.lowers.append(lower)
+                self.uppers.append(upper)
+
+    def add(self, lower, upper):
+        "Adds the revisions from lower to upper, inclusive."
+        lower, upper = int(lower), int(upper)
+        uppers = self.uppers
+        if not uppers or lower > uppers[-1] + 1:
+            # Past the end, which is the usual case for annotate output.
+            self.lowers.append(lower)
+            uppers.append(upper)
+            return
+        # Ranges i through j - 1 overlap or touch the new one.
+        i = bisect.bisect_left(uppers, lower - 1)
+        j = bisect.bisect_right(self.lowers, upper + 1)
+        if i == j:
+            self.lowers.insert(i, lower)
+            uppers.insert(i, upper)
+            return
+        if j - i == 1:
+            if lower < self.lowers[i]:
+                self.lowers[i] = lower
+            if upper > uppers[i]:
+                uppers[i] = upper
+            return
+        self.lowers[i:j] = [min(lower, self.lowers[i])]
+        uppers[i:j] = [max(upper, uppers[j - 1])]
+
+    def union(self, other):
+        return RevisionRangeSet(list(self) + list(other))
+
+    def intersection(self, other):
+        result = RevisionRangeSet()
+        i = j = 0
+        while i < len(self.lowers) and j < len(other.lowers):
+            lower = max(self.lowers[i], other.lowers[j])
+            upper = min(self.uppers[i], other.uppers[j])
+            if lower <= upper:
+                result.lowers.append(lower)
+                result.uppers.append(upper)
+            if self.uppers[i] < other.uppers[j]:
+                i += 1
+            else:
+                j += 1
+        return result
+
+    def __contains__(self, revision):
+        i = bisect.bisect_right(self.lowers, revision) - 1
+        return i >= 0 and revision <= self.uppers[i]
+
+    def __iter__(self):
+        return itertools.izip(self.lowers, self.uppers)
+
+    def __len__(self):
+        "Returns the number of ranges."
+        return len(self.lowers)
+
+    def __eq__(self, other):
+        return isinstance(other, RevisionRangeSet) and list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'RevisionRangeSet(%r)' % (list(self),)
+
 def coalesce_revision_ranges(ranges):
     """Returns the smallest set of revision ranges that cover the
     ranges passed in.  E.g., ((1, 10), (11, 13)) -> (1, 13)
     """
-    # Fuck it, let's just brute force this.
-    # Build a bitmap.
-    max_r = None
-    for l, r in ranges:
-        if not max_r or int(r) > max_r:
-            max_r = int(r)
-    revisions = [False] * (max_r + 1)
-    for l, r in ranges:
-        for i in range(int(l), int(r) + 1):
-            revisions[i] = True
-
-    # Scan the bitmap.
-    new_ranges = []
-    start_l = None
-    pos = 0
-    while pos < len(revisions):
-        state = revisions[pos]
-        if start_l:
-            if state == False:
-                new_ranges.append((start_l, pos - 1))
-                start_l = None
-        if not start_l:
-            if state == True:
-                start_l = pos
-        pos += 1
-    if start_l:
-        new_ranges.append((start_l, pos - 1))
-    return new_ranges
+    return list(RevisionRangeSet(ranges))
 
 
 # Hook our custom implementations to the command names.
@@ -609,21 +5334,48 @@ def coalesce_revision_ranges(ranges):
 def_r4_command('status', R4Status())
 def_r4_command('help', R4Help())
 def_r4_command('grep', R4Grep())
+def_r4_command('index', R4Index())
 def_r4_command('bisect', R4Bisect())
 def_r4_command('blame', R4Blame())
+def_r4_command('daemon', R4Daemon())
+def_r4_command('changes', R4Changes())
 
 
-if __name__ == '__main__':
-    try:
-        p4 = get_p4_connection()
+def main(argv):
+    # --trace[=file] comes before the command.
+    trace_path = None
+    tracing = len(argv) > 1 and (argv[1] == '--trace' or argv[1].startswith('--trace='))
+    if tracing:
+        trace_path = argv[1].partition('=')[2] or None
+        argv = argv[:1] + argv[2:]
+    # Commands we don't implement go straight to p4, without loading
+    # the P4 module or connecting to the server.
+    if len(argv) > 1 and get_r4_command(argv[1]) and not get_r4_command(argv[1]).passes_to_p4(argv[2:]):
+        # Stop quietly, like other Unix tools, when whatever's reading
+        # our output goes away, instead of with a traceback.
+        import signal
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        # A traced command runs here, where we can see it.
+        if get_r4_command(argv[1]).runs_in_daemon and not tracing:
+            run_in_daemon(argv)
+        if tracing:
+            start_tracing(argv[1], trace_path)
+        try:
+            try:
+                with trace('r4 ' + argv[1], 'command'):
+                    status = handle_command(argv[1], argv[2:])
+            finally:
+                if tracing:
+                    g_tracer.finish()
+            sys.exit(status)
+        except P4.P4Exception, e:
+            sys.stderr.write('%s\n' % (e,))
+            sys.exit(1)
+    elif len(argv) > 1:
+        run_standard_p4_command(argv[1], argv[2:])
+    else:
+        run_standard_p4_command(None, [])
 
-        if len(sys.argv) > 1:
-            command = sys.argv[1]
-            args = sys.argv[2:]
-            sys.exit(handle_command(command, args, p4=p4))
-        else:
-            run_standard_p4_command(None, [])
-    except P4.P4Exception, e:
-        sys.stderr.write('%s\n' % (e,))
-        sys.exit(1)
-        
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,66 @@
+"""
+Tests for how r4 grep matches lines.  r4 is Python 2, so run these
+with a Python 2 interpreter, e.g. 'python2 -m unittest discover tests'.
+"""
+
+import os
+import sys
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('r4 needs Python 2')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import r4
+
+
+class RegexLiteralTextTest(unittest.TestCase):
+    def test_plain_text(self):
+        self.assertEqual(r4.regex_literal_text('TODO'), 'TODO')
+
+    def test_escaped_metacharacters(self):
+        self.assertEqual(r4.regex_literal_text(r'foo\('), 'foo(')
+        self.assertEqual(r4.regex_literal_text(r'a\.b'), 'a.b')
+        self.assertEqual(r4.regex_literal_text(r'/\* TODO'), '/* TODO')
+        self.assertEqual(r4.regex_literal_text(r'x = 2\;'), 'x = 2;')
+
+    def test_inline_flags(self):
+        self.assertEqual(r4.regex_literal_text('(?x)TODO'), None)
+        self.assertEqual(r4.regex_literal_text('(?i)todo'), None)
+
+    def test_metacharacters(self):
+        self.assertEqual(r4.regex_literal_text('a.b'), None)
+        self.assertEqual(r4.regex_literal_text('ab*'), None)
+
+
+class LineMatcherTest(unittest.TestCase):
+    def test_escaped_metacharacters(self):
+        self.assertTrue(r4.LineMatcher([r'foo\(']).search('call foo(x)'))
+        self.assertTrue(r4.LineMatcher([r'a\.b']).search('a.b'))
+        self.assertFalse(r4.LineMatcher([r'a\.b']).search('axb'))
+        self.assertTrue(r4.LineMatcher([r'/\* TODO']).search('  /* TODO: fix */'))
+        self.assertTrue(r4.LineMatcher([r'a\.b', r'c\(']).search('c(d)'))
+
+    def test_inline_flags(self):
+        self.assertTrue(r4.LineMatcher(['(?x)TODO']).search('/* TODO */'))
+        self.assertTrue(r4.LineMatcher(['(?x) T O D O ']).search('/* TODO */'))
+        self.assertTrue(r4.LineMatcher(['(?i)todo']).search('/* TODO */'))
+        self.assertFalse(r4.LineMatcher(['(?x)TODO']).search('(?x)TOD'))
+
+    def test_fixed_strings(self):
+        self.assertTrue(r4.LineMatcher([r'a\.b'], fixed_strings=True).search(r'a\.b'))
+        self.assertFalse(r4.LineMatcher([r'a\.b'], fixed_strings=True).search('a.b'))
+
+    def test_ignore_case(self):
+        self.assertTrue(r4.LineMatcher([r'foo\('], ignore_case=True).search('FOO(x)'))
+
+    def test_text_filter(self):
+        matcher = r4.LineMatcher([r'foo\(', r'bar\.'])
+        self.assertTrue(matcher.text_filter.search('x foo( y'))
+        self.assertTrue(matcher.text_filter.search('bar.'))
+        self.assertFalse(matcher.text_filter.search('foo bar'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+Tests for HaveList, the compact have list status and grep --local use.
+r4 is Python 2, so run these with a Python 2 interpreter, e.g.
+'python2 -m unittest discover tests'.
+"""
+
+import os
+import sys
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('r4 needs Python 2')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import r4
+
+
+class HaveListTest(unittest.TestCase):
+    def test_lookup(self):
+        have_list = r4.HaveList()
+        have_list.add('/ws/a/x.c', 3)
+        have_list.add('/ws/a/b.c', 1)
+        have_list.add('/ws/c/d.c', 7)
+        self.assertEqual(have_list.revision('/ws/a/x.c'), 3)
+        self.assertEqual(have_list.revision('/ws/a/b.c'), 1)
+        self.assertEqual(have_list.revision('/ws/c/d.c'), 7)
+        self.assertEqual(have_list.revision('/ws/a/d.c'), None)
+        self.assertTrue('/ws/c/d.c' in have_list)
+        self.assertFalse('/ws/c' in have_list)
+        self.assertEqual(len(have_list), 3)
+
+    def test_interleaved_directories(self):
+        have_list = r4.HaveList()
+        for i in range(100):
+            have_list.add('/ws/d%d/f%d.c' % (i % 3, i), i)
+        self.assertEqual(len(have_list), 100)
+        for i in range(100):
+            self.assertEqual(have_list.revision('/ws/d%d/f%d.c' % (i % 3, i)), i)
+        # Adding after looking up merges into what's there.
+        have_list.add('/ws/d0/new.c', 5)
+        have_list.add('/ws/d1/f1.c', 9)
+        self.assertEqual(have_list.revision('/ws/d0/new.c'), 5)
+        self.assertEqual(have_list.revision('/ws/d1/f1.c'), 9)
+        self.assertEqual(len(have_list), 101)
+
+    def test_files(self):
+        have_list = r4.HaveList()
+        have_list.add('/ws/b/y.c', 2)
+        have_list.add('/ws/a/x.c', 1)
+        have_list.add('/ws/b/a.c', 3)
+        self.assertEqual(list(have_list.files()),
+                         [('/ws/a/x.c', 1), ('/ws/b/a.c', 3), ('/ws/b/y.c', 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+Tests for the revision cache in ~/.r4/revisions.  r4 is Python 2, so
+run these with a Python 2 interpreter, e.g. 'python2 -m unittest
+discover tests'.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('r4 needs Python 2')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import r4
+
+
+class RevisionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = r4.RevisionCache('fake:1666', self.directory, max_size=1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, kind, key, records):
+        writer = self.cache.writer(kind, key)
+        for record in records:
+            writer.add(record)
+        writer.commit()
+
+    def entries_size(self):
+        return sum([os.path.getsize(os.path.join(dirpath, name))
+                    for dirpath, dirnames, filenames in os.walk(self.directory)
+                    for name in filenames
+                    if dirpath != self.directory and not name.startswith('.')])
+
+    def test_records(self):
+        self.assertEqual(self.cache.records('annotate', '//depot/a.c#1,2'), None)
+        self.write('annotate', '//depot/a.c#1,2', [{'data': 'x\n'}, {'data': 'y\n'}])
+        self.assertEqual(list(self.cache.records('annotate', '//depot/a.c#1,2')),
+                         [{'data': 'x\n'}, {'data': 'y\n'}])
+
+    def test_size_of_new_entries(self):
+        self.write('annotate', '//depot/a.c#1', ['a' * 100])
+        self.write('annotate', '//depot/b.c#1', ['b' * 200])
+        self.assertEqual(self.cache.read_size(), self.entries_size())
+
+    def test_size_of_replaced_entries(self):
+        for rev in range(1, 20):
+            self.write('blame', '//depot/a.c', [(rev, str(i) * rev) for i in range(rev * 10)])
+        self.assertEqual(self.cache.read_size(), self.entries_size())
+
+
+if __name__ == '__main__':
+    unittest.main()